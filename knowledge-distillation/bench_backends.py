@@ -0,0 +1,40 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from knowledge_distillation import InProcessBackend, StudentModel
+
+# InProcessBackend の動的バッチングによるスループットを測る
+#
+# CPU のモデルは1回の呼び出しに固定のコストがかかり、1件あたりのコストは小さいので、まとめるほど速くなる。
+# ここではモデルの代わりに「1回 overhead 秒 + 1件 per_item 秒」かかる関数を使う。
+#
+# poetry run python bench_backends.py --items 2000
+
+def simulated_model(overhead: float, per_item: float):
+    def predict_batch(prompts: list[str]) -> list[str]:
+        time.sleep(overhead + per_item * len(prompts))
+        return ["True"] * len(prompts)
+    return predict_batch
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dynamic batching of the in-process backend")
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--overhead", type=float, default=0.02, help="Simulated cost per model call (s)")
+    parser.add_argument("--per-item", type=float, default=0.0005, help="Simulated cost per prompt (s)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    args = parser.parse_args()
+
+    prompts = [f"X がイベント{i}をする" for i in range(args.items)]
+    print(f"{'max_batch_size':>14}{'seconds':>9}{'items/s':>9}{'batches':>9}")
+    for batch_size in args.batch_sizes:
+        backend = InProcessBackend(simulated_model(args.overhead, args.per_item), max_batch_size=batch_size)
+        student = StudentModel(backend=backend)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(student.generate, prompts))
+        elapsed = time.perf_counter() - start
+        print(f"{batch_size:>14}{elapsed:>9.2f}{args.items / elapsed:>9.0f}{backend.stats['batches']:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import os
+import time
+from knowledge_distillation import KnowledgeDistillation, StudentModel, TeacherModel, serve_stub
+
+# evaluate_inferences のスループットを並列度ごとに比較する (ローカルのモックサーバを使用)
+#
+# poetry run python bench_concurrency.py --events 32 --latency 0.05
+
+INFERENCE = """- xEvent: X が本を読む
+- xEffect: 知識が増える
+- xWant: 続きを読みたい
+- xNeed: 本を手に入れる
+- xIntent: 知識を得たい
+- xReact: 満足する
+- HinderedBy: 時間がない"""
+
+def respond(prompt: str) -> str:
+    return "True" if "True" in prompt else INFERENCE
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent evaluate_inferences")
+    parser.add_argument("--events", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server latency per request (s)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    events = [f"X がイベント{i}をする" for i in range(args.events)]
+    with serve_stub(respond, delay=args.latency) as base_url:
+        print(f"{'concurrency':>11}{'seconds':>9}{'events/s':>10}{'requests/s':>12}")
+        baseline = None
+        for concurrency in args.concurrency:
+            distillation = KnowledgeDistillation(
+                teacher=TeacherModel(base_url=base_url),
+                student=StudentModel(base_url=base_url),
+            )
+            start = time.perf_counter()
+            metrics = distillation.evaluate_inferences(events, num_samples=len(events), concurrency=concurrency)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or metrics
+            assert metrics == baseline, "metrics must not depend on concurrency"
+            requests = len(events) * 7
+            print(f"{concurrency:>11}{elapsed:>9.2f}{len(events) / elapsed:>10.1f}{requests / elapsed:>12.1f}")
+
+if __name__ == "__main__":
+    main()
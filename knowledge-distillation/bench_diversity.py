@@ -0,0 +1,82 @@
+import argparse
+import multiprocessing
+import random
+import resource
+import time
+from collections import Counter
+from knowledge_distillation.diversity import DiversityTracker
+
+# 多様性の集計 (DiversityTracker) のスループットとメモリを件数ごとに測る
+#
+# poetry run python bench_diversity.py --records 10000 100000 1000000
+
+PREDICATES = ["が増える", "が減る", "を得たい", "が必要", "に満足する", "が足りない", "を楽しむ", "を忘れる"]
+
+def synthetic_inferences(count: int, seed: int = 0, duplicate_rate: float = 0.3):
+    """推論らしい短い文を作る。duplicate_rate の割合で最近の文の1文字違いを混ぜる"""
+    rng = random.Random(seed)
+    # 常用漢字の範囲からランダムに選んだ語彙
+    words = ["".join(chr(0x4E00 + rng.randrange(3000)) for _ in range(rng.randint(1, 3))) for _ in range(5000)]
+    recent: list[str] = []
+    for _ in range(count):
+        if recent and rng.random() < duplicate_rate:
+            text = rng.choice(recent)
+            position = rng.randrange(len(text))
+            text = text[:position] + rng.choice("のがをにでとも") + text[position + 1:]
+        else:
+            text = "の".join(rng.choice(words) for _ in range(rng.randint(2, 4))) + rng.choice(PREDICATES)
+            recent = (recent + [text])[-100:]
+        yield text
+
+def peak_memory_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def batches(count: int, batch_size: int):
+    batch: list[str] = []
+    for text in synthetic_inferences(count):
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    yield batch
+
+def run_counter(count: int, batch_size: int) -> tuple[float, float, float, str]:
+    counter: Counter = Counter()
+    elapsed = 0.0
+    for batch in batches(count, batch_size):
+        start = time.perf_counter()
+        counter.update(batch)
+        elapsed += time.perf_counter() - start
+    return elapsed, peak_memory_mb(), float("nan"), f"diversity={count / len(counter):.3f}"
+
+def run_tracker(count: int, batch_size: int) -> tuple[float, float, float, str]:
+    tracker = DiversityTracker(bloom_capacity=max(count * 20, 1_000_000))
+    # 入力の生成にかかる時間は含めない
+    elapsed = 0.0
+    for batch in batches(count, batch_size):
+        start = time.perf_counter()
+        tracker.add(batch)
+        elapsed += time.perf_counter() - start
+    report = tracker.report()
+    metrics = (f"diversity={count / report['distinct_texts']:.3f} distinct_2={report['distinct_n']:.3f}"
+               f" self_overlap={report['self_overlap']:.3f} near_duplicate_rate={report['near_duplicate_rate']:.3f}"
+               f" clusters={report['clusters']}")
+    return elapsed, peak_memory_mb(), tracker.nbytes() / 2**20, metrics
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming diversity metrics")
+    parser.add_argument("--records", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--batch-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    # ピークメモリを測るため、1回ずつ別プロセスで実行する
+    context = multiprocessing.get_context("spawn")
+    print(f"{'records':>9}{'method':>9}{'seconds':>9}{'records/s':>11}{'peak MB':>9}{'state MB':>10}  metrics")
+    for count in args.records:
+        for name, run in [("Counter", run_counter), ("tracker", run_tracker)]:
+            with context.Pool(1) as pool:
+                elapsed, peak, state, metrics = pool.apply(run, (count, args.batch_size))
+            print(f"{count:>9}{name:>9}{elapsed:>9.2f}{count / elapsed:>11.0f}{peak:>9.0f}{state:>10.1f}  {metrics}")
+
+if __name__ == "__main__":
+    main()
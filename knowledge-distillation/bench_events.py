@@ -0,0 +1,52 @@
+import argparse
+import os
+import random
+import re
+import time
+from knowledge_distillation import KnowledgeDistillation, StudentModel, TeacherModel, serve_stub
+
+# iter_events で大量のイベントを生成するときのスループットを測る (ローカルのモックサーバを使用)
+#
+# poetry run python bench_events.py --events 10000 --latency 0.5
+
+ACTIONS = ["に行く", "で友達に会う", "を食べる", "を読む", "の写真を撮る", "を掃除する", "を買う", "を調べる"]
+MODIFIERS = ["", "朝早く", "週末に", "一人で", "家族と", "雨の日に", "久しぶりに", "急いで", "夜遅く", "のんびり"]
+
+def respond(prompt: str) -> str:
+    # モデルの応答のように、既出のイベントや箇条書きでない行も混ざる
+    size = int(re.search(r"イベントを(\d+)個", prompt).group(1))
+    rng = random.Random(prompt)
+    lines = ["以下のとおりです。", ""]
+    for _ in range(size):
+        noun = "".join(chr(0x4E00 + rng.randrange(300)) for _ in range(2))
+        lines.append(f"- X が{rng.choice(MODIFIERS)}{noun}{rng.choice(ACTIONS)}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark large-scale event generation")
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock server latency per request (s)")
+    parser.add_argument("--events-per-request", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    with serve_stub(respond, delay=args.latency) as base_url:
+        print(f"{'concurrency':>11}{'seconds':>9}{'events':>8}{'events/s':>10}{'requests':>10}{'duplicates':>12}")
+        for concurrency in args.concurrency:
+            distillation = KnowledgeDistillation(
+                teacher=TeacherModel(base_url=base_url),
+                student=StudentModel(base_url=base_url),
+            )
+            start = time.perf_counter()
+            count = sum(1 for _ in distillation.iter_events(
+                args.events, events_per_request=args.events_per_request, concurrency=concurrency
+            ))
+            elapsed = time.perf_counter() - start
+            stats = distillation.event_stats
+            duplicates = stats["duplicates"] + stats["near_duplicates"]
+            print(f"{concurrency:>11}{elapsed:>9.2f}{count:>8}{count / elapsed:>10.1f}{stats['requests']:>10}"
+                  f"{duplicates:>12}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from knowledge_distillation import KnowledgeDistillation, StubClient, StudentModel, TeacherModel
+from knowledge_distillation.distillation import RELATIONS
+
+# 行形式と構造化出力 (JSON スキーマ + 足りない関係の聞き直し) で、推論生成の呼び出し回数と欠けた関係を比べる
+# (ローカルのスタブを使用。応答は一定の割合で形式から外れる)
+#
+# poetry run python bench_inference.py --events 1000 --deviation 0.05
+
+def make_responder(deviation: float):
+    def respond(prompt: str) -> str:
+        rng = random.Random(prompt)
+        if "JSON オブジェクト" in prompt:
+            # スキーマに対応しないバックエンドでは、関係が抜けることがある
+            relations = [line[2:].split(":", 1)[0] for line in prompt.split("\n") if line.startswith("- ")]
+            return json.dumps(
+                {relation: "推論の文" for relation in relations if rng.random() >= deviation}, ensure_ascii=False
+            )
+        # 行形式では、行が抜けたり、全角のコロンや強調で書かれたりすると読み落とす
+        lines = []
+        for relation in RELATIONS:
+            roll = rng.random()
+            if roll < deviation / 3:
+                continue
+            if roll < deviation * 2 / 3:
+                lines.append(f"- {relation}：推論の文")
+            elif roll < deviation:
+                lines.append(f"- **{relation}**: 推論の文")
+            else:
+                lines.append(f"- {relation}: 推論の文")
+        return "\n".join(lines)
+
+    return respond
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark free-text vs structured inference generation")
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--deviation", type=float, default=0.05, help="Probability that a relation deviates")
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub latency per request (s)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    events = [f"X がイベント{i}をする" for i in range(args.events)]
+    print(f"{'mode':>11}{'seconds':>9}{'calls/event':>13}{'reask_rate':>12}{'complete':>10}"
+          f"{'calls/complete':>16}{'tokens/event':>14}")
+    for structured in (False, True):
+        client = StubClient(make_responder(args.deviation), delay=args.latency)
+        distillation = KnowledgeDistillation(
+            teacher=TeacherModel(client=client), student=StudentModel(client=client), structured_output=structured
+        )
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(distillation.generate_inference, events))
+        elapsed = time.perf_counter() - start
+        report = distillation.inference_report()
+        complete = sum(all(relation in inferences for relation in RELATIONS) for inferences in results)
+        # 行形式で欠けたイベントを揃えるには、推論全体を生成し直す必要がある
+        calls_per_complete = report["teacher_calls"] / complete if complete else float("inf")
+        tokens = distillation.usage.summary()["total"]["total_tokens"] / len(events)
+        print(f"{'structured' if structured else 'text':>11}{elapsed:>9.2f}{report['calls_per_event']:>13.3f}"
+              f"{report['reask_rate']:>12.3f}{complete / len(events):>10.3f}{calls_per_complete:>16.3f}{tokens:>14.1f}")
+
+if __name__ == "__main__":
+    main()
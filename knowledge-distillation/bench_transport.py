@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import httpx
+from openai import OpenAI
+from knowledge_distillation import StudentModel, Transport, serve_stub
+
+# 接続プールを共有したときと、呼び出しごとにクライアントを作ったときのレイテンシを比べる (ローカルのモックサーバを使用)
+#
+# poetry run python bench_transport.py --requests 500
+
+def report(name: str, latencies: list[float], elapsed: float, stats: str = ""):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f"{name:>16}{p50:>9.2f}{p95:>9.2f}{len(latencies) / elapsed:>10.0f}  {stats}")
+
+def unpooled(base_url: str, requests: int):
+    # 以前の実装と同じく、モデルごとに OpenAI クライアントと httpx.Client を作る
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        begin = time.perf_counter()
+        http_client = httpx.Client(timeout=30.0)
+        client = OpenAI(api_key="stub", base_url=base_url, max_retries=0, http_client=http_client)
+        StudentModel(client=client).generate("ping")
+        http_client.close()
+        latencies.append(time.perf_counter() - begin)
+    report("unpooled", latencies, time.perf_counter() - start)
+
+def pooled(base_url: str, requests: int):
+    transport = Transport()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        begin = time.perf_counter()
+        StudentModel(base_url=base_url, transport=transport).generate("ping")
+        latencies.append(time.perf_counter() - begin)
+    report("pooled", latencies, time.perf_counter() - start, str(transport.stats()))
+    transport.close()
+
+async def pooled_async(base_url: str, requests: int, concurrency: int):
+    transport = Transport(max_keepalive_connections=concurrency)
+    client = transport.async_openai(base_url=base_url)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def call():
+        async with semaphore:
+            begin = time.perf_counter()
+            await client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "ping"}])
+            latencies.append(time.perf_counter() - begin)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(requests)))
+    report(f"pooled async x{concurrency}", latencies, time.perf_counter() - start, str(transport.stats()))
+    await transport.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs unpooled HTTP clients")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    with serve_stub(lambda prompt: "True") as base_url:
+        print(f"{'':>16}{'p50 ms':>9}{'p95 ms':>9}{'req/s':>10}")
+        unpooled(base_url, args.requests)
+        pooled(base_url, args.requests)
+        asyncio.run(pooled_async(base_url, args.requests, args.concurrency))
+
+if __name__ == "__main__":
+    main()
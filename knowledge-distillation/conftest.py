@@ -0,0 +1,37 @@
+import json
+import pytest
+from knowledge_distillation import KnowledgeDistillation, StubClient, StudentModel, TeacherModel
+
+# Teacher model の推論の応答 (xEvent の行は推論として数えない)
+INFERENCE = """- xEvent: X が本を読む
+- xEffect: 知識が増える
+- xWant: 続きを読みたい
+- xNeed: 本を手に入れる"""
+
+def _respond(prompt: str) -> str:
+    # 関係ごとに評価を変えて、集計の取り違えを検出できるようにする
+    if "JSON配列" in prompt:
+        blocks = [block for block in prompt.split("\n\n") if "推論:" in block]
+        return json.dumps(["関係: xWant" not in block for block in blocks])
+    if "関係: xWant" in prompt:
+        return "False"
+    if "関係:" in prompt:
+        return "True"
+    return INFERENCE
+
+@pytest.fixture
+def inference() -> str:
+    return INFERENCE
+
+@pytest.fixture
+def respond():
+    """Teacher model には INFERENCE を、Student model には xWant だけを不採用とする評価を返す (まとめた評価にも答える)"""
+    return _respond
+
+@pytest.fixture
+def make_distillation():
+    """Teacher model と Student model が同じ StubClient (省略時は respond で答える) を使う KnowledgeDistillation を作る"""
+    def make(client=None, **kwargs) -> KnowledgeDistillation:
+        client = client or StubClient(_respond)
+        return KnowledgeDistillation(teacher=TeacherModel(client=client), student=StudentModel(client=client), **kwargs)
+    return make
@@ -1,4 +1,34 @@
 from .distillation import KnowledgeDistillation
 from .models import TeacherModel, StudentModel
+from .backends import InProcessBackend, LocalEndpointBackend, OpenAIBackend
+from .cache import ResponseCache
+from .corpus import CorpusWriter
+from .diversity import DiversityTracker, MinHashLSH
+from .ratelimit import RateLimiter
+from .transport import Transport, default_transport
+from .usage import Budget, UsageTracker
+from .stub import StubClient, serve_stub
+from .batch import DistillationJob, LocalBatchBackend, OpenAIBatchBackend
 
-__all__ = ["KnowledgeDistillation", "TeacherModel", "StudentModel"]
+__all__ = [
+    "KnowledgeDistillation",
+    "TeacherModel",
+    "StudentModel",
+    "OpenAIBackend",
+    "LocalEndpointBackend",
+    "InProcessBackend",
+    "ResponseCache",
+    "CorpusWriter",
+    "DiversityTracker",
+    "MinHashLSH",
+    "RateLimiter",
+    "Transport",
+    "default_transport",
+    "Budget",
+    "UsageTracker",
+    "StubClient",
+    "serve_stub",
+    "DistillationJob",
+    "LocalBatchBackend",
+    "OpenAIBatchBackend",
+]
@@ -0,0 +1,139 @@
+from concurrent.futures import Future
+from typing import Callable, NamedTuple, Optional, Protocol
+import queue
+import threading
+import time
+from .transport import Transport, default_transport
+
+
+class Completion(NamedTuple):
+    text: str
+    # 使用量を返さないバックエンドでは None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+
+
+class Backend(Protocol):
+    """ChatModel が応答を得る先
+
+    model が None でなければ、ChatModel のモデル名 (リクエストとキャッシュのキー) をこれで置き換える。
+    response_format (JSON スキーマなど) に対応しないバックエンドは無視してよい (呼び出し側で応答を検証する)。
+    """
+
+    model: Optional[str]
+
+    def complete(self, model: str, prompt: str, response_format: Optional[dict] = None) -> Completion:
+        ...
+
+
+class OpenAIBackend:
+    """OpenAI 互換のクライアント (OpenAI, StubClient など) で応答を得る"""
+
+    model: Optional[str] = None
+
+    def __init__(self, client):
+        self.client = client
+
+    def complete(self, model: str, prompt: str, response_format: Optional[dict] = None) -> Completion:
+        kwargs = {} if response_format is None else {"response_format": response_format}
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            **kwargs,
+        )
+        text = response.choices[0].message.content or ""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return Completion(text)
+        return Completion(text, usage.prompt_tokens, usage.completion_tokens)
+
+
+class LocalEndpointBackend(OpenAIBackend):
+    """ローカルで動かす OpenAI 互換のサーバ (vLLM, llama.cpp, Ollama など)
+
+    サーバ側で複数のリクエストをまとめて処理するので、呼び出し側は並列に投げるだけでよい。
+    """
+
+    def __init__(
+        self,
+        base_url: str = "http://localhost:8000/v1",
+        model: Optional[str] = None,
+        transport: Optional[Transport] = None,
+        timeout: float = 60.0,
+    ):
+        client = (transport or default_transport()).openai(base_url=base_url, timeout=timeout, api_key="local")
+        super().__init__(client)
+        self.model = model
+
+
+class InProcessBackend:
+    """同じプロセス内のモデル (CPU で動く小さなモデルなど) で応答を得る
+
+    複数のスレッドから同時に呼ばれたリクエストを、max_batch_size 件または max_wait 秒まで待ってまとめ、
+    predict_batch (プロンプトのリストから応答のリストを返す関数) を1回だけ呼ぶ。
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[list[str]], list[str]],
+        model: Optional[str] = "in-process",
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+    ):
+        self.predict_batch = predict_batch
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = {"requests": 0, "batches": 0}
+        self._queue: queue.SimpleQueue[tuple[str, Future]] = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def complete(self, model: str, prompt: str, response_format: Optional[dict] = None) -> Completion:
+        future: Future = Future()
+        self._queue.put((prompt, future))
+        return Completion(future.result())
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            prompts = [prompt for prompt, _ in batch]
+            try:
+                outputs = self.predict_batch(prompts)
+                if len(outputs) != len(prompts):
+                    raise ValueError(f"predict_batch returned {len(outputs)} outputs for {len(prompts)} prompts")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+
+def huggingface_predictor(
+    model_name: str, max_new_tokens: int = 8, batch_size: int = 32
+) -> Callable[[list[str]], list[str]]:
+    """transformers の text-generation パイプラインを InProcessBackend の predict_batch にする (transformers が必要)"""
+    try:
+        from transformers import pipeline
+    except ImportError as e:
+        raise ImportError("huggingface_predictor requires transformers (pip install transformers torch)") from e
+    generator = pipeline("text-generation", model=model_name, device=-1)
+    if generator.tokenizer.pad_token_id is None:
+        generator.tokenizer.pad_token_id = generator.tokenizer.eos_token_id
+
+    def predict_batch(prompts: list[str]) -> list[str]:
+        messages = [[{"role": "user", "content": prompt}] for prompt in prompts]
+        outputs = generator(messages, max_new_tokens=max_new_tokens, batch_size=batch_size, do_sample=False)
+        return [output[0]["generated_text"][-1]["content"] for output in outputs]
+
+    return predict_batch
@@ -0,0 +1,422 @@
+from typing import Iterator, Optional, Protocol
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from .distillation import RELATIONS, filter_prompt, inference_prompt, parse_inference
+
+
+class BatchBackend(Protocol):
+    """リクエストを書いた JSONL ファイルをまとめて処理するバックエンド (OpenAI Batch API の形式)"""
+
+    def submit(self, requests_path: str, name: str) -> str:
+        ...
+
+    def find(self, name: str, since: float) -> Optional[str]:
+        """since 以降に name で投入したバッチの ID (再開時に同じバッチを二重に投入しないため)"""
+        ...
+
+    def status(self, batch_id: str) -> str:
+        """"completed" / "failed" / それ以外 (処理中) を返す"""
+        ...
+
+    def download(self, batch_id: str, output_path: str, error_path: str) -> None:
+        """成功した応答を output_path に、失敗したリクエストを error_path に書く (どちらも同じ JSONL の形式)"""
+        ...
+
+    def cleanup(self, batch_id: str) -> None:
+        """ダウンロードした結果を state.json に記録した後に呼ぶ。バッチの結果を消してよい"""
+        ...
+
+
+class OpenAIBatchBackend:
+    def __init__(self, client=None):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = client
+
+    def submit(self, requests_path: str, name: str) -> str:
+        with open(requests_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"name": name},
+        )
+        return batch.id
+
+    def find(self, name: str, since: float) -> Optional[str]:
+        # 一覧は新しい順に返るので、since より前に作られたバッチまで来たら打ち切る
+        for batch in self.client.batches.list(limit=100):
+            if batch.created_at < since - 60:
+                break
+            if (batch.metadata or {}).get("name") == name:
+                return batch.id
+        return None
+
+    def status(self, batch_id: str) -> str:
+        status = self.client.batches.retrieve(batch_id).status
+        if status in ("failed", "expired", "cancelled"):
+            return "failed"
+        return status
+
+    def download(self, batch_id: str, output_path: str, error_path: str) -> None:
+        batch = self.client.batches.retrieve(batch_id)
+        # 期限切れや取り消しのバッチにも、処理済みの分の結果がある
+        for file_id, path in ((batch.output_file_id, output_path), (batch.error_file_id, error_path)):
+            if file_id:
+                self.client.files.content(file_id).write_to_file(path)
+            else:
+                open(path, "w").close()
+
+    def cleanup(self, batch_id: str) -> None:
+        # 結果のファイルは OpenAI 側で保持期間が過ぎると消える
+        pass
+
+
+class LocalBatchBackend:
+    """OpenAI Batch API のファイルベースの代用品 (テストやローカル実行用)
+
+    OpenAI 互換のクライアント (StubClient など) で1件ずつ処理し、結果を同じ形式の JSONL に書く。
+    例外になったリクエストは Batch API のエラーファイルと同じ形式で別のファイルに書く。
+    """
+
+    def __init__(self, client, work_dir: str):
+        self.client = client
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+    def submit(self, requests_path: str, name: str) -> str:
+        batch_id = f"local-{name}"
+        output_path = os.path.join(self.work_dir, f"{batch_id}.jsonl")
+        error_path = os.path.join(self.work_dir, f"{batch_id}.errors.jsonl")
+        with open(requests_path) as requests, open(output_path + ".tmp", "w") as output, \
+                open(error_path + ".tmp", "w") as errors:
+            for line in requests:
+                request = json.loads(line)
+                try:
+                    response = self.client.chat.completions.create(**request["body"])
+                except Exception as e:
+                    record = {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+                    errors.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    continue
+                body = {
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": response.choices[0].message.content}}
+                    ]
+                }
+                record = {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}}
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(error_path + ".tmp", error_path)
+        os.replace(output_path + ".tmp", output_path)
+        return batch_id
+
+    def find(self, name: str, since: float) -> Optional[str]:
+        batch_id = f"local-{name}"
+        return batch_id if os.path.exists(os.path.join(self.work_dir, f"{batch_id}.jsonl")) else None
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if os.path.exists(os.path.join(self.work_dir, f"{batch_id}.jsonl")) else "failed"
+
+    def download(self, batch_id: str, output_path: str, error_path: str) -> None:
+        for source, path in ((f"{batch_id}.jsonl", output_path), (f"{batch_id}.errors.jsonl", error_path)):
+            source = os.path.join(self.work_dir, source)
+            # 取り込んだと記録する前に落ちたら読み直せるよう、ここでは消さない
+            if os.path.exists(source):
+                shutil.copyfile(source, path)
+            else:
+                open(path, "w").close()
+
+    def cleanup(self, batch_id: str) -> None:
+        for source in (f"{batch_id}.jsonl", f"{batch_id}.errors.jsonl"):
+            source = os.path.join(self.work_dir, source)
+            if os.path.exists(source):
+                os.remove(source)
+
+
+def _request(custom_id: str, model: str, prompt: str) -> str:
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": [{"role": "user", "content": prompt}]},
+        },
+        ensure_ascii=False,
+    ) + "\n"
+
+
+def _read_outputs(path: str) -> Iterator[tuple[str, str]]:
+    """Batch API の結果ファイルから (custom_id, 応答本文) を1行ずつ読む。失敗した行は飛ばす"""
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            yield record["custom_id"], response["body"]["choices"][0]["message"]["content"] or ""
+
+
+class DistillationJob:
+    """Teacher model の推論生成と Student model の評価を、2段階のバッチジョブとして実行する
+
+    各段階の完了を job_dir/state.json に記録するので、途中で落ちても run() を再実行すれば続きから再開する。
+    結果は job_dir/accepted.jsonl に (event, relation, inference) を1行ずつ書く。
+
+    リクエストは Batch API の上限 (1バッチ 50,000 件・200 MB) に収まるようにシャードに分けて投入する。
+    バッチは投入の前にジョブ内で一意な名前を記録し、投入の途中で落ちたときは再開時にその名前で探して二重に投入しない。
+    失敗したリクエスト (エラーファイルの行と、結果に含まれないもの) は max_retries 回まで送り直し、
+    それでも失敗したものは job_dir/<teacher|student>_failed_requests.jsonl に残す。
+    """
+
+    STAGES = [
+        "init",
+        "teacher_prepared",
+        "teacher_submitted",
+        "teacher_done",
+        "student_prepared",
+        "student_submitted",
+        "student_done",
+        "completed",
+    ]
+
+    def __init__(
+        self,
+        job_dir: str,
+        backend: BatchBackend,
+        teacher_model: str = "o3-mini",
+        student_model: str = "gpt-4o-mini",
+        poll_interval: float = 30.0,
+        max_requests_per_batch: int = 50_000,
+        max_bytes_per_batch: int = 200_000_000,
+        max_retries: int = 2,
+    ):
+        self.job_dir = job_dir
+        self.backend = backend
+        self.teacher_model = teacher_model
+        self.student_model = student_model
+        self.poll_interval = poll_interval
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_bytes_per_batch = max_bytes_per_batch
+        self.max_retries = max_retries
+        os.makedirs(job_dir, exist_ok=True)
+        self.state = self._load_state()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.job_dir, name)
+
+    def run(self, events: Optional[list[str]] = None) -> str:
+        if self.state["stage"] == "init":
+            if events is None:
+                raise ValueError("events are required to start a new job")
+            self._prepare_teacher(events)
+        while self.state["stage"] != "completed":
+            stage = self.state["stage"]
+            print(f"Batch job stage: {stage}")
+            if stage == "teacher_prepared":
+                self._submit("teacher")
+            elif stage == "teacher_submitted":
+                self._wait("teacher", self.path("teacher_outputs.jsonl"), "teacher_done")
+            elif stage == "teacher_done":
+                self._prepare_student()
+            elif stage == "student_prepared":
+                self._submit("student")
+            elif stage == "student_submitted":
+                self._wait("student", self.path("student_outputs.jsonl"), "student_done")
+            elif stage == "student_done":
+                self._write_accepted()
+            elif stage not in self.STAGES:
+                raise ValueError(f"Unknown batch job stage: {stage}")
+        return self.path("accepted.jsonl")
+
+    def _db(self) -> sqlite3.Connection:
+        # イベントと推論は SQLite に置き、応答と突き合わせるときにメモリに全件を載せない
+        return sqlite3.connect(self.path("job.sqlite3"))
+
+    def _prepare_teacher(self, events: list[str]):
+        db = self._db()
+        db.execute("DROP TABLE IF EXISTS events")
+        db.execute("CREATE TABLE events (custom_id TEXT PRIMARY KEY, event TEXT)")
+        with open(self.path("teacher_requests.jsonl.tmp"), "w") as requests:
+            for i, event in enumerate(events):
+                custom_id = f"event-{i}"
+                db.execute("INSERT INTO events VALUES (?, ?)", (custom_id, event))
+                requests.write(_request(custom_id, self.teacher_model, inference_prompt(event)))
+        db.commit()
+        db.close()
+        os.replace(self.path("teacher_requests.jsonl.tmp"), self.path("teacher_requests.jsonl"))
+        self._save_state(stage="teacher_prepared", events=len(events), job_id=uuid.uuid4().hex[:12])
+
+    def _requests_path(self, name: str, attempt: int) -> str:
+        if attempt == 0:
+            return self.path(f"{name}_requests.jsonl")
+        return self.path(f"{name}_requests.retry{attempt}.jsonl")
+
+    @staticmethod
+    def _sibling(requests_path: str, kind: str) -> str:
+        """シャードのリクエストのファイルに対応する結果 (outputs) やエラー (errors) のファイル"""
+        directory, filename = os.path.split(requests_path)
+        return os.path.join(directory, filename.replace("_requests", f"_{kind}", 1))
+
+    def _shard(self, requests_path: str) -> list[str]:
+        """リクエストのファイルを Batch API の上限に収まるシャードに分ける"""
+        paths: list[str] = []
+        shard = None
+        count = size = 0
+        with open(requests_path, "rb") as requests:
+            for line in requests:
+                full = count >= self.max_requests_per_batch or size + len(line) > self.max_bytes_per_batch
+                if shard is None or full:
+                    if shard is not None:
+                        shard.close()
+                    paths.append(f"{requests_path[:-len('.jsonl')]}.{len(paths):05d}.jsonl")
+                    shard = open(paths[-1], "wb")
+                    count = size = 0
+                shard.write(line)
+                count += 1
+                size += len(line)
+        if shard is not None:
+            shard.close()
+        return paths
+
+    def _submit(self, name: str):
+        attempt = self.state.get(f"{name}_attempt", 0)
+        batches = self.state.get(f"{name}_batches", [])
+        if not any(batch["attempt"] == attempt for batch in batches):
+            for i, path in enumerate(self._shard(self._requests_path(name, attempt))):
+                batch_name = f"{self.state['job_id']}-{name}-{attempt}-{i}"
+                batches.append({"attempt": attempt, "requests": path, "name": batch_name, "batch_id": None})
+            self._save_state(**{f"{name}_batches": batches})
+        for batch in batches:
+            if batch["batch_id"] is not None:
+                continue
+            if "submitted_at" in batch:
+                # 前回は投入の途中で落ちた。投入済みならそのバッチを使い、二重に払わない
+                batch["batch_id"] = self.backend.find(batch["name"], batch["submitted_at"])
+            if batch["batch_id"] is None:
+                batch["submitted_at"] = time.time()
+                self._save_state(**{f"{name}_batches": batches})
+                batch["batch_id"] = self.backend.submit(batch["requests"], batch["name"])
+            self._save_state(**{f"{name}_batches": batches})
+        self._save_state(stage=f"{name}_submitted")
+
+    def _wait(self, name: str, output_path: str, next_stage: str):
+        attempt = self.state.get(f"{name}_attempt", 0)
+        batches = self.state.get(f"{name}_batches", [])
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS succeeded (stage TEXT, custom_id TEXT, PRIMARY KEY (stage, custom_id))")
+        for batch in batches:
+            if batch.get("downloaded"):
+                continue
+            batch_id = batch["batch_id"]
+            while True:
+                status = self.backend.status(batch_id)
+                if status in ("completed", "failed"):
+                    break
+                time.sleep(self.poll_interval)
+            if status == "failed":
+                print(f"{name} batch {batch_id} failed, its unfinished requests will be retried")
+            outputs = self._sibling(batch["requests"], "outputs")
+            errors = self._sibling(batch["requests"], "errors")
+            self.backend.download(batch_id, outputs + ".tmp", errors + ".tmp")
+            os.replace(errors + ".tmp", errors)
+            os.replace(outputs + ".tmp", outputs)
+            for custom_id, _ in _read_outputs(outputs):
+                db.execute("INSERT OR IGNORE INTO succeeded VALUES (?, ?)", (name, custom_id))
+            db.commit()
+            batch["downloaded"] = True
+            self._save_state(**{f"{name}_batches": batches})
+            self.backend.cleanup(batch_id)
+
+        # エラーになったリクエストと結果に含まれないリクエストを集め、回数が残っていれば送り直す
+        failed = 0
+        retry_path = self._requests_path(name, attempt + 1)
+        with open(self._requests_path(name, attempt)) as requests, open(retry_path + ".tmp", "w") as retry:
+            for line in requests:
+                custom_id = json.loads(line)["custom_id"]
+                if db.execute(
+                    "SELECT 1 FROM succeeded WHERE stage = ? AND custom_id = ?", (name, custom_id)
+                ).fetchone() is None:
+                    failed += 1
+                    retry.write(line)
+        db.close()
+        if failed and attempt < self.max_retries:
+            print(f"Retrying {failed} failed {name} requests")
+            os.replace(retry_path + ".tmp", retry_path)
+            self._save_state(stage=f"{name}_prepared", **{f"{name}_attempt": attempt + 1})
+            return
+        os.replace(retry_path + ".tmp", self.path(f"{name}_failed_requests.jsonl"))
+
+        with open(output_path + ".tmp", "w") as output:
+            for batch in batches:
+                with open(self._sibling(batch["requests"], "outputs")) as f:
+                    for line in f:
+                        output.write(line)
+        os.replace(output_path + ".tmp", output_path)
+        self._save_state(stage=next_stage, **{f"{name}_failed": failed})
+
+    def _prepare_student(self):
+        db = self._db()
+        db.execute("DROP TABLE IF EXISTS items")
+        db.execute("CREATE TABLE items (custom_id TEXT PRIMARY KEY, event TEXT, relation TEXT, inference TEXT)")
+        parsed = 0
+        with open(self.path("student_requests.jsonl.tmp"), "w") as requests:
+            for custom_id, content in _read_outputs(self.path("teacher_outputs.jsonl")):
+                row = db.execute("SELECT event FROM events WHERE custom_id = ?", (custom_id,)).fetchone()
+                if row is None:
+                    continue
+                event = row[0]
+                inferences = parse_inference(content)
+                parsed += 1
+                for relation in RELATIONS:
+                    if relation not in inferences:
+                        continue
+                    item_id = f"{custom_id}-{relation}"
+                    db.execute(
+                        "INSERT INTO items VALUES (?, ?, ?, ?)", (item_id, event, relation, inferences[relation])
+                    )
+                    requests.write(
+                        _request(item_id, self.student_model, filter_prompt(event, relation, inferences[relation]))
+                    )
+        db.commit()
+        db.close()
+        os.replace(self.path("student_requests.jsonl.tmp"), self.path("student_requests.jsonl"))
+        self._save_state(stage="student_prepared", teacher_outputs=parsed)
+
+    def _write_accepted(self):
+        db = self._db()
+        evaluated = accepted = 0
+        with open(self.path("accepted.jsonl.tmp"), "w") as output:
+            for custom_id, content in _read_outputs(self.path("student_outputs.jsonl")):
+                evaluated += 1
+                if content.strip().lower() != "true":
+                    continue
+                row = db.execute(
+                    "SELECT event, relation, inference FROM items WHERE custom_id = ?", (custom_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                event, relation, inference = row
+                accepted += 1
+                record = {"event": event, "relation": relation, "inference": inference}
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        db.close()
+        os.replace(self.path("accepted.jsonl.tmp"), self.path("accepted.jsonl"))
+        self._save_state(stage="completed", evaluated=evaluated, accepted=accepted)
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.path("state.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"stage": "init"}
+
+    def _save_state(self, **updates):
+        self.state = {**self.state, **updates}
+        with open(self.path("state.json.tmp"), "w") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(self.path("state.json.tmp"), self.path("state.json"))
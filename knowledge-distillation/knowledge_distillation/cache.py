@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+
+class ResponseCache:
+    """モデル名・プロンプト・パラメータをキーにした応答キャッシュ (SQLite)
+
+    同じプロンプトが同時に要求された場合は1回だけAPIを呼び、他の呼び出しはその結果を待つ。
+    """
+
+    def __init__(
+        self,
+        path: str = ".cache/responses.sqlite3",
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = 100_000,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.ttl = ttl  # 秒。None なら期限なし
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: Optional[dict] = None) -> str:
+        payload = json.dumps([model, prompt, params or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._set(key, value)
+
+    def get_or_compute(self, model: str, prompt: str, params: Optional[dict], compute: Callable[[], str]) -> str:
+        key = self.make_key(model, prompt, params)
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.deduplicated += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+            # 空の応答 (エラー時を含む) はキャッシュしない
+            if value:
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        now = time.time()
+        if self.ttl is not None and now - created_at > self.ttl:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        return value
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        if self.max_entries is not None:
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                # 上限を超えたら最後に使われた時刻が古いものから1割多めに消し、削除の頻度を下げる
+                excess = count - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                    (excess,),
+                )
+                self.evictions += excess
+        self._conn.commit()
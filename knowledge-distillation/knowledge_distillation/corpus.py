@@ -0,0 +1,96 @@
+from typing import Dict, Iterator, Optional
+import json
+import os
+import sqlite3
+import time
+
+
+class CorpusWriter:
+    """(event, relation, inference, valid) を1行ずつ追記する JSONL 書き出し
+
+    イベント単位で書き込み、完了したイベントとファイル上の位置をチェックポイント (path + ".index.sqlite3") に記録する。
+    チェックポイントは fsync の後にだけ更新するので、再起動時は記録済みの位置までファイルを切り詰めて続きから書く。
+    """
+
+    def __init__(self, path: str = "corpus/triples.jsonl", fsync_every: int = 100, fsync_interval: float = 5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._index = sqlite3.connect(path + ".index.sqlite3")
+        self._index.execute("CREATE TABLE IF NOT EXISTS events (event TEXT PRIMARY KEY, start INTEGER, end INTEGER)")
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        size = os.path.getsize(path)
+        committed = self._index.execute("SELECT COALESCE(MAX(end), 0) FROM events").fetchone()[0]
+        if committed > size:
+            # ファイルが消された・切り詰められたときは、ファイルに残っているイベントだけを完了として扱う
+            print(f"{path} is shorter than its checkpoint ({size} < {committed} bytes), resuming from {size} bytes")
+            self._index.execute("DELETE FROM events WHERE end > ?", (size,))
+            self._index.commit()
+            committed = self._index.execute("SELECT COALESCE(MAX(end), 0) FROM events").fetchone()[0]
+        # チェックポイントより後ろは fsync 前に落ちた書きかけの行なので捨てる
+        self._file = open(path, "r+b")
+        self._file.truncate(committed)
+        self._file.seek(committed)
+        self._pending: list[tuple[str, int, int]] = []
+        self._last_sync = time.monotonic()
+        self.stats = {"events": 0, "records": 0, "resumed_events": 0}
+
+    def is_done(self, event: str) -> bool:
+        if any(pending[0] == event for pending in self._pending):
+            return True
+        return self._index.execute("SELECT 1 FROM events WHERE event = ?", (event,)).fetchone() is not None
+
+    def write_event(self, event: str, inferences: Dict[str, str], validity: Dict[str, bool]):
+        start = self._file.tell()
+        for relation, inference in inferences.items():
+            if relation not in validity:
+                continue
+            record = {"event": event, "relation": relation, "inference": inference, "valid": validity[relation]}
+            self._file.write((json.dumps(record, ensure_ascii=False) + "\n").encode())
+            self.stats["records"] += 1
+        self._pending.append((event, start, self._file.tell()))
+        self.stats["events"] += 1
+        if len(self._pending) >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def read_event(self, event: str) -> Iterator[dict]:
+        """記録済みのイベントの行を読み直す (再開時の集計用)"""
+        if any(pending[0] == event for pending in self._pending):
+            # is_done は索引に書く前のイベントも記録済みとするので、先に索引に書く
+            self.sync()
+        row = self._index.execute("SELECT start, end FROM events WHERE event = ?", (event,)).fetchone()
+        if row is None:
+            return
+        start, end = row
+        self.stats["resumed_events"] += 1
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            for line in f.read(end - start).splitlines():
+                yield json.loads(line)
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._pending:
+            self._index.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?)", self._pending)
+            self._index.commit()
+            self._pending.clear()
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self) -> "CorpusWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> Optional[bool]:
+        self.close()
+        return None
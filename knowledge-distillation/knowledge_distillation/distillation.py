@@ -1,29 +1,74 @@
-from typing import List, Dict, Tuple
-from collections import Counter
+from typing import Callable, List, Dict, Iterable, Iterator, Tuple, Optional
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from .cache import ResponseCache
+from .corpus import CorpusWriter
+from .diversity import DiversityTracker, MinHashLSH
 from .models import TeacherModel, StudentModel
+from .usage import UsageTracker, usage_scope
 
-class KnowledgeDistillation:
-    def __init__(self):
-        self.teacher = TeacherModel()
-        self.student = StudentModel()
-        
-    def generate_events(self, num_events: int = 10) -> List[str]:
-        prompt = f"""以下の形式で、人間が関与するイベントを{num_events}個生成してください。
+_DONE = object()
+
+RELATIONS = ["xEffect", "xWant", "xNeed", "xIntent", "xReact", "HinderedBy"]
+
+FILTER_CRITERIA = """### チェック基準:
+1. 論理的一貫性 - イベントと関係に対して適切な推論か
+2. 常識的な妥当性 - 現実世界の知識と矛盾しないか
+3. 情報の具体性 - 推論が単純すぎず、具体的な知識を含んでいるか
+4. 不要な曖昧さがないか
+5. 誤解を招く表現がないか"""
+
+# イベントを複数回に分けて生成するときに、リクエストごとに変える題材
+EVENT_THEMES = [
+    "家事", "仕事", "学校", "趣味", "人間関係", "買い物", "移動", "健康", "食事", "旅行",
+    "お金", "スポーツ", "季節の行事", "住まい", "ペット", "子育て", "インターネット", "天気",
+]
+
+def events_prompt(num_events: int, theme: Optional[str] = None) -> str:
+    theme_rule = f"\n- 「{theme}」に関係する出来事を考えること" if theme else ""
+    return f"""以下の形式で、人間が関与するイベントを{num_events}個生成してください。
 
 ### ルール
 - 各イベントは短い日本語の文にすること (7～15文字程度)
 - 主語は "X" にする (例: X が本を読む)
 - 日常的にありふれた出来事を考えること
-- 可能な限りバリエーションを持たせること
+- 可能な限りバリエーションを持たせること{theme_rule}
 
 ### 出力
 Markdownの-を使った順序なしリスト形式で出力してください。
 """
-        return self.teacher.generate(prompt).split("\n")
-        
-    def generate_inference(self, event: str) -> dict[str, str]:
-        print(f"\nGenerating inference for event: {event}")
-        prompt = f"""以下のイベントについて、因果関係を持つ推論を生成してください。
+
+def normalize_event(line: str) -> Optional[str]:
+    """生成されたリストの1行からイベントを取り出す。イベントでない行は None"""
+    text = unicodedata.normalize("NFKC", line).strip()
+    # 箇条書きの記号や番号を取り除く
+    text = re.sub(r"^(?:[-*・•]|\d+[.)、])\s*", "", text).strip().strip("\"'「」`")
+    text = re.sub(r"\s+", " ", text)
+    if not text or text.startswith("#") or "X" not in text:
+        return None
+    return text
+
+# 関係ごとの説明 (推論のプロンプトに並べる)
+RELATION_DESCRIPTIONS = {
+    "xEffect": "X の行動の結果",
+    "xWant": "X の行動後に X が望むこと",
+    "xNeed": "X の行動をするために必要なこと",
+    "xIntent": "X の行動の意図",
+    "xReact": "X の行動の後の感情反応",
+    "HinderedBy": "X の行動が妨げられる要因",
+}
+
+def _relation_descriptions(relations: List[str]) -> str:
+    return "\n".join(f"- {relation}: {RELATION_DESCRIPTIONS[relation]}" for relation in relations)
+
+def inference_prompt(event: str) -> str:
+    return f"""以下のイベントについて、因果関係を持つ推論を生成してください。
 
 ### ルール
 - 各関係に対応する推論を作成してください
@@ -31,12 +76,7 @@ Markdownの-を使った順序なしリスト形式で出力してください
 - 可能な限り現実的な推論を生成してください
 
 ### 関係の説明
-- xEffect: X の行動の結果
-- xWant: X の行動後に X が望むこと
-- xNeed: X の行動をするために必要なこと
-- xIntent: X の行動の意図
-- xReact: X の行動の後の感情反応
-- HinderedBy: X の行動が妨げられる要因
+{_relation_descriptions(RELATIONS)}
 
 ### 出力フォーマット
 - xEvent: {event}
@@ -49,42 +89,363 @@ Markdownの-を使った順序なしリスト形式で出力してください
 
 出力フォーマットには厳密に従ってください。出力フォーマットにない余計な出力は絶対に含めないようにしてください。
 """
+
+def parse_inference(response: str) -> Dict[str, str]:
+    relations = {}
+    for line in response.split("\n"):
+        if ":" in line:
+            key, value = line.split(":", 1)
+            key = key.strip("- ")
+            relations[key] = value.strip()
+    return relations
+
+def structured_inference_prompt(event: str, relations: List[str] = RELATIONS, attempt: int = 0) -> str:
+    """relations の推論を JSON で答えさせるプロンプト。attempt > 0 は足りなかった関係だけを聞き直すとき"""
+    # 聞き直しは回数ごとにプロンプトを変え、キャッシュされた前回の応答が返らないようにする
+    reask = ""
+    if attempt:
+        reask = f"\n前回の回答に含まれていなかった関係です。今回はこれらを必ず答えてください (再質問{attempt}回目)。\n"
+    return f"""以下のイベントについて、因果関係を持つ推論を生成してください。
+{reask}
+### ルール
+- 各関係に対応する推論を作成してください
+- 出力はシンプルで自然な日本語の文章にしてください (10～20文字程度)
+- 可能な限り現実的な推論を生成してください
+
+### 関係の説明
+{_relation_descriptions(relations)}
+
+### イベント
+{event}
+
+### 出力
+キーが {", ".join(relations)} で、値が推論の文字列の JSON オブジェクトのみを出力してください。
+"""
+
+def inference_response_format(relations: List[str] = RELATIONS) -> dict:
+    """relations をすべて文字列で持つ JSON オブジェクトに応答を制約する response_format (Structured Outputs)"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "inference",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {relation: {"type": "string"} for relation in relations},
+                "required": list(relations),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def parse_structured_inference(response: str, relations: List[str] = RELATIONS) -> Dict[str, str]:
+    """JSON の応答から relations の推論を取り出す。値が空や文字列でない関係は含めない
+
+    応答の前後に説明やコードブロックが付いていても、最初の { から最後の } までを読む。
+    JSON として読めない応答 (スキーマに対応しないバックエンドなど) は従来の行形式として読む。
+    """
+    start, end = response.find("{"), response.rfind("}")
+    values = None
+    if start != -1 and end > start:
+        try:
+            values = json.loads(response[start:end + 1])
+        except json.JSONDecodeError:
+            pass
+    if not isinstance(values, dict):
+        values = parse_inference(response)
+    inferences = {}
+    for relation in relations:
+        value = values.get(relation)
+        if isinstance(value, str) and value.strip():
+            inferences[relation] = value.strip()
+    return inferences
+
+def filter_prompt(event: str, relation: str, inference: str) -> str:
+    return f"""以下のイベントと推論が適切かどうかを評価してください。
+
+{FILTER_CRITERIA}
+
+イベント: {event}
+関係: {relation}
+推論: {inference}
+
+回答は "True" または "False" のみで答えてください。
+"""
+
+def parse_validity_array(response: str, size: int) -> List[Optional[bool]]:
+    """バッチ評価の応答から各項目の True/False を取り出す。読み取れなかった項目は None"""
+    def to_bool(value) -> Optional[bool]:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+        if isinstance(value, dict):
+            return to_bool(value.get("valid"))
+        return None
+
+    results: List[Optional[bool]] = [None] * size
+    start, end = response.find("["), response.rfind("]")
+    if start != -1 and end > start:
+        try:
+            values = json.loads(response[start:end + 1])
+        except json.JSONDecodeError:
+            # 一部の要素だけが壊れた配列は要素ごとに読む
+            values = [token.strip().strip("\"'") for token in response[start + 1:end].split(",")]
+        if isinstance(values, list):
+            for i, value in enumerate(values[:size]):
+                results[i] = to_bool(value)
+            return results
+    # JSON でない場合は "1: True" のような番号付きの行として読む
+    for match in re.finditer(r"^\W*(\d+)\W+(true|false)\b", response, re.IGNORECASE | re.MULTILINE):
+        index = int(match.group(1)) - 1
+        if 0 <= index < size:
+            results[index] = match.group(2).lower() == "true"
+    return results
+
+class KnowledgeDistillation:
+    def __init__(
+        self,
+        teacher: Optional[TeacherModel] = None,
+        student: Optional[StudentModel] = None,
+        cache: Optional[ResponseCache] = None,
+        drop_near_duplicates: bool = False,
+        usage: Optional[UsageTracker] = None,
+        structured_output: bool = False,
+        max_reasks: int = 1,
+    ):
+        """structured_output のときは推論を JSON スキーマで生成させ、足りない関係だけを max_reasks 回まで聞き直す"""
+        self.teacher = teacher or TeacherModel(cache=cache)
+        self.student = student or StudentModel(cache=cache)
+        # 使用量は Teacher model と Student model で1つに集計する
+        self.usage = usage or self.teacher.usage or self.student.usage or UsageTracker()
+        for model in (self.teacher, self.student):
+            if model.usage is None:
+                model.usage = self.usage
+        self.run_stats = {"events": 0, "resumed_events": 0, "stopped_by": None}
+        self._admitted = {"event": 0, "filter": 0}
+        self.filter_stats = {"items": 0, "calls": 0, "fallback_calls": 0, "seconds": 0.0, "near_duplicates": 0}
+        self._stats_lock = threading.Lock()
+        # drop_near_duplicates のときは、既に評価した推論の近似重複を Student model に送らずに不採用にする
+        self._seen = {relation: MinHashLSH() for relation in RELATIONS} if drop_near_duplicates else None
+        self._seen_lock = threading.Lock()
+        self.event_stats = {"requests": 0, "accepted": 0, "duplicates": 0, "near_duplicates": 0, "invalid": 0}
+        self.structured_output = structured_output
+        self.max_reasks = max_reasks
+        self.inference_stats = {"events": 0, "calls": 0, "reasked_events": 0, "reasks": 0, "missing": 0}
+        
+    def generate_events(self, num_events: int = 10, **kwargs) -> List[str]:
+        return list(self.iter_events(num_events, **kwargs))
+
+    def iter_events(
+        self,
+        num_events: int,
+        events_per_request: int = 50,
+        concurrency: int = 4,
+        max_requests: Optional[int] = None,
+    ) -> Iterator[str]:
+        """重複のないイベントを num_events 個になるまで生成し、採用したものから順に返す
+
+        Teacher model へのリクエストを並列に出し、応答ごとに正規化して完全一致と近似重複 (MinHash LSH) を取り除く。
+        足りなければ題材を変えてリクエストを追加する。応答は処理したら捨て、保持するのはハッシュと LSH の索引だけ。
+        max_requests (既定は必要な回数の5倍) に達したら、num_events 個に満たなくても終了する。
+        """
+        if num_events <= 0:
+            return
+        per_request = min(events_per_request, num_events)
+        if max_requests is None:
+            max_requests = 5 * -(-num_events // per_request)
+        seen = set()
+        lsh = MinHashLSH()
+        accepted = submitted = 0
+        executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        pending = set()
+        try:
+            while accepted < num_events:
+                # 残りの数を満たすのに必要な分だけリクエストを出す
+                while (
+                    len(pending) < concurrency
+                    and submitted < max_requests
+                    and len(pending) * per_request < num_events - accepted
+                ):
+                    # リクエストごとにプロンプトを変え、キャッシュで同じ応答が返らないようにする
+                    # (最初のリクエストは題材なし、2つ目から EVENT_THEMES を先頭から順に使う)
+                    theme = None
+                    if submitted:
+                        rounds, index = divmod(submitted - 1, len(EVENT_THEMES))
+                        theme = EVENT_THEMES[index] if rounds == 0 else f"{EVENT_THEMES[index]} ({rounds + 1}回目)"
+                    pending.add(executor.submit(self._generate_events_response, events_prompt(per_request, theme)))
+                    submitted += 1
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    candidates = []
+                    for line in future.result().split("\n"):
+                        event = normalize_event(line)
+                        if event is None:
+                            self.event_stats["invalid"] += 1
+                            continue
+                        key = hashlib.blake2b(event.encode(), digest_size=8).digest()
+                        if key in seen:
+                            self.event_stats["duplicates"] += 1
+                            continue
+                        seen.add(key)
+                        candidates.append(event)
+                    self.event_stats["requests"] += 1
+                    representatives = lsh.add(candidates)
+                    first_id = lsh.records - len(candidates)
+                    for offset, (event, representative) in enumerate(zip(candidates, representatives)):
+                        if representative != first_id + offset:
+                            self.event_stats["near_duplicates"] += 1
+                            continue
+                        if accepted < num_events:
+                            accepted += 1
+                            self.event_stats["accepted"] += 1
+                            yield event
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+    def _generate_events_response(self, prompt: str) -> str:
+        with usage_scope("events"):
+            return self.teacher.generate(prompt)
+
+    def generate_inference(self, event: str) -> dict[str, str]:
+        print(f"\nGenerating inference for event: {event}")
+        if self.structured_output:
+            return self._generate_structured_inference(event)
+        prompt = inference_prompt(event)
         print("Sending request to teacher model...")
-        response = self.teacher.generate(prompt)
+        with usage_scope("inference", RELATIONS):
+            response = self.teacher.generate(prompt)
         print(f"Teacher model response:\n{response}")
-        relations = {}
-        for line in response.split("\n"):
-            if ":" in line:
-                key, value = line.split(":", 1)
-                key = key.strip("- ")
-                relations[key] = value.strip()
-        return relations
-
-    def evaluate_inferences(self, events: List[str], num_samples: int = 5) -> Dict[str, Dict[str, float]]:
+        inferences = parse_inference(response)
+        self._count_inference(1, sum(relation not in inferences for relation in RELATIONS))
+        return inferences
+
+    def _generate_structured_inference(self, event: str) -> Dict[str, str]:
+        """JSON スキーマで推論を生成し、応答に足りなかった関係だけを聞き直す (推論全体は生成し直さない)"""
+        inferences: Dict[str, str] = {}
+        missing = RELATIONS
+        calls = 0
+        for attempt in range(self.max_reasks + 1):
+            if attempt:
+                print(f"Re-asking teacher model for missing relations: {', '.join(missing)}")
+            else:
+                print("Sending request to teacher model...")
+            with usage_scope("inference", missing):
+                response = self.teacher.generate(
+                    structured_inference_prompt(event, missing, attempt),
+                    response_format=inference_response_format(missing),
+                )
+            calls += 1
+            print(f"Teacher model response:\n{response}")
+            inferences.update(parse_structured_inference(response, missing))
+            missing = [relation for relation in RELATIONS if relation not in inferences]
+            if not missing:
+                break
+        self._count_inference(calls, len(missing))
+        return {relation: inferences[relation] for relation in RELATIONS if relation in inferences}
+
+    def _count_inference(self, calls: int, missing: int):
+        with self._stats_lock:
+            self.inference_stats["events"] += 1
+            self.inference_stats["calls"] += calls
+            self.inference_stats["reasks"] += calls - 1
+            self.inference_stats["reasked_events"] += calls > 1
+            self.inference_stats["missing"] += missing
+
+    def inference_report(self) -> Dict[str, float]:
+        """Teacher model のイベントあたりの呼び出し回数と、聞き直しの割合・最後まで得られなかった関係の数"""
+        with self._stats_lock:
+            stats = dict(self.inference_stats)
+        events = stats["events"]
+        return {
+            "events": events,
+            "teacher_calls": stats["calls"],
+            "calls_per_event": stats["calls"] / events if events else 0.0,
+            "reask_rate": stats["reasked_events"] / events if events else 0.0,
+            "reasks": stats["reasks"],
+            "missing_relations": stats["missing"],
+            "completeness": 1 - stats["missing"] / (events * len(RELATIONS)) if events else 0.0,
+        }
+
+    def evaluate_inferences(
+        self,
+        events: List[str],
+        num_samples: int = 5,
+        concurrency: int = 1,
+        filter_batch_size: int = 1,
+        writer: Optional[CorpusWriter] = None,
+        exact_diversity: bool = False,
+    ) -> Dict[str, Dict[str, float]]:
+        """concurrency > 1 のときはイベント単位でスレッドプールで並列に処理する (集計結果は逐次実行と同じ)
+
+        filter_batch_size > 1 のときは、複数の推論 (イベントをまたいでもよい) を1回の Student model 呼び出しで評価する。
+        writer を渡すと推論と評価結果を1件ずつ書き出し、書き出し済みのイベントは処理せずに記録から集計する。
+        usage の予算 (Budget) を超えたら新しいイベントを始めず、処理を終えたイベントだけで指標を計算する。
+        diversity の異なり数は HyperLogLog で見積もる (メモリは一定)。exact_diversity のときは推論ごとのハッシュを持って正確に数える。
+        """
         metrics = {
             "generation_rate": {},  # 各関係タイプの生成成功率
             "validity_rate": {},    # 各関係タイプの妥当性評価率
             "diversity": {},        # 各関係タイプの推論の多様性
         }
         
-        all_inferences = {relation: [] for relation in ["xEffect", "xWant", "xNeed", "xIntent", "xReact", "HinderedBy"]}
-        valid_counts = {relation: 0 for relation in all_inferences.keys()}
-        total_counts = {relation: 0 for relation in all_inferences.keys()}
+        metrics.update({
+            "distinct_2": {},           # 異なる文字 bigram の割合
+            "self_overlap": {},         # それ以前の推論に現れた文字 bigram の割合 (self-BLEU の近似)
+            "near_duplicate_rate": {},  # 既出の推論の近似重複 (MinHash LSH) の割合
+        })
+
+        samples = events[:num_samples]
+        # 推論の本文は保持しない。exact_diversity のときだけ、異なり数を正確に数えるため推論ごとに 8 バイトのハッシュを持つ
+        distinct_inferences = {relation: set() for relation in RELATIONS} if exact_diversity else None
+        # 指標はスケッチで集計する。スケッチは関係が初めて現れたときに、イベント数に見合う大きさで作る
+        trackers: Dict[str, DiversityTracker] = {}
+        bloom_capacity = max(1024, len(samples) * 32)
+        valid_counts = {relation: 0 for relation in RELATIONS}
+        total_counts = {relation: 0 for relation in RELATIONS}
+
+        def count(relation: str, inference: str, valid: bool):
+            total_counts[relation] += 1
+            if distinct_inferences is not None:
+                distinct_inferences[relation].add(hashlib.blake2b(inference.encode(), digest_size=8).digest())
+            if relation not in trackers:
+                trackers[relation] = DiversityTracker(bloom_capacity=bloom_capacity)
+            trackers[relation].add([inference])
+            if valid:
+                valid_counts[relation] += 1
         
-        for event in events[:num_samples]:
-            inferences = self.generate_inference(event)
-            for relation in all_inferences.keys():
+        self.run_stats = {"events": 0, "resumed_events": 0, "stopped_by": None}
+        self._admitted = {"event": 0, "filter": 0}
+        if writer is not None:
+            resumed = [event for event in samples if writer.is_done(event)]
+            for event in resumed:
+                for record in writer.read_event(event):
+                    if record["relation"] in total_counts:
+                        count(record["relation"], record["inference"], record["valid"])
+            samples = [event for event in samples if not writer.is_done(event)]
+            self.run_stats["resumed_events"] = len(resumed)
+
+        if filter_batch_size > 1:
+            results = self._evaluate_batched(samples, concurrency, filter_batch_size)
+        else:
+            results = self._ordered_map(self._evaluate_event, samples, concurrency)
+
+        for event, (inferences, validity) in results:
+            self.run_stats["events"] += 1
+            if writer is not None:
+                writer.write_event(event, inferences, validity)
+            for relation in RELATIONS:
                 if relation in inferences:
-                    total_counts[relation] += 1
-                    inference = inferences[relation]
-                    all_inferences[relation].append(inference)
-                    
-                    if self.filter_inference(event, relation, inference):
-                        valid_counts[relation] += 1
-        
-        for relation in all_inferences.keys():
+                    count(relation, inferences[relation], validity[relation])
+
+        # 予算で打ち切ったときは、処理を終えたイベントの数で割る
+        processed = self.run_stats["events"] + self.run_stats["resumed_events"]
+        denominator = processed if self.run_stats["stopped_by"] else num_samples
+        for relation in RELATIONS:
             # 生成率の計算
-            metrics["generation_rate"][relation] = total_counts[relation] / num_samples
+            metrics["generation_rate"][relation] = total_counts[relation] / denominator if denominator else 0.0
             
             # 妥当性の計算
             if total_counts[relation] > 0:
@@ -92,37 +453,246 @@ Markdownの-を使った順序なしリスト形式で出力してください
             else:
                 metrics["validity_rate"][relation] = 0.0
             
+            if relation in trackers:
+                report = trackers[relation].report()
+            else:
+                report = {"distinct_texts": 0, "distinct_n": 0.0, "self_overlap": 0.0, "near_duplicate_rate": 0.0}
+
             # 多様性の計算（重複度の逆数）
-            if all_inferences[relation]:
-                counter = Counter(all_inferences[relation])
-                metrics["diversity"][relation] = len(all_inferences[relation]) / len(counter)
+            if distinct_inferences is not None:
+                distinct = len(distinct_inferences[relation])
             else:
-                metrics["diversity"][relation] = 0.0
+                distinct = report["distinct_texts"]
+            metrics["diversity"][relation] = total_counts[relation] / distinct if distinct else 0.0
+            metrics["distinct_2"][relation] = report["distinct_n"]
+            metrics["self_overlap"][relation] = report["self_overlap"]
+            metrics["near_duplicate_rate"][relation] = report["near_duplicate_rate"]
         
         return metrics
 
-    def filter_inference(self, event: str, relation: str, inference: str) -> bool:
+    def _admit(self, kind: str = "event") -> bool:
+        """予算の範囲内なら次のイベント (kind="event") か評価のバッチ (kind="filter") を始めてよい
+
+        tokens_per_minute があればそれに合わせて待つ。
+        """
+        reason = self.usage.exceeded()
+        if reason is not None:
+            if self.run_stats["stopped_by"] is None:
+                print(f"Budget exceeded ({reason}), stopping")
+            self.run_stats["stopped_by"] = reason
+            return False
+        # 1件あたりのトークン数を、同じ種類のそれまでの平均で見積もる
+        admitted = self._admitted[kind]
+        self.usage.throttle(self._unit_tokens(kind) / admitted if admitted else 0)
+        self._admitted[kind] += 1
+        return True
+
+    def _unit_tokens(self, kind: str) -> float:
+        """kind の処理に使ったトークン数の合計。評価をバッチにしないときは、評価もイベントの処理に含める"""
+        if not self._admitted["filter"]:
+            return self.usage.total_tokens()
+        filter_tokens = self.usage.stage_tokens("filter")
+        return filter_tokens if kind == "filter" else self.usage.total_tokens() - filter_tokens
+
+    def _ordered_map(
+        self, fn: Callable, items: Iterable, concurrency: int
+    ) -> Iterator[Tuple[object, object]]:
+        """items に fn を適用した (item, 結果) を入力の順に返す
+
+        同時に実行するのは concurrency 件までで、1件始めるごとに予算を確認する (Executor.map は全件を先に投入してしまう)。
+        """
+        iterator = iter(items)
+        if concurrency <= 1:
+            for item in iterator:
+                if not self._admit():
+                    return
+                yield item, fn(item)
+            return
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending: deque = deque()
+
+            def fill():
+                while len(pending) < concurrency:
+                    item = next(iterator, _DONE)
+                    if item is _DONE or not self._admit():
+                        return
+                    pending.append((item, executor.submit(fn, item)))
+
+            fill()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+                fill()
+
+    def _evaluate_event(self, event: str) -> Tuple[Dict[str, str], Dict[str, bool]]:
+        inferences = self.generate_inference(event)
+        relations = [relation for relation in RELATIONS if relation in inferences]
+        duplicates = self._near_duplicates([(event, relation, inferences[relation]) for relation in relations])
+        validity = {}
+        for relation, duplicate in zip(relations, duplicates):
+            if duplicate:
+                validity[relation] = False
+            else:
+                validity[relation] = self.filter_inference(event, relation, inferences[relation])
+        return inferences, validity
+
+    def _near_duplicates(self, items: List[Tuple[str, str, str]]) -> List[bool]:
+        """(イベント, 関係, 推論) のうち、同じ関係の既出の推論の近似重複を判定する"""
+        if self._seen is None or not items:
+            return [False] * len(items)
+        duplicates = [False] * len(items)
+        with self._seen_lock:
+            for relation, lsh in self._seen.items():
+                indices = [i for i, item in enumerate(items) if item[1] == relation]
+                if not indices:
+                    continue
+                representatives = lsh.add([items[i][2] for i in indices])
+                first_id = lsh.records - len(indices)
+                for offset, (i, representative) in enumerate(zip(indices, representatives)):
+                    duplicates[i] = bool(representative != first_id + offset)
+        with self._stats_lock:
+            self.filter_stats["near_duplicates"] += sum(duplicates)
+        return duplicates
+
+    def _evaluate_batched(
+        self, samples: List[str], concurrency: int, batch_size: int
+    ) -> Iterator[Tuple[str, Tuple[Dict[str, str], Dict[str, bool]]]]:
+        """推論の生成と評価を流れ作業にし、評価が揃ったイベントから入力の順に返す
+
+        処理中のイベントは batch_size * concurrency 件までで、評価待ちの推論が batch_size 件たまるごとに
+        Student model に送る (窓がいっぱいになったら、たまった分だけで送る)。
+        生成と評価はそれぞれ concurrency 件まで並列に実行する。
+        予算を超えたら新しいイベントは生成しないが、生成済みの推論 (窓の中の分) は評価して返す。
+        """
+        concurrency = max(1, concurrency)
+        max_events = batch_size * concurrency
+        generated = self._ordered_map(self.generate_inference, samples, concurrency)
+        # イベントごとの [イベント, 推論, 評価, 評価待ちの数]
+        window: deque = deque()
+        queue: List[Tuple[list, str]] = []
+        pending: deque = deque()
+        exhausted = False
+
+        def collect():
+            batch, future = pending.popleft()
+            for (state, relation), valid in zip(batch, future.result()):
+                state[2][relation] = valid
+                state[3] -= 1
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+            def submit():
+                # 予算を超えていても送る。生成は止まっているので、超過は窓の中の推論の評価だけで済む
+                self._admit("filter")
+                batch = queue[:batch_size]
+                del queue[:batch_size]
+                items = [(state[0], relation, state[1][relation]) for state, relation in batch]
+                pending.append((batch, executor.submit(self.filter_inferences, items)))
+
+            try:
+                while True:
+                    while pending and pending[0][1].done():
+                        collect()
+                    while window and window[0][3] == 0:
+                        event, inferences, validity, _ = window.popleft()
+                        yield event, (inferences, validity)
+                    if not exhausted and len(window) < max_events:
+                        result = next(generated, None)
+                        if result is None:
+                            exhausted = True
+                            continue
+                        event, inferences = result
+                        state = [event, inferences, {}, 0]
+                        relations = [relation for relation in RELATIONS if relation in inferences]
+                        duplicates = self._near_duplicates([(event, r, inferences[r]) for r in relations])
+                        for relation, duplicate in zip(relations, duplicates):
+                            if duplicate:
+                                state[2][relation] = False
+                            else:
+                                queue.append((state, relation))
+                                state[3] += 1
+                        window.append(state)
+                        if len(queue) >= batch_size:
+                            if len(pending) >= concurrency:
+                                collect()
+                            submit()
+                        continue
+                    # 窓がいっぱいか生成が終わったら、たまった推論を送るか、送ったバッチの結果を待つ
+                    if queue and len(pending) < concurrency:
+                        submit()
+                        continue
+                    if pending:
+                        collect()
+                        continue
+                    break
+            finally:
+                generated.close()
+
+    def filter_inferences(self, items: List[Tuple[str, str, str]]) -> List[bool]:
+        """(イベント, 関係, 推論) の組をまとめて1回で評価する。読み取れなかった項目だけ個別に評価し直す"""
+        if not items:
+            return []
+        start = time.perf_counter()
+        listing = "\n\n".join(
+            f"{i}.\nイベント: {event}\n関係: {relation}\n推論: {inference}"
+            for i, (event, relation, inference) in enumerate(items, start=1)
+        )
+        prompt = f"""以下の各項目について、イベントと推論が適切かどうかを評価してください。
+
+{FILTER_CRITERIA}
+
+{listing}
+
+回答は項目の順に {len(items)} 個の true または false を並べたJSON配列のみで答えてください。
+例: [true, false, true]
+"""
+        print(f"Sending batch of {len(items)} inferences to student model...")
+        with usage_scope("filter", [relation for _, relation, _ in items]):
+            response = self.student.generate(prompt)
+        print(f"Student model response: {response}")
+        parsed = parse_validity_array(response, len(items))
+        results = []
+        fallback_calls = 0
+        for item, valid in zip(items, parsed):
+            if valid is None:
+                fallback_calls += 1
+                valid = self.filter_inference(*item, count_stats=False)
+            results.append(valid)
+        with self._stats_lock:
+            self.filter_stats["items"] += len(items)
+            self.filter_stats["calls"] += 1
+            self.filter_stats["fallback_calls"] += fallback_calls
+            self.filter_stats["seconds"] += time.perf_counter() - start
+        return results
+
+    def filter_report(self) -> Dict[str, float]:
+        """Student model の呼び出し回数の削減量と、推論1件あたりの評価時間 (近似重複として送らなかった件数は別に数える)"""
+        with self._stats_lock:
+            stats = dict(self.filter_stats)
+        calls = stats["calls"] + stats["fallback_calls"]
+        return {
+            "evaluated_inferences": stats["items"],
+            "student_calls": calls,
+            "calls_saved": stats["items"] - calls,
+            "seconds_per_inference": stats["seconds"] / stats["items"] if stats["items"] else 0.0,
+            "near_duplicates_dropped": stats["near_duplicates"],
+        }
+
+    def filter_inference(self, event: str, relation: str, inference: str, count_stats: bool = True) -> bool:
+        start = time.perf_counter()
         print(f"\nEvaluating inference:")
         print(f"Event: {event}")
         print(f"Relation: {relation}")
         print(f"Inference: {inference}")
         
-        prompt = f"""以下のイベントと推論が適切かどうかを評価してください。
-
-### チェック基準:
-1. 論理的一貫性 - イベントと関係に対して適切な推論か
-2. 常識的な妥当性 - 現実世界の知識と矛盾しないか
-3. 情報の具体性 - 推論が単純すぎず、具体的な知識を含んでいるか
-4. 不要な曖昧さがないか
-5. 誤解を招く表現がないか
-
-イベント: {event}
-関係: {relation}
-推論: {inference}
-
-回答は "True" または "False" のみで答えてください。
-"""
+        prompt = filter_prompt(event, relation, inference)
         print("Sending request to student model...")
-        response = self.student.generate(prompt)
+        with usage_scope("filter", [relation]):
+            response = self.student.generate(prompt)
         print(f"Student model response: {response}")
+        if count_stats:
+            with self._stats_lock:
+                self.filter_stats["items"] += 1
+                self.filter_stats["calls"] += 1
+                self.filter_stats["seconds"] += time.perf_counter() - start
         return response.strip().lower() == "true"
@@ -0,0 +1,337 @@
+from typing import Dict, Iterable, Optional, Sequence
+import hashlib
+import math
+import numpy as np
+
+# 文字 n-gram のハッシュ・MinHash・HyperLogLog・Bloom filter をすべて uint64 の配列演算で計算する。
+# uint64 の乗算・加算は 2^64 を法として折り返すので、その性質をそのままハッシュに使う。
+
+_PRIME = np.uint64(0x100000001B3)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """splitmix64 の最終段 (ビットをよく混ぜる)"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def char_ngram_hashes(texts: Sequence[str], n: int = 2) -> tuple[np.ndarray, np.ndarray]:
+    """テキストごとの文字 n-gram のハッシュを1つの配列にまとめて返す
+
+    戻り値は (hashes, offsets) で、texts[i] の n-gram は hashes[offsets[i]:offsets[i + 1]]。
+    分かち書きのない日本語でも使えるよう、単語ではなく文字単位で区切る。n 文字未満のテキストも1つの n-gram になる。
+    """
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    # テキストの間に n 文字の区切りを入れてまとめて符号化し、テキストをまたぐ n-gram を作らない
+    separator = "\0" * n
+    codepoints = np.frombuffer((separator.join(texts) + separator).encode("utf-32-le"), dtype=np.uint32)
+    codepoints = codepoints.astype(np.uint64)
+    starts = np.concatenate(([0], np.cumsum(lengths + n)[:-1])) if len(texts) else lengths
+    counts = np.maximum(lengths - n + 1, 1)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+    hashes = np.zeros(len(positions), dtype=np.uint64)
+    for k in range(n):
+        hashes = hashes * _PRIME + codepoints[positions + k]
+    return _mix(hashes), offsets
+
+
+def text_hashes(texts: Iterable[str]) -> np.ndarray:
+    """テキスト全体のハッシュ (完全一致の重複の判定用)"""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little") for text in texts),
+        dtype=np.uint64,
+    )
+
+
+class HyperLogLog:
+    """異なり数の近似 (メモリは 2^p バイトで一定、相対誤差は約 1.04 / sqrt(2^p))"""
+
+    def __init__(self, p: int = 14):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, hashes: np.ndarray):
+        if len(hashes) == 0:
+            return
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        # index の次の32ビットの先頭の0の数 + 1 (frexp の指数がビット長になる)
+        rest = ((hashes >> np.uint64(32 - self.p)) & _MASK32).astype(np.float64)
+        rank = (33 - np.frexp(rest)[1]).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def count(self) -> float:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # 少ないうちは線形カウンティングの方が正確
+            return m * math.log(m / zeros)
+        return float(estimate)
+
+
+class BloomFilter:
+    """n-gram を見たことがあるかの判定 (偽陽性はあるが偽陰性はない)"""
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.01):
+        bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = 1 << max(bits - 1, 1).bit_length()
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros(self.size // 8, dtype=np.uint8)
+
+    def _positions(self, hashes: np.ndarray) -> np.ndarray:
+        # ダブルハッシングで num_hashes 個の位置を作る
+        h1 = hashes & _MASK32
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) & np.uint64(self.size - 1)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        positions = self._positions(hashes)
+        present = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return present.all(axis=1)
+
+    def add(self, hashes: np.ndarray):
+        positions = self._positions(hashes).ravel()
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+
+
+class _BandTable:
+    """LSH のバンドのキーからクラスタ代表への対応 (numpy 配列によるオープンアドレス法)
+
+    Python の dict より1件あたりのメモリが一桁小さいので、数百万件の推論でも保持できる。キー 0 は空きを表す。
+    小さく作って、埋まってきたら倍に広げる。
+    """
+
+    max_load = 0.75
+
+    def __init__(self, capacity: int = 1 << 10):
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.zeros(capacity, dtype=np.int32)
+        self.size = 0
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        mask = np.uint64(len(self.keys) - 1)
+        slots = keys & mask
+        result = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+        while len(pending):
+            found = self.keys[slots[pending]]
+            hit = found == keys[pending]
+            result[pending[hit]] = self.values[slots[pending[hit]]]
+            pending = pending[~hit & (found != 0)]
+            slots[pending] = (slots[pending] + np.uint64(1)) & mask
+        return result
+
+    def insert(self, keys: np.ndarray, values: np.ndarray):
+        """表にまだないキーを追加する"""
+        keys, first = np.unique(keys, return_index=True)
+        values = values[first]
+        if self.size + len(keys) > len(self.keys) * self.max_load:
+            self._grow(self.size + len(keys))
+        self._place(keys, values)
+
+    def _place(self, keys: np.ndarray, values: np.ndarray):
+        mask = np.uint64(len(self.keys) - 1)
+        slots = keys & mask
+        pending = np.arange(len(keys))
+        while len(pending):
+            free = self.keys[slots[pending]] == 0
+            # 同じ空きに複数のキーが来たら最初の1つだけを入れ、残りは次の周回で先へ進む
+            candidates = np.flatnonzero(free)
+            taken, first = np.unique(slots[pending[candidates]], return_index=True)
+            winners = pending[candidates[first]]
+            self.keys[taken] = keys[winners]
+            self.values[taken] = values[winners]
+            occupied = pending[~free]
+            slots[occupied] = (slots[occupied] + np.uint64(1)) & mask
+            won = np.zeros(len(pending), dtype=bool)
+            won[candidates[first]] = True
+            pending = pending[~won]
+        self.size += len(keys)
+
+    def _grow(self, size: int):
+        used = self.keys != 0
+        keys, values = self.keys[used], self.values[used]
+        capacity = len(self.keys)
+        while size > capacity * self.max_load:
+            capacity *= 2
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.zeros(capacity, dtype=np.int32)
+        self.size = 0
+        # 既存のキーは重複がないので、そのまま置き直す (一時配列を抑えるため少しずつ)
+        for start in range(0, len(keys), 1 << 20):
+            self._place(keys[start:start + (1 << 20)], values[start:start + (1 << 20)])
+
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.values.nbytes
+
+
+class MinHashLSH:
+    """文字 n-gram の MinHash と LSH による近似重複の検出
+
+    num_perm 個のハッシュを bands 個に分け、どれかのバンドが一致したものを近似重複とみなす。
+    Jaccard 類似度がおよそ (1 / bands) ** (1 / rows) 以上のものが同じクラスタに入る (既定では約 0.77)。
+    推論は10～20文字程度と短いので、既定では文字 bigram で比べる。
+    短い文は語尾が同じだけでも類似度が 0.4 程度になるので、誤って重複とみなさないよう閾値は高めにしている。
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 8, ngram: int = 2, seed: int = 0):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+        # 表にはクラスタの番号 (現れた順) を int32 で持つ (1つの索引のクラスタは約21億個まで)。
+        # クラスタごとの代表 (最初に現れた記録の通し番号) と大きさは番号で引くので、メモリは記録数ではなくクラスタ数に比例する
+        self._table = _BandTable()
+        self.records = 0
+        self.num_clusters = 0
+        self._representatives = np.zeros(1024, dtype=np.int64)
+        self.cluster_sizes = np.zeros(1024, dtype=np.int64)
+
+    def signatures(self, hashes: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        permuted = hashes[:, None] * self._a[None, :] + self._b[None, :]
+        return np.minimum.reduceat(permuted, offsets[:-1], axis=0)
+
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        keys = np.zeros((len(signatures), self.bands), dtype=np.uint64)
+        for band in range(self.bands):
+            key = np.full(len(signatures), band + 1, dtype=np.uint64)
+            for row in signatures[:, band * self.rows:(band + 1) * self.rows].T:
+                key = key * _PRIME ^ row
+            keys[:, band] = _mix(key)
+        keys[keys == 0] = 1
+        return keys
+
+    def add(self, texts: Sequence[str], hashes: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None
+            ) -> np.ndarray:
+        """texts を追加し、それぞれが属するクラスタの代表 (最初に現れた記録の通し番号) を返す
+
+        代表が自分自身でないものが近似重複。重複でないものだけを表に登録するので、メモリは異なり数に比例する。
+        """
+        if not len(texts):
+            return np.zeros(0, dtype=np.int64)
+        if hashes is None:
+            hashes, offsets = char_ngram_hashes(texts, self.ngram)
+        keys = self.band_keys(self.signatures(hashes, offsets))
+        ids = np.arange(self.records, self.records + len(texts))
+
+        # 既存のクラスタとの一致 (番号は現れた順なので、最小の番号が最も前の代表)
+        found = self._table.lookup(keys.ravel()).reshape(keys.shape)
+        found = np.where(found >= 0, found, self.num_clusters).min(axis=1)
+
+        # 同じバッチ内の、より前の記録との一致 (バンドごとに最初に現れた位置)
+        earliest = np.arange(len(texts))
+        for band in range(self.bands):
+            _, first, inverse = np.unique(keys[:, band], return_index=True, return_inverse=True)
+            earliest = np.minimum(earliest, first[inverse.ravel()])
+
+        # バッチ内の重複は連鎖しうるので、前から順にクラスタをたどる
+        clusters = found.tolist()
+        new = np.zeros(len(texts), dtype=bool)
+        next_cluster = self.num_clusters
+        for i, j in enumerate(earliest.tolist()):
+            if clusters[i] < self.num_clusters:
+                continue
+            if j < i:
+                clusters[i] = clusters[j]
+            else:
+                clusters[i] = next_cluster
+                new[i] = True
+                next_cluster += 1
+        clusters = np.array(clusters, dtype=np.int64)
+
+        if next_cluster > len(self._representatives):
+            capacity = max(next_cluster, len(self._representatives) * 2)
+            self._representatives = np.resize(self._representatives, capacity)
+            self.cluster_sizes = np.resize(self.cluster_sizes, capacity)
+            self.cluster_sizes[self.num_clusters:] = 0
+        self._representatives[clusters[new]] = ids[new]
+        self._table.insert(keys[new].ravel(), np.repeat(clusters[new], self.bands))
+        np.add.at(self.cluster_sizes, clusters, 1)
+        self.num_clusters = next_cluster
+        self.records += len(texts)
+        return self._representatives[clusters]
+
+    def nbytes(self) -> int:
+        return self._table.nbytes() + self._representatives.nbytes + self.cluster_sizes.nbytes
+
+    def clusters(self) -> Dict[str, int]:
+        sizes = self.cluster_sizes[:self.num_clusters]
+        return {
+            "clusters": self.num_clusters,
+            "duplicate_clusters": int(np.count_nonzero(sizes > 1)),
+            "largest_cluster": int(sizes.max()) if self.num_clusters else 0,
+        }
+
+
+class DiversityTracker:
+    """推論の多様性をストリーミングで集計する (メモリは記録数によらずほぼ一定)
+
+    - distinct_texts: 異なり数 (HyperLogLog)
+    - distinct_n: 異なる文字 n-gram の数 / n-gram の総数 (HyperLogLog)
+    - self_overlap: それ以前の記録に現れた n-gram の割合の平均 (Bloom filter、self-BLEU の近似)
+    - near_duplicate_rate: MinHash LSH で既存の記録の近似重複と判定された割合
+    """
+
+    def __init__(self, n: int = 2, lsh: Optional[MinHashLSH] = None, bloom_capacity: int = 1_000_000):
+        self.n = n
+        self.lsh = lsh or MinHashLSH()
+        self.texts = HyperLogLog()
+        self.ngrams = HyperLogLog()
+        self.bloom = BloomFilter(bloom_capacity)
+        self.records = 0
+        self.total_ngrams = 0
+        self.overlap_sum = 0.0
+        self.near_duplicates = 0
+
+    def add(self, texts: Sequence[str]) -> np.ndarray:
+        """texts を追加し、近似重複かどうかの配列を返す"""
+        if not len(texts):
+            return np.zeros(0, dtype=bool)
+        self.texts.add(text_hashes(texts))
+
+        hashes, offsets = char_ngram_hashes(texts, self.n)
+        self.ngrams.add(hashes)
+        owners = np.repeat(np.arange(len(texts)), np.diff(offsets))
+        # バッチ内で先に現れた n-gram も「既に見た」として数える
+        _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        seen = self.bloom.contains(hashes) | (owners[first[inverse.ravel()]] < owners)
+        self.bloom.add(hashes)
+        self.overlap_sum += float(np.sum(np.add.reduceat(seen.astype(np.float64), offsets[:-1]) / np.diff(offsets)))
+        self.total_ngrams += len(hashes)
+
+        if self.lsh.ngram == self.n:
+            representatives = self.lsh.add(texts, hashes, offsets)
+        else:
+            representatives = self.lsh.add(texts)
+        duplicates = representatives != np.arange(self.lsh.records - len(texts), self.lsh.records)
+        self.records += len(texts)
+        self.near_duplicates += int(duplicates.sum())
+        return duplicates
+
+    def nbytes(self) -> int:
+        return self.lsh.nbytes() + self.bloom.bits.nbytes + self.texts.registers.nbytes + self.ngrams.registers.nbytes
+
+    def report(self) -> Dict[str, float]:
+        if not self.records:
+            return {"records": 0, "distinct_texts": 0, "distinct_n": 0.0, "self_overlap": 0.0,
+                    "near_duplicate_rate": 0.0, **self.lsh.clusters()}
+        return {
+            "records": self.records,
+            "distinct_texts": max(1, min(round(self.texts.count()), self.records)),
+            "distinct_n": min(self.ngrams.count() / self.total_ngrams, 1.0),
+            "self_overlap": self.overlap_sum / self.records,
+            "near_duplicate_rate": self.near_duplicates / self.records,
+            **self.lsh.clusters(),
+        }
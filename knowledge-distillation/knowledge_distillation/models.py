@@ -1,39 +1,103 @@
-from openai import OpenAI
-import os
-import httpx
-
-class TeacherModel:
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            http_client=httpx.Client(timeout=30.0)
-        )
-        
-    def generate(self, prompt: str) -> str:
-        try:
-            response = self.client.chat.completions.create(
-                model="o3-mini",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.choices[0].message.content or ""
-        except Exception as e:
-            print(f"Teacher model error: {e}")
-            return ""
-
-class StudentModel:
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            http_client=httpx.Client(timeout=30.0)
+from typing import Optional
+import random
+import time
+import openai
+from .backends import Backend, OpenAIBackend
+from .cache import ResponseCache
+from .ratelimit import RateLimiter
+from .transport import Transport, default_transport
+from .usage import UsageTracker
+
+def is_transient(error: Exception) -> bool:
+    """再試行で直る見込みのあるエラー (レート制限・タイムアウト・接続エラー・5xx)
+
+    認証エラーや不正なリクエスト (response_format の誤り、コンテキスト長の超過など) は再試行しても直らない。
+    """
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+class ChatModel:
+    model = ""
+    label = ""
+    timeout = 30.0
+
+    def __init__(
+        self,
+        client=None,
+        cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        base_url: Optional[str] = None,
+        transport: Optional[Transport] = None,
+        timeout: Optional[float] = None,
+        backend: Optional[Backend] = None,
+        model: Optional[str] = None,
+        usage: Optional[UsageTracker] = None,
+    ):
+        if timeout is not None:
+            self.timeout = timeout
+        if backend is None:
+            # client を渡さなければ、プロセス全体で共有する接続プールを使う
+            client = client or (transport or default_transport()).openai(base_url=base_url, timeout=self.timeout)
+            backend = OpenAIBackend(client)
+        self.backend = backend
+        self.client = getattr(backend, "client", None)
+        # ローカルのモデルは名前が違うので、キャッシュのキーも分かれる
+        self.model = model or backend.model or self.model
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.usage = usage
+
+    def generate(self, prompt: str, response_format: Optional[dict] = None) -> str:
+        """response_format (JSON スキーマなど) を渡すと、対応するバックエンドでは応答をその形式に制約する"""
+        if self.cache is None:
+            return self._complete(prompt, response_format)
+        params = None if response_format is None else {"response_format": response_format}
+        return self.cache.get_or_compute(
+            self.model, prompt, params, lambda: self._complete(prompt, response_format)
         )
-        
-    def generate(self, prompt: str) -> str:
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.choices[0].message.content or ""
-        except Exception as e:
-            print(f"Student model error: {e}")
-            return ""
+
+    def _complete(self, prompt: str, response_format: Optional[dict] = None) -> str:
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                # 日本語は概ね1文字1トークンなので、文字数をトークン数の見積もりにする
+                self.rate_limiter.acquire(tokens=len(prompt))
+            start = time.perf_counter()
+            try:
+                completion = self.backend.complete(self.model, prompt, response_format)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                if attempt == self.max_retries:
+                    print(f"{self.label} model error: {e}")
+                    return ""
+                # 指数バックオフ (同時に失敗した呼び出しが揃って再試行しないよう揺らぎを入れる)
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                print(f"{self.label} model error: {e} (retrying in {delay:.1f}s)")
+                time.sleep(delay)
+                continue
+            if self.usage is not None:
+                self.usage.record(
+                    self.model,
+                    completion.prompt_tokens,
+                    completion.completion_tokens,
+                    time.perf_counter() - start,
+                    prompt=prompt,
+                    response=completion.text,
+                )
+            return completion.text
+        return ""
+
+class TeacherModel(ChatModel):
+    model = "o3-mini"
+    label = "Teacher"
+    # 推論モデルは応答に時間がかかる
+    timeout = 120.0
+
+class StudentModel(ChatModel):
+    model = "gpt-4o-mini"
+    label = "Student"
@@ -0,0 +1,47 @@
+import threading
+import time
+from typing import Optional
+
+
+class RateLimiter:
+    """1分あたりのリクエスト数・トークン数の上限 (トークンバケット方式、スレッドセーフ)
+
+    トークン数は送信前に分からないので、呼び出し側の見積もりで消費する。
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute is not None and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute is not None:
+                    # 1回の見積もりがバケットより大きくても、満杯になれば通す
+                    needed = min(tokens, self.tokens_per_minute)
+                    if self._tokens < needed:
+                        wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute is not None:
+                        self._requests -= 1
+                    if self.tokens_per_minute is not None:
+                        self._tokens -= min(tokens, self.tokens_per_minute)
+                    return
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
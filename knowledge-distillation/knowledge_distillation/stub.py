@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, Iterator, Optional, Union
+
+
+class StubClient:
+    """OpenAI クライアントの代わりにローカルで応答を返すクライアント (オフラインのテスト用)
+
+    responder にはプロンプトから応答を返す関数、またはプロンプトと応答の辞書を渡す。
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Union[Callable[[str], str], dict[str, str]]] = None,
+        delay: float = 0.0,
+    ):
+        self.responder = responder
+        self.delay = delay
+        self.calls: list[tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _respond(self, prompt: str) -> str:
+        if self.responder is None:
+            return ""
+        if callable(self.responder):
+            return self.responder(prompt)
+        return self.responder.get(prompt, "")
+
+    def _create(self, model: str, messages: list[dict], **kwargs):
+        prompt = messages[-1]["content"]
+        with self._lock:
+            self.calls.append((model, prompt))
+        if self.delay:
+            time.sleep(self.delay)
+        content = self._respond(prompt)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=len(prompt),
+                completion_tokens=len(content),
+                total_tokens=len(prompt) + len(content),
+            ),
+        )
+
+
+@contextmanager
+def serve_stub(
+    responder: Optional[Union[Callable[[str], str], dict[str, str]]] = None,
+    delay: float = 0.0,
+) -> Iterator[str]:
+    """OpenAI 互換の /chat/completions を返すローカルHTTPサーバを起動し、base_url を返す (ベンチマーク用)"""
+    stub = StubClient(responder)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ヘッダと本文を別々に書くので、Nagle アルゴリズムで応答が遅れないようにする
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if delay:
+                time.sleep(delay)
+            completion = stub.chat.completions.create(**request)
+            body = json.dumps(
+                {
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": completion.choices[0].message.content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": vars(completion.usage),
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    finally:
+        server.shutdown()
+        server.server_close()
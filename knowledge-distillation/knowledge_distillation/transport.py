@@ -0,0 +1,131 @@
+from typing import Optional
+import importlib.util
+import os
+import threading
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+
+class Transport:
+    """Teacher model と Student model で共有する HTTP 接続プール (同期・非同期)
+
+    httpx のクライアントは接続を使い回すので、モデルやインスタンスごとに作らずにこれを共有する。
+    HTTP/2 は h2 パッケージがあるときだけ有効にする (httpx[http2])。
+    接続の再利用状況は httpcore の trace 拡張で数える。
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: Optional[bool] = None,
+        connect_timeout: float = 5.0,
+    ):
+        if http2 is None:
+            http2 = importlib.util.find_spec("h2") is not None
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.connect_timeout = connect_timeout
+        self.client = httpx.Client(
+            limits=self.limits, http2=http2, event_hooks={"request": [self._add_trace]}
+        )
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._openai: dict[tuple, OpenAI] = {}
+        self._async_openai: dict[tuple, AsyncOpenAI] = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "connections_opened": 0}
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # AsyncClient はイベントループの中で使うので、必要になるまで作らない
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                limits=self.limits, http2=self.http2, event_hooks={"request": [self._add_trace_async]}
+            )
+        return self._async_client
+
+    def timeout(self, seconds: float) -> httpx.Timeout:
+        return httpx.Timeout(seconds, connect=min(seconds, self.connect_timeout))
+
+    def openai(self, base_url: Optional[str] = None, timeout: float = 30.0, api_key: Optional[str] = None) -> OpenAI:
+        """この接続プールを使う OpenAI クライアント (base_url とタイムアウトごとに1つ)"""
+        key = (base_url, timeout, api_key)
+        with self._lock:
+            if key not in self._openai:
+                self._openai[key] = OpenAI(
+                    api_key=api_key or os.getenv("OPENAI_API_KEY"),
+                    base_url=base_url,
+                    # 再試行は ChatModel で行う
+                    max_retries=0,
+                    timeout=self.timeout(timeout),
+                    http_client=self.client,
+                )
+            return self._openai[key]
+
+    def async_openai(
+        self, base_url: Optional[str] = None, timeout: float = 30.0, api_key: Optional[str] = None
+    ) -> AsyncOpenAI:
+        key = (base_url, timeout, api_key)
+        with self._lock:
+            if key not in self._async_openai:
+                self._async_openai[key] = AsyncOpenAI(
+                    api_key=api_key or os.getenv("OPENAI_API_KEY"),
+                    base_url=base_url,
+                    max_retries=0,
+                    timeout=self.timeout(timeout),
+                    http_client=self.async_client,
+                )
+            return self._async_openai[key]
+
+    def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._stats["connections_opened"] += 1
+        elif event_name.endswith(".send_request_headers.started"):
+            with self._lock:
+                self._stats["requests"] += 1
+
+    async def _trace_async(self, event_name: str, info: dict):
+        self._trace(event_name, info)
+
+    def _add_trace(self, request: httpx.Request):
+        request.extensions["trace"] = self._trace
+
+    async def _add_trace_async(self, request: httpx.Request):
+        request.extensions["trace"] = self._trace_async
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        reused = max(stats["requests"] - stats["connections_opened"], 0)
+        return {
+            **stats,
+            "reused": reused,
+            "reuse_rate": reused / stats["requests"] if stats["requests"] else 0.0,
+            "http2": self.http2,
+        }
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+
+
+_default_transport: Optional[Transport] = None
+_default_lock = threading.Lock()
+
+
+def default_transport() -> Transport:
+    """モデルに transport を渡さなかったときに使う、プロセス全体で共有する接続プール"""
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
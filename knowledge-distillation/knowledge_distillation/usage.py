@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Sequence
+import json
+import os
+import threading
+import time
+from .ratelimit import RateLimiter
+
+# 100万トークンあたりの料金 (USD, 入力・出力)。載っていないモデル (ローカルのモデルなど) は0として数える
+PRICES = {
+    "o3-mini": (1.10, 4.40),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# 今の呼び出しがどの段階・どの関係のものか (スレッドごと)
+_scope: ContextVar[tuple[str, tuple[str, ...]]] = ContextVar("usage_scope", default=("other", ()))
+
+
+@contextmanager
+def usage_scope(stage: str, relations: Sequence[str] = ()) -> Iterator[None]:
+    """この中のモデル呼び出しを stage に数える。relations を渡すと、トークン数をそれらに等分して関係ごとにも数える"""
+    token = _scope.set((stage, tuple(relations)))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+@dataclass
+class Budget:
+    """実行の上限。超えたら新しいイベントの処理を始めない
+
+    tokens_per_minute を指定すると、上限とは別にイベントの投入をこの速さに抑える。
+    """
+
+    max_tokens: Optional[int] = None
+    max_cost: Optional[float] = None
+    max_seconds: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+def _empty() -> Dict[str, float]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost": 0.0}
+
+
+class UsageTracker:
+    """モデル呼び出しごとのトークン数・時間・料金を、段階・関係・モデルごとに集計する (スレッドセーフ)"""
+
+    def __init__(self, budget: Optional[Budget] = None, prices: Optional[Dict[str, tuple[float, float]]] = None):
+        self.budget = budget or Budget()
+        self.prices = PRICES if prices is None else prices
+        self.started = time.monotonic()
+        self.total = _empty()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.relations: Dict[str, Dict[str, float]] = {}
+        self.models: Dict[str, Dict[str, float]] = {}
+        self.estimated_calls = 0
+        self._lock = threading.Lock()
+        self._throttle = RateLimiter(tokens_per_minute=self.budget.tokens_per_minute)
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: Optional[int],
+        completion_tokens: Optional[int],
+        seconds: float,
+        prompt: str = "",
+        response: str = "",
+    ):
+        """1回の呼び出しを記録する。usage が返らないバックエンドでは文字数をトークン数の見積もりにする"""
+        estimated = prompt_tokens is None or completion_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = len(prompt)
+        if completion_tokens is None:
+            completion_tokens = len(response)
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+        call = {
+            "calls": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "seconds": seconds, "cost": cost,
+        }
+        stage, relations = _scope.get()
+        with self._lock:
+            self.estimated_calls += estimated
+            self._add(self.total, call, 1.0)
+            self._add(self.stages.setdefault(stage, _empty()), call, 1.0)
+            self._add(self.models.setdefault(model, _empty()), call, 1.0)
+            for relation in relations:
+                self._add(self.relations.setdefault(relation, _empty()), call, 1 / len(relations))
+
+    @staticmethod
+    def _add(totals: Dict[str, float], call: Dict[str, float], share: float):
+        for key, value in call.items():
+            totals[key] += value * share
+
+    def total_tokens(self) -> float:
+        with self._lock:
+            return self.total["prompt_tokens"] + self.total["completion_tokens"]
+
+    def stage_tokens(self, stage: str) -> float:
+        with self._lock:
+            totals = self.stages.get(stage)
+            return totals["prompt_tokens"] + totals["completion_tokens"] if totals else 0.0
+
+    def exceeded(self) -> Optional[str]:
+        """超えた上限の名前 (超えていなければ None)"""
+        with self._lock:
+            tokens = self.total["prompt_tokens"] + self.total["completion_tokens"]
+            cost = self.total["cost"]
+        if self.budget.max_tokens is not None and tokens >= self.budget.max_tokens:
+            return "max_tokens"
+        if self.budget.max_cost is not None and cost >= self.budget.max_cost:
+            return "max_cost"
+        if self.budget.max_seconds is not None and time.monotonic() - self.started >= self.budget.max_seconds:
+            return "max_seconds"
+        return None
+
+    def throttle(self, tokens: float):
+        """tokens_per_minute を超えないよう、次の処理の前に待つ"""
+        if self.budget.tokens_per_minute is not None:
+            self._throttle.acquire(tokens=int(tokens))
+
+    def summary(self) -> dict:
+        def rounded(totals: Dict[str, float]) -> Dict[str, float]:
+            return {
+                # 関係ごとの集計は呼び出しを等分するので、回数は小数になりうる
+                "calls": round(totals["calls"], 2),
+                "prompt_tokens": round(totals["prompt_tokens"]),
+                "completion_tokens": round(totals["completion_tokens"]),
+                "total_tokens": round(totals["prompt_tokens"] + totals["completion_tokens"]),
+                "seconds": round(totals["seconds"], 3),
+                "cost": round(totals["cost"], 6),
+            }
+
+        exceeded = self.exceeded()
+        with self._lock:
+            return {
+                "total": rounded(self.total),
+                "stages": {stage: rounded(totals) for stage, totals in self.stages.items()},
+                "relations": {relation: rounded(totals) for relation, totals in self.relations.items()},
+                "models": {model: rounded(totals) for model, totals in self.models.items()},
+                "estimated_calls": self.estimated_calls,
+                "elapsed_seconds": round(time.monotonic() - self.started, 3),
+                "budget": {key: value for key, value in vars(self.budget).items() if value is not None},
+                "exceeded": exceeded,
+            }
+
+    def write_json(self, path: str, **extra):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({**self.summary(), **extra}, f, ensure_ascii=False, indent=2)
@@ -1,11 +1,28 @@
+import argparse
 import os
 from dotenv import load_dotenv
-from knowledge_distillation import KnowledgeDistillation
+from knowledge_distillation import Budget, CorpusWriter, KnowledgeDistillation, ResponseCache, UsageTracker
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="corpus/triples.jsonl", help="推論と評価結果を追記する JSONL ファイル")
+    parser.add_argument("--summary", default="corpus/summary.json", help="実行結果の要約 (JSON) の書き出し先")
+    parser.add_argument("--max-tokens", type=int, help="この実行で使うトークン数の上限")
+    parser.add_argument("--max-cost", type=float, help="この実行の料金の上限 (USD)")
+    parser.add_argument("--max-seconds", type=float, help="この実行の時間の上限 (秒)")
+    parser.add_argument("--tokens-per-minute", type=float, help="1分あたりのトークン数をこれに抑える")
+    args = parser.parse_args()
     load_dotenv()
     
-    distillation = KnowledgeDistillation()
+    # 同じイベントで再実行したときはAPIを呼ばずにキャッシュから応答を返す
+    cache = ResponseCache()
+    # 予算を超えたら新しいイベントを始めず、それまでの結果で指標を計算する
+    usage = UsageTracker(Budget(args.max_tokens, args.max_cost, args.max_seconds, args.tokens_per_minute))
+    # 既に評価した推論の近似重複は Student model に送らない
+    # 推論は JSON スキーマで生成し、足りない関係だけを聞き直す
+    distillation = KnowledgeDistillation(
+        cache=cache, drop_near_duplicates=True, usage=usage, structured_output=True
+    )
     
     # イベントの生成
     events = distillation.generate_events(num_events=5)
@@ -15,12 +32,41 @@ def main():
         
     # 評価メトリクスの計算
     print("\n評価メトリクス:")
-    metrics = distillation.evaluate_inferences(events)
+    # 1イベント分の推論 (6関係) を1回の Student model 呼び出しでまとめて評価する
+    # 書き出し済みのイベントは再実行時に飛ばす
+    with CorpusWriter(args.output) as writer:
+        metrics = distillation.evaluate_inferences(events, filter_batch_size=6, writer=writer)
     
     for metric_name, metric_values in metrics.items():
         print(f"\n{metric_name}:")
         for relation, value in metric_values.items():
             print(f"- {relation}: {value:.2f}")
 
+    report = distillation.filter_report()
+    print(f"\n評価: {report['evaluated_inferences']}件 / Student model 呼び出し {report['student_calls']}回 "
+          f"(削減 {report['calls_saved']}回, 1件あたり {report['seconds_per_inference']:.2f}秒, "
+          f"近似重複で省略 {report['near_duplicates_dropped']}件)")
+    inference = distillation.inference_report()
+    print(f"推論: イベントあたり Teacher model 呼び出し {inference['calls_per_event']:.2f}回 "
+          f"(聞き直し {inference['reask_rate']:.0%}, 得られなかった関係 {inference['missing_relations']}件)")
+    print(f"キャッシュ: {cache.stats()}")
+    print(f"書き出し: {writer.stats} -> {args.output}")
+
+    # 機械で読める要約を書き出す
+    summary = usage.summary()
+    print(f"トークン: {summary['total']['total_tokens']} (料金 ${summary['total']['cost']:.4f}, "
+          f"打ち切り: {distillation.run_stats['stopped_by']})")
+    usage.write_json(
+        args.summary,
+        metrics=metrics,
+        run=distillation.run_stats,
+        events=distillation.event_stats,
+        inference=inference,
+        filter=report,
+        cache=cache.stats(),
+        corpus=writer.stats,
+    )
+    print(f"要約: {args.summary}")
+
 if __name__ == "__main__":
     main()
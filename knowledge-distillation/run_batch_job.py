@@ -0,0 +1,26 @@
+import argparse
+from dotenv import load_dotenv
+from knowledge_distillation import DistillationJob, KnowledgeDistillation, OpenAIBatchBackend
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch API で大量のイベントをまとめて蒸留する (再実行で続きから再開)")
+    parser.add_argument("--job-dir", default="batch-jobs/default")
+    parser.add_argument("--events", help="1行1イベントのテキストファイル (省略時は Teacher model で生成)")
+    parser.add_argument("--num-events", type=int, default=100)
+    parser.add_argument("--poll-interval", type=float, default=60.0)
+    args = parser.parse_args()
+    load_dotenv()
+
+    job = DistillationJob(args.job_dir, OpenAIBatchBackend(), poll_interval=args.poll_interval)
+    events = None
+    if job.state["stage"] == "init":
+        if args.events:
+            with open(args.events) as f:
+                events = [line.strip() for line in f if line.strip()]
+        else:
+            events = KnowledgeDistillation().generate_events(num_events=args.num_events)
+    path = job.run(events)
+    print(f"採用: {job.state['accepted']}件 / 評価 {job.state['evaluated']}件 -> {path}")
+
+if __name__ == "__main__":
+    main()
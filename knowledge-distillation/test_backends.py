@@ -0,0 +1,69 @@
+import threading
+from knowledge_distillation import (
+    InProcessBackend,
+    KnowledgeDistillation,
+    LocalEndpointBackend,
+    ResponseCache,
+    StubClient,
+    StudentModel,
+    TeacherModel,
+    Transport,
+    serve_stub,
+)
+
+def test_in_process_backend_batches_concurrent_requests():
+    batch_sizes = []
+
+    def predict_batch(prompts):
+        batch_sizes.append(len(prompts))
+        return ["True" if "本" in prompt else "False" for prompt in prompts]
+
+    student = StudentModel(backend=InProcessBackend(predict_batch, max_batch_size=8, max_wait=0.05))
+    assert student.model == "in-process"
+    results = [None] * 16
+
+    def call(i):
+        results[i] = student.generate(f"X が本を読む {i}" if i % 2 else f"X が走る {i}")
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["False", "True"] * 8
+    assert sum(batch_sizes) == 16
+    assert max(batch_sizes) > 1
+    assert len(batch_sizes) < 16
+
+def test_in_process_backend_errors_are_retried():
+    calls = []
+
+    def predict_batch(prompts):
+        calls.append(prompts)
+        if len(calls) == 1:
+            raise TimeoutError("model not ready")
+        return ["True"] * len(prompts)
+
+    student = StudentModel(backend=InProcessBackend(predict_batch), backoff=0)
+    assert student.generate("prompt") == "True"
+    assert len(calls) == 2
+
+def test_local_model_has_separate_cache_key(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite3"))
+    StudentModel(client=StubClient(lambda prompt: "False"), cache=cache).generate("prompt")
+    local = StudentModel(backend=InProcessBackend(lambda prompts: ["True"] * len(prompts)), cache=cache)
+    assert local.generate("prompt") == "True"
+
+def test_local_endpoint_backend():
+    transport = Transport()
+    with serve_stub(lambda prompt: "True") as base_url:
+        backend = LocalEndpointBackend(base_url, model="qwen2.5-1.5b-instruct", transport=transport)
+        student = StudentModel(backend=backend)
+        distillation = KnowledgeDistillation(
+            teacher=TeacherModel(client=StubClient(lambda prompt: "- xEffect: 知識が増える")), student=student
+        )
+        metrics = distillation.evaluate_inferences(["X が本を読む"])
+    assert student.model == "qwen2.5-1.5b-instruct"
+    assert metrics["validity_rate"]["xEffect"] == 1.0
+    transport.close()
@@ -0,0 +1,80 @@
+from knowledge_distillation import CorpusWriter, StubClient
+from knowledge_distillation.distillation import parse_validity_array
+
+def test_parse_validity_array_formats():
+    assert parse_validity_array("[true, false, true]", 3) == [True, False, True]
+    assert parse_validity_array('```json\n["True", "false"]\n```', 2) == [True, False]
+    assert parse_validity_array("[true]", 3) == [True, None, None]
+    assert parse_validity_array("1: True\n2. false\n", 3) == [True, False, None]
+    assert parse_validity_array("[true, maybe]", 2) == [True, None]
+    assert parse_validity_array("わかりません", 2) == [None, None]
+
+def test_batched_filter_uses_one_call_per_batch(make_distillation, inference):
+    def respond(prompt: str) -> str:
+        if "JSON配列" in prompt:
+            return "[true, false, true]"
+        return inference
+
+    client = StubClient(respond)
+    distillation = make_distillation(client)
+    metrics = distillation.evaluate_inferences(["X が本を読む"], num_samples=1, filter_batch_size=6)
+
+    assert metrics["validity_rate"]["xEffect"] == 1.0
+    assert metrics["validity_rate"]["xWant"] == 0.0
+    assert metrics["validity_rate"]["xNeed"] == 1.0
+    assert len(client.calls) == 2
+    report = distillation.filter_report()
+    assert report["student_calls"] == 1
+    assert report["calls_saved"] == 2
+
+def test_batched_filter_falls_back_for_unparseable_items(make_distillation, inference):
+    def respond(prompt: str) -> str:
+        if "JSON配列" in prompt:
+            return "[true]"
+        if "推論:" in prompt:
+            return "False"
+        return inference
+
+    client = StubClient(respond)
+    distillation = make_distillation(client)
+    metrics = distillation.evaluate_inferences(["X が本を読む"], num_samples=1, filter_batch_size=6)
+
+    assert metrics["validity_rate"]["xEffect"] == 1.0
+    assert metrics["validity_rate"]["xWant"] == 0.0
+    assert distillation.filter_report()["student_calls"] == 3
+
+def test_batches_span_events_and_keep_event_order(make_distillation):
+    events = [f"X がイベント{i}をする" for i in range(4)]
+
+    def respond(prompt: str) -> str:
+        if "JSON配列" in prompt:
+            # イベント0と2の推論だけを妥当とする
+            verdicts = ["イベント0" in block or "イベント2" in block for block in prompt.split("\n\n") if "推論:" in block]
+            return str(verdicts).lower()
+        return f"- xEffect: 結果{prompt.count('イベント')}"
+
+    client = StubClient(respond)
+    distillation = make_distillation(client)
+    metrics = distillation.evaluate_inferences(events, num_samples=4, concurrency=2, filter_batch_size=3)
+
+    assert metrics["validity_rate"]["xEffect"] == 0.5
+    assert distillation.filter_report()["student_calls"] == 2
+
+def test_batched_events_are_written_while_later_events_are_generated(tmp_path, make_distillation):
+    events = [f"X がイベント{i}をする" for i in range(6)]
+    written = []
+
+    with CorpusWriter(str(tmp_path / "triples.jsonl")) as writer:
+        def respond(prompt: str) -> str:
+            if "JSON配列" in prompt:
+                return "[true, true]"
+            if "イベント5" in prompt:
+                written.append(writer.stats["events"])
+            return "- xEffect: 結果"
+
+        distillation = make_distillation(StubClient(respond))
+        distillation.evaluate_inferences(events, num_samples=6, filter_batch_size=2, writer=writer)
+
+    # 処理中のイベントは filter_batch_size * concurrency 件までなので、最後のイベントの前に4件は書き出している
+    assert written == [4]
+    assert writer.stats["events"] == 6
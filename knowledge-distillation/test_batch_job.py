@@ -0,0 +1,135 @@
+import json
+import pytest
+from knowledge_distillation import DistillationJob, LocalBatchBackend, StubClient
+
+class CrashingBackend(LocalBatchBackend):
+    """crash_at 回目の submit で落ちるバックエンド。after_submit のときはバッチを投入した後で落ちる"""
+
+    def __init__(self, client, work_dir, crash_at=2, after_submit=False):
+        super().__init__(client, work_dir)
+        self.submits = 0
+        self.crash_at = crash_at
+        self.after_submit = after_submit
+
+    def submit(self, requests_path, name):
+        self.submits += 1
+        if self.submits == self.crash_at:
+            if self.after_submit:
+                super().submit(requests_path, name)
+            raise RuntimeError("crash")
+        return super().submit(requests_path, name)
+
+def read_accepted(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_job_writes_accepted_triples(tmp_path, respond):
+    client = StubClient(respond)
+    job = DistillationJob(str(tmp_path / "job"), LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0)
+    accepted = read_accepted(job.run(["X が本を読む", "X が走る"]))
+
+    assert len(accepted) == 4
+    assert {record["relation"] for record in accepted} == {"xEffect", "xNeed"}
+    assert {record["event"] for record in accepted} == {"X が本を読む", "X が走る"}
+    assert job.state["stage"] == "completed"
+    assert job.state["evaluated"] == 6
+    # Teacher model 2件 + Student model 6件
+    assert len(client.calls) == 8
+
+def test_job_resumes_after_crash(tmp_path, respond):
+    client = StubClient(respond)
+    job_dir = str(tmp_path / "job")
+    with pytest.raises(RuntimeError):
+        DistillationJob(job_dir, CrashingBackend(client, str(tmp_path / "batches")), poll_interval=0).run(
+            ["X が本を読む"]
+        )
+    assert len(client.calls) == 1
+
+    # 再実行では events を渡さなくても続きから再開し、Teacher model は呼び直さない
+    job = DistillationJob(job_dir, LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0)
+    assert job.state["stage"] == "student_prepared"
+    accepted = read_accepted(job.run())
+    assert [record["relation"] for record in accepted] == ["xEffect", "xNeed"]
+    assert len(client.calls) == 4
+
+def test_new_job_requires_events(tmp_path):
+    job = DistillationJob(str(tmp_path / "job"), LocalBatchBackend(StubClient(), str(tmp_path / "batches")))
+    with pytest.raises(ValueError):
+        job.run()
+
+def test_resume_does_not_resubmit_a_batch_submitted_before_the_crash(tmp_path, respond):
+    client = StubClient(respond)
+    job_dir = str(tmp_path / "job")
+    backend = CrashingBackend(client, str(tmp_path / "batches"), crash_at=1, after_submit=True)
+    with pytest.raises(RuntimeError):
+        DistillationJob(job_dir, backend, poll_interval=0).run(["X が本を読む"])
+    assert len(client.calls) == 1
+
+    job = DistillationJob(job_dir, LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0)
+    accepted = read_accepted(job.run())
+    assert [record["relation"] for record in accepted] == ["xEffect", "xNeed"]
+    # Teacher model のバッチは投入し直さない (Teacher model 1回 + Student model 3回)
+    assert len(client.calls) == 4
+
+def test_resume_after_crash_during_download_reads_results_again(tmp_path, respond):
+    client = StubClient(respond)
+    job_dir = str(tmp_path / "job")
+
+    class CrashingDownload(LocalBatchBackend):
+        def download(self, batch_id, output_path, error_path):
+            super().download(batch_id, output_path, error_path)
+            raise RuntimeError("crash")
+
+    with pytest.raises(RuntimeError):
+        DistillationJob(job_dir, CrashingDownload(client, str(tmp_path / "batches")), poll_interval=0).run(
+            ["X が本を読む"]
+        )
+
+    # 結果は取り込みを記録するまで残っているので、Teacher model のリクエストを送り直さない
+    job = DistillationJob(job_dir, LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0)
+    accepted = read_accepted(job.run())
+    assert [record["relation"] for record in accepted] == ["xEffect", "xNeed"]
+    assert len(client.calls) == 4
+    assert not list((tmp_path / "batches").glob("*.jsonl"))
+
+def test_unknown_stage_is_rejected(tmp_path):
+    job = DistillationJob(str(tmp_path / "job"), LocalBatchBackend(StubClient(), str(tmp_path / "batches")))
+    job._save_state(stage="teacher_sumbitted")
+    with pytest.raises(ValueError):
+        job.run()
+
+def test_requests_are_sharded_per_batch(tmp_path, respond):
+    client = StubClient(respond)
+    job = DistillationJob(
+        str(tmp_path / "job"), LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0,
+        max_requests_per_batch=4,
+    )
+    accepted = read_accepted(job.run(["X が本を読む", "X が走る", "X が寝る"]))
+
+    assert len(accepted) == 6
+    assert len(job.state["teacher_batches"]) == 1
+    # Student model のリクエスト 9件を 4 + 4 + 1 件に分ける
+    assert len(job.state["student_batches"]) == 3
+    assert job.state["evaluated"] == 9
+
+def test_failed_requests_are_retried_and_recorded(tmp_path, respond):
+    failures = {"関係: xEffect": 1, "関係: xNeed": 10}
+
+    def flaky(prompt: str) -> str:
+        for key in failures:
+            if key in prompt and failures[key]:
+                failures[key] -= 1
+                raise RuntimeError("server error")
+        return respond(prompt)
+
+    client = StubClient(flaky)
+    job = DistillationJob(
+        str(tmp_path / "job"), LocalBatchBackend(client, str(tmp_path / "batches")), poll_interval=0, max_retries=2
+    )
+    accepted = read_accepted(job.run(["X が本を読む"]))
+
+    # xEffect は1回目の再送で成功し、xNeed は再送しても失敗したまま記録に残る
+    assert [record["relation"] for record in accepted] == ["xEffect"]
+    assert job.state["student_failed"] == 1
+    with open(tmp_path / "job" / "student_failed_requests.jsonl") as f:
+        assert [json.loads(line)["custom_id"] for line in f] == ["event-0-xNeed"]
@@ -0,0 +1,68 @@
+import threading
+import time
+from knowledge_distillation import ResponseCache, StubClient, StudentModel, TeacherModel
+
+def test_cache_hit_skips_api_call(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite3"))
+    client = StubClient(lambda prompt: "True")
+    student = StudentModel(client=client, cache=cache)
+
+    assert student.generate("イベント: X が本を読む") == "True"
+    assert student.generate("イベント: X が本を読む") == "True"
+
+    assert len(client.calls) == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_cache_is_persistent_and_keyed_by_model(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    client = StubClient(lambda prompt: "response")
+    TeacherModel(client=client, cache=ResponseCache(path=path)).generate("prompt")
+
+    # 再起動後も同じモデルなら再利用し、別モデルでは再利用しない
+    cache = ResponseCache(path=path)
+    TeacherModel(client=client, cache=cache).generate("prompt")
+    StudentModel(client=client, cache=cache).generate("prompt")
+    assert [model for model, _ in client.calls] == ["o3-mini", "gpt-4o-mini"]
+
+def test_empty_responses_are_not_cached(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite3"))
+    client = StubClient(lambda prompt: "")
+    student = StudentModel(client=client, cache=cache)
+    student.generate("prompt")
+    student.generate("prompt")
+    assert len(client.calls) == 2
+
+def test_ttl_expires_entries():
+    cache = ResponseCache(path=":memory:", ttl=0.05)
+    key = cache.make_key("m", "p")
+    cache.set(key, "v")
+    assert cache.get(key) == "v"
+    time.sleep(0.1)
+    assert cache.get(key) is None
+
+def test_size_based_eviction_drops_least_recently_used():
+    cache = ResponseCache(path=":memory:", max_entries=10)
+    for i in range(10):
+        cache.set(f"k{i}", "v")
+        time.sleep(0.001)
+    cache.get("k0")
+    cache.set("k10", "v")
+    assert cache.stats()["entries"] <= 10
+    assert cache.get("k0") == "v"
+    assert cache.get("k1") is None
+
+def test_concurrent_identical_prompts_are_deduplicated():
+    cache = ResponseCache(path=":memory:")
+    client = StubClient(lambda prompt: "True", delay=0.1)
+    student = StudentModel(client=client, cache=cache)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(student.generate("prompt"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["True"] * 8
+    assert len(client.calls) == 1
+    assert cache.stats()["deduplicated"] == 7
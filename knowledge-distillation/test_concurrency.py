@@ -0,0 +1,83 @@
+import time
+import httpx
+import openai
+import pytest
+from knowledge_distillation import RateLimiter, StubClient, StudentModel
+
+def _status_error(cls, status: int) -> Exception:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return cls("error", response=httpx.Response(status, request=request), body=None)
+
+def test_concurrent_metrics_match_sequential(make_distillation, respond):
+    events = [f"X がイベント{i}をする" for i in range(6)]
+    sequential = make_distillation().evaluate_inferences(events, num_samples=6)
+    concurrent = make_distillation(StubClient(respond, delay=0.01)).evaluate_inferences(
+        events, num_samples=6, concurrency=4
+    )
+    assert concurrent == sequential
+    assert sequential["validity_rate"]["xEffect"] == 1.0
+    assert sequential["validity_rate"]["xWant"] == 0.0
+    assert sequential["generation_rate"]["xReact"] == 0.0
+
+def test_retry_with_backoff_recovers_from_errors():
+    attempts = []
+
+    def flaky(prompt: str) -> str:
+        attempts.append(prompt)
+        if len(attempts) < 3:
+            raise _status_error(openai.RateLimitError, 429)
+        return "True"
+
+    student = StudentModel(client=StubClient(flaky), max_retries=3, backoff=0.01)
+    assert student.generate("prompt") == "True"
+    assert len(attempts) == 3
+
+def test_retry_gives_up_after_max_retries():
+    def failing(prompt: str) -> str:
+        raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+    client = StubClient(failing)
+    student = StudentModel(client=client, max_retries=2, backoff=0.01)
+    assert student.generate("prompt") == ""
+    assert len(client.calls) == 3
+
+@pytest.mark.parametrize("error", [
+    _status_error(openai.BadRequestError, 400),
+    _status_error(openai.AuthenticationError, 401),
+    ValueError("invalid response_format"),
+])
+def test_permanent_errors_are_not_retried(error):
+    def failing(prompt: str) -> str:
+        raise error
+
+    client = StubClient(failing)
+    student = StudentModel(client=client, max_retries=2, backoff=0.01)
+    with pytest.raises(type(error)):
+        student.generate("prompt")
+    assert len(client.calls) == 1
+
+def test_server_errors_are_retried():
+    calls = []
+
+    def flaky(prompt: str) -> str:
+        calls.append(prompt)
+        if len(calls) == 1:
+            raise _status_error(openai.InternalServerError, 503)
+        return "True"
+
+    assert StudentModel(client=StubClient(flaky), backoff=0.01).generate("prompt") == "True"
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(requests_per_minute=600)  # 10 req/s、最初の600件分はバケットに入っている
+    limiter._requests = 0
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.25
+
+def test_rate_limiter_limits_tokens():
+    limiter = RateLimiter(tokens_per_minute=6000)  # 100 tokens/s
+    limiter.acquire(tokens=6000)
+    start = time.monotonic()
+    limiter.acquire(tokens=20)
+    assert time.monotonic() - start >= 0.15
@@ -0,0 +1,76 @@
+import json
+import os
+from knowledge_distillation import CorpusWriter, StubClient
+
+def test_records_are_streamed_to_jsonl(tmp_path, make_distillation):
+    path = str(tmp_path / "triples.jsonl")
+    with CorpusWriter(path) as writer:
+        make_distillation().evaluate_inferences(["X が本を読む", "X が走る"], writer=writer)
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 6
+    assert records[0] == {"event": "X が本を読む", "relation": "xEffect", "inference": "知識が増える", "valid": True}
+    assert records[1]["valid"] is False
+
+def test_restart_skips_processed_events_with_same_metrics(tmp_path, make_distillation, respond):
+    path = str(tmp_path / "triples.jsonl")
+    events = ["X が本を読む", "X が走る", "X が寝る"]
+    expected = make_distillation().evaluate_inferences(events)
+
+    with CorpusWriter(path) as writer:
+        make_distillation().evaluate_inferences(events[:2], writer=writer)
+
+    client = StubClient(respond)
+    with CorpusWriter(path) as writer:
+        metrics = make_distillation(client).evaluate_inferences(events, writer=writer)
+    assert metrics == expected
+    assert writer.stats["resumed_events"] == 2
+    # 3つ目のイベントだけを処理する (Teacher model 1回 + Student model 3回)
+    assert len(client.calls) == 4
+
+def test_unsynced_tail_is_discarded_on_restart(tmp_path):
+    path = str(tmp_path / "triples.jsonl")
+    writer = CorpusWriter(path, fsync_every=1)
+    writer.write_event("X が本を読む", {"xEffect": "知識が増える"}, {"xEffect": True})
+    # fsync 前に落ちた書きかけの行
+    writer._file.write(b'{"event": "X \xe3\x81\x8c')
+    writer._file.flush()
+
+    writer = CorpusWriter(path)
+    assert writer.is_done("X が本を読む")
+    assert not writer.is_done("X が走る")
+    writer.write_event("X が走る", {"xEffect": "疲れる"}, {"xEffect": True})
+    writer.close()
+    with open(path) as f:
+        assert [json.loads(line)["event"] for line in f] == ["X が本を読む", "X が走る"]
+
+def test_event_not_yet_synced_can_be_read(tmp_path):
+    writer = CorpusWriter(str(tmp_path / "triples.jsonl"), fsync_every=100, fsync_interval=3600)
+    writer.write_event("X が本を読む", {"xEffect": "知識が増える"}, {"xEffect": True})
+    assert writer.is_done("X が本を読む")
+    assert list(writer.read_event("X が本を読む")) == [
+        {"event": "X が本を読む", "relation": "xEffect", "inference": "知識が増える", "valid": True}
+    ]
+    writer.close()
+
+def test_missing_or_truncated_file_resets_checkpoint(tmp_path):
+    path = str(tmp_path / "triples.jsonl")
+    with CorpusWriter(path) as writer:
+        writer.write_event("X が本を読む", {"xEffect": "知識が増える"}, {"xEffect": True})
+        size = writer._file.tell()
+        writer.write_event("X が走る", {"xEffect": "疲れる"}, {"xEffect": True})
+
+    with open(path, "r+b") as f:
+        f.truncate(size + 5)
+    with CorpusWriter(path) as writer:
+        assert writer.is_done("X が本を読む")
+        assert not writer.is_done("X が走る")
+        writer.write_event("X が走る", {"xEffect": "疲れる"}, {"xEffect": True})
+    with open(path) as f:
+        assert [json.loads(line)["event"] for line in f] == ["X が本を読む", "X が走る"]
+
+    os.remove(path)
+    with CorpusWriter(path) as writer:
+        assert not writer.is_done("X が本を読む")
+        assert list(writer.read_event("X が本を読む")) == []
@@ -0,0 +1,67 @@
+import numpy as np
+from knowledge_distillation import DiversityTracker, MinHashLSH, StubClient
+from knowledge_distillation.diversity import BloomFilter, HyperLogLog, char_ngram_hashes, text_hashes
+
+def test_char_ngrams_do_not_cross_texts():
+    hashes, offsets = char_ngram_hashes(["知識が増える", "a", ""], n=2)
+    assert list(offsets) == [0, 5, 6, 7]
+    alone, _ = char_ngram_hashes(["知識が増える"], n=2)
+    assert np.array_equal(hashes[:5], alone)
+
+def test_sketches_estimate_counts():
+    hll = HyperLogLog()
+    hll.add(text_hashes(f"推論{i % 5000}" for i in range(20000)))
+    assert abs(hll.count() - 5000) / 5000 < 0.05
+
+    bloom = BloomFilter(capacity=1000)
+    seen = text_hashes(f"a{i}" for i in range(1000))
+    bloom.add(seen)
+    assert bloom.contains(seen).all()
+    assert bloom.contains(text_hashes(f"b{i}" for i in range(1000))).mean() < 0.05
+
+def test_lsh_clusters_near_duplicates_across_batches():
+    lsh = MinHashLSH()
+    first = lsh.add(["友達と映画を見に行きたい", "お腹が空いて何か食べたい"])
+    second = lsh.add(["友達と映画を見に行きたい!", "部屋を片付ける必要がある", "お腹が空いて何か食べたい"])
+    assert list(first) == [0, 1]
+    assert list(second) == [0, 3, 1]
+    assert lsh.clusters() == {"clusters": 3, "duplicate_clusters": 2, "largest_cluster": 2}
+
+def test_lsh_memory_follows_clusters_not_records():
+    lsh = MinHashLSH()
+    for _ in range(100):
+        lsh.add(["友達と映画を見に行きたい"] * 100)
+    assert lsh.records == 10000
+    assert lsh.clusters() == {"clusters": 1, "duplicate_clusters": 1, "largest_cluster": 10000}
+    assert len(lsh.cluster_sizes) < 10000
+
+def test_tracker_report():
+    tracker = DiversityTracker()
+    duplicates = tracker.add(["知識が増える", "知識が増える", "続きを読みたい"])
+    assert list(duplicates) == [False, True, False]
+    report = tracker.report()
+    assert report["distinct_texts"] == 2
+    assert report["near_duplicate_rate"] == 1 / 3
+    assert 0 < report["self_overlap"] < 1
+
+def test_near_duplicates_are_not_sent_to_student(make_distillation):
+    def respond(prompt: str) -> str:
+        if "関係:" in prompt:
+            return "True"
+        return "- xEvent: X\n- xEffect: 知識がとても増える"
+
+    client = StubClient(respond)
+    distillation = make_distillation(client, drop_near_duplicates=True)
+    metrics = distillation.evaluate_inferences(["X が本を読む", "X が新聞を読む"])
+    # Teacher model 2回 + Student model 1回 (2件目は近似重複として送らない)
+    assert len(client.calls) == 3
+    assert metrics["validity_rate"]["xEffect"] == 0.5
+    assert distillation.filter_report()["near_duplicates_dropped"] == 1
+
+def test_exact_diversity_is_opt_in(make_distillation):
+    events = [f"X がイベント{i}をする" for i in range(5)]
+    estimated = make_distillation().evaluate_inferences(events, num_samples=5)
+    exact = make_distillation().evaluate_inferences(events, num_samples=5, exact_diversity=True)
+    # 推論はすべて同じ本文なので、推論数 / 異なり数 は 5
+    assert exact["diversity"]["xEffect"] == 5.0
+    assert abs(estimated["diversity"]["xEffect"] - 5.0) < 0.1
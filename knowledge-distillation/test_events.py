@@ -0,0 +1,55 @@
+import re
+from knowledge_distillation import StubClient
+from knowledge_distillation.distillation import EVENT_THEMES, normalize_event
+
+def test_normalize_event():
+    assert normalize_event("- X が本を読む") == "X が本を読む"
+    assert normalize_event("2. Ｘ　が　走る") == "X が 走る"
+    assert normalize_event("・「X が寝る」") == "X が寝る"
+    assert normalize_event("") is None
+    assert normalize_event("### 出力") is None
+    assert normalize_event("以下がイベントです:") is None
+
+def test_events_are_topped_up_to_target_without_duplicates(make_distillation):
+    counter = iter(range(1000))
+
+    def respond(prompt: str) -> str:
+        # 応答ごとに新しいイベント2個と、既出・近似重複・箇条書きでない行を混ぜる
+        size = int(re.search(r"イベントを(\d+)個", prompt).group(1))
+        lines = ["以下のとおりです。", "", "- X が本を読む", "- X が本を読む。"]
+        lines += [f"- X が{next(counter)}番目の場所に行く" for _ in range(2)]
+        return "\n".join(lines[:size + 4])
+
+    client = StubClient(respond)
+    distillation = make_distillation(client)
+    events = distillation.generate_events(num_events=9, events_per_request=4, concurrency=2)
+
+    assert len(events) == 9
+    assert len(set(events)) == 9
+    assert events.count("X が本を読む") == 1
+    assert "X が本を読む。" not in events
+    stats = distillation.event_stats
+    assert stats["accepted"] == 9
+    assert stats["near_duplicates"] >= 1
+    # 同じプロンプトにならないよう、リクエストごとに題材を変える
+    prompts = [prompt for _, prompt in client.calls]
+    assert len(set(prompts)) == len(prompts)
+
+def test_every_theme_is_used_in_order(make_distillation):
+    client = StubClient(lambda prompt: "")
+    distillation = make_distillation(client)
+    max_requests = len(EVENT_THEMES) + 2
+    list(distillation.iter_events(1000, events_per_request=50, max_requests=max_requests, concurrency=1))
+    prompts = [prompt for _, prompt in client.calls]
+    assert len(prompts) == max_requests
+    assert "に関係する出来事" not in prompts[0]
+    for prompt, theme in zip(prompts[1:], EVENT_THEMES):
+        assert f"「{theme}」" in prompt
+    assert f"「{EVENT_THEMES[0]} (2回目)」" in prompts[-1]
+
+def test_generation_stops_at_max_requests(make_distillation):
+    client = StubClient(lambda prompt: "- X が本を読む")
+    distillation = make_distillation(client)
+    events = list(distillation.iter_events(5, max_requests=3, concurrency=1))
+    assert events == ["X が本を読む"]
+    assert len(client.calls) == 3
@@ -0,0 +1,52 @@
+import json
+from knowledge_distillation import ResponseCache, StubClient, TeacherModel
+from knowledge_distillation.distillation import RELATIONS, parse_structured_inference
+
+def test_parse_structured_inference():
+    response = '```json\n{"xEffect": "知識が増える", "xWant": " ", "xNeed": 1, "other": "x"}\n```'
+    assert parse_structured_inference(response) == {"xEffect": "知識が増える"}
+    assert parse_structured_inference('{"xEffect": "a", "xWant": "b"}', ["xWant"]) == {"xWant": "b"}
+    # JSON でない応答は行形式として読む
+    assert parse_structured_inference("- xEffect: 知識が増える\n- xEvent: X") == {"xEffect": "知識が増える"}
+    assert parse_structured_inference('{"xEffect": "壊れた') == {}
+
+def test_missing_relations_are_reasked_without_regenerating(make_distillation):
+    def respond(prompt: str) -> str:
+        if "関係:" in prompt:
+            return "True"
+        if "再質問" in prompt:
+            return json.dumps({"xWant": "続きを読みたい", "HinderedBy": "本がない"}, ensure_ascii=False)
+        # 最初の応答には xWant と HinderedBy がない
+        return json.dumps({relation: "推論" for relation in RELATIONS if relation not in ("xWant", "HinderedBy")})
+
+    client = StubClient(respond)
+    distillation = make_distillation(client, structured_output=True)
+    inferences = distillation.generate_inference("X が本を読む")
+
+    assert list(inferences) == RELATIONS
+    assert inferences["HinderedBy"] == "本がない"
+    prompts = [prompt for _, prompt in client.calls]
+    assert len(prompts) == 2
+    # 聞き直すのは足りなかった関係だけ
+    assert "xWant" in prompts[1] and "HinderedBy" in prompts[1]
+    assert "xEffect" not in prompts[1]
+    report = distillation.inference_report()
+    assert report["calls_per_event"] == 2
+    assert report["reask_rate"] == 1.0
+    assert report["completeness"] == 1.0
+
+def test_reasks_are_bounded(make_distillation):
+    client = StubClient(lambda prompt: "{}")
+    distillation = make_distillation(client, structured_output=True, max_reasks=2)
+    assert distillation.generate_inference("X が本を読む") == {}
+    report = distillation.inference_report()
+    assert report["teacher_calls"] == 3
+    assert report["missing_relations"] == len(RELATIONS)
+
+def test_response_format_is_part_of_cache_key(tmp_path):
+    client = StubClient(lambda prompt: "{}")
+    teacher = TeacherModel(client=client, cache=ResponseCache(str(tmp_path / "cache.sqlite3")))
+    teacher.generate("prompt")
+    teacher.generate("prompt", response_format={"type": "json_object"})
+    teacher.generate("prompt", response_format={"type": "json_object"})
+    assert len(client.calls) == 2
@@ -0,0 +1,29 @@
+from knowledge_distillation import StudentModel, TeacherModel, Transport, serve_stub
+
+def test_models_share_pooled_connections(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    transport = Transport()
+    with serve_stub(lambda prompt: "True") as base_url:
+        teacher = TeacherModel(base_url=base_url, transport=transport)
+        student = StudentModel(base_url=base_url, transport=transport)
+        for _ in range(3):
+            assert teacher.generate("prompt") == "True"
+            assert student.generate("prompt") == "True"
+    stats = transport.stats()
+    assert stats["requests"] == 6
+    assert stats["connections_opened"] == 1
+    assert stats["reused"] == 5
+    transport.close()
+
+def test_per_model_timeouts(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    transport = Transport(connect_timeout=2.0)
+    teacher = TeacherModel(transport=transport)
+    student = StudentModel(transport=transport)
+    assert teacher.client.timeout.read == 120.0
+    assert student.client.timeout.read == 30.0
+    assert student.client.timeout.connect == 2.0
+    assert StudentModel(transport=transport, timeout=5.0).client.timeout.read == 5.0
+    # 同じ設定のモデルは OpenAI クライアントも共有する
+    assert StudentModel(transport=transport).client is student.client
+    transport.close()
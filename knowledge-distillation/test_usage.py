@@ -0,0 +1,66 @@
+import json
+import pytest
+from knowledge_distillation import Budget, StubClient, UsageTracker
+
+@pytest.fixture
+def make_tracked(make_distillation, respond):
+    """UsageTracker(budget) で使用量を集計する KnowledgeDistillation と、その StubClient"""
+    def make(budget=None):
+        client = StubClient(respond)
+        return make_distillation(client, usage=UsageTracker(budget)), client
+    return make
+
+def test_usage_is_aggregated_per_stage_and_relation(tmp_path, make_tracked):
+    distillation, client = make_tracked()
+    distillation.evaluate_inferences(["X が本を読む", "X が走る"])
+    summary = distillation.usage.summary()
+
+    # StubClient は文字数をトークン数として返す
+    prompt_tokens = sum(len(prompt) for _, prompt in client.calls)
+    assert summary["total"]["calls"] == 8
+    assert summary["total"]["prompt_tokens"] == prompt_tokens
+    assert summary["stages"]["inference"]["calls"] == 2
+    assert summary["stages"]["filter"]["calls"] == 6
+    assert summary["relations"]["xEffect"]["calls"] == round(2 + 2 / 6, 2)
+    assert summary["models"]["o3-mini"]["cost"] > 0
+    assert summary["estimated_calls"] == 0
+
+    path = tmp_path / "summary.json"
+    distillation.usage.write_json(str(path), run=distillation.run_stats)
+    assert json.loads(path.read_text())["run"]["events"] == 2
+
+def test_batched_filter_tokens_are_split_across_relations(make_tracked):
+    distillation, _ = make_tracked()
+    distillation.evaluate_inferences(["X が本を読む"], filter_batch_size=6)
+    relations = distillation.usage.summary()["relations"]
+    assert relations["xEffect"]["calls"] == round(1 / 6 + 1 / 3, 2)
+    assert relations["xWant"]["calls"] == relations["xEffect"]["calls"]
+
+def test_budget_stops_run_with_valid_partial_metrics(make_tracked):
+    distillation, client = make_tracked(Budget(max_tokens=1))
+    metrics = distillation.evaluate_inferences(["X が本を読む", "X が走る", "X が寝る"])
+
+    # 1件目を処理したところで上限を超え、2件目以降は始めない
+    assert distillation.run_stats == {"events": 1, "resumed_events": 0, "stopped_by": "max_tokens"}
+    assert len(client.calls) == 4
+    assert metrics["generation_rate"]["xEffect"] == 1.0
+    assert metrics["validity_rate"]["xEffect"] == 1.0
+    assert distillation.usage.summary()["exceeded"] == "max_tokens"
+
+def test_budget_in_batched_mode_drains_generated_events(make_tracked):
+    distillation, _ = make_tracked(Budget(max_tokens=1))
+    metrics = distillation.evaluate_inferences(["X が本を読む", "X が走る"], filter_batch_size=2, concurrency=1)
+    # 2件目は始めないが、生成済みの1件目の推論は評価してから終える
+    assert distillation.run_stats["stopped_by"] == "max_tokens"
+    assert distillation.run_stats["events"] == 1
+    assert metrics["generation_rate"]["xEffect"] == 1.0
+    assert metrics["validity_rate"]["xWant"] == 0.0
+
+def test_throttle_estimates_events_and_filter_batches_separately(make_tracked):
+    distillation, _ = make_tracked()
+    distillation.evaluate_inferences(["X が本を読む", "X が走る", "X が寝る"], num_samples=3, filter_batch_size=3)
+    usage = distillation.usage
+    assert distillation._admitted == {"event": 3, "filter": 3}
+    # イベントの見積もりには評価のバッチのトークン数を含めない
+    assert distillation._unit_tokens("event") == usage.stage_tokens("inference")
+    assert distillation._unit_tokens("filter") == usage.stage_tokens("filter")
@@ -0,0 +1,111 @@
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+from langchain_community.embeddings.ollama import OllamaEmbeddings
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ingest import VectorWriter, ingest, iter_chunks
+
+# 文書の埋め込みのスループット (チャンク/秒) とピークメモリを、ローカルの Ollama のスタブで測る
+#
+# python bench_ingest.py --documents 1000 --latency 0.005
+
+
+@contextmanager
+def serve_stub_ollama(dim: int, latency: float) -> Iterator[str]:
+    """Ollama の /api/embeddings を返すローカルサーバ"""
+    # サーバ側の処理がボトルネックにならないよう、応答はあらかじめ作っておく
+    rng = random.Random(0)
+    bodies = [json.dumps({"embedding": [rng.random() for _ in range(dim)]}).encode() for _ in range(64)]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if latency:
+                time.sleep(latency)
+            body = bodies[hash(request["prompt"]) % len(bodies)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def documents(count: int) -> Iterator[Document]:
+    rng = random.Random(0)
+    words = ["LangSmith", "trace", "dataset", "evaluation", "prompt", "chain", "agent", "feedback", "run", "project"]
+    for i in range(count):
+        # 1割は既出の文書と同じ内容にする
+        seed = rng.randrange(i) if i and rng.random() < 0.1 else i
+        text_rng = random.Random(seed)
+        text = " ".join(text_rng.choice(words) for _ in range(400))
+        yield Document(page_content=text, metadata={"source": f"doc-{i}"})
+
+
+def run(mode: str, args: argparse.Namespace, base_url: str, queue: multiprocessing.Queue):
+    embeddings = OllamaEmbeddings(model="gemma:2b", base_url=base_url)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    start = time.perf_counter()
+    if mode == "baseline":
+        # example_retrieve.py と同じく、全チャンクを分割してからまとめて埋め込む
+        chunks = list(iter_chunks(documents(args.documents), splitter))
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+        count = len(vectors)
+    else:
+        workers = int(mode.split("=")[1])
+        with tempfile.TemporaryDirectory() as directory, VectorWriter(directory) as writer:
+            stats = ingest(documents(args.documents), embeddings, writer, splitter, args.batch_size, workers)
+            count = stats["chunks"]
+    seconds = time.perf_counter() - start
+    queue.put((count, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched, concurrent embedding ingestion")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.005, help="Stub latency per embedding request (s)")
+    parser.add_argument("--dim", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with serve_stub_ollama(args.dim, args.latency) as base_url:
+        print(f"{'mode':>12}{'chunks':>8}{'seconds':>9}{'chunks/s':>10}{'peak MB':>9}")
+        for mode in ["baseline"] + [f"workers={workers}" for workers in args.workers]:
+            # ピークメモリを比べるため、1回ずつ別のプロセスで実行する
+            queue = context.Queue()
+            process = context.Process(target=run, args=(mode, args, base_url, queue))
+            process.start()
+            count, seconds, peak = queue.get()
+            process.join()
+            print(f"{mode:>12}{count:>8}{seconds:>9.2f}{count / seconds:>10.1f}{peak:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import importlib.util
+import time
+from pathlib import Path
+
+# 保存した HTML で、常に1回で要約する場合 (stuff) と既定の設定 (長いページは map-reduce) のレイテンシと料金を比べる
+# 既定では LLM の代わりに、入出力のトークン数からレイテンシを見積もるスタブを使う (--live で実際に呼ぶ)
+#
+# python bench_summarize.py --fixtures fixtures
+
+_spec = importlib.util.spec_from_file_location("summarize_web", Path(__file__).with_name("summarize-web.py"))
+summarize_web = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(summarize_web)
+
+# claude-3-haiku の100万トークンあたりの料金 (USD, 入力・出力)
+PRICE = (0.25, 1.25)
+
+
+class MeteredChain:
+    """chain の呼び出し回数と入出力のトークン数を数える"""
+
+    def __init__(self, chain=None, base_latency: float = 0.5, input_tps: float = 20_000, output_tps: float = 150):
+        self.chain = chain
+        self.base_latency = base_latency
+        self.input_tps = input_tps
+        self.output_tps = output_tps
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    async def ainvoke(self, inputs: dict):
+        input_tokens = summarize_web.count_tokens(inputs["content"] + inputs["task"])
+        if self.chain is not None:
+            result = await self.chain.ainvoke(inputs)
+        else:
+            result = summarize_web.SummarizeOutput(
+                Who="編集部",
+                When="2024年4月",
+                What=inputs["content"][:200],
+                Where="駅前",
+                Why="再開発",
+                How="工事",
+                URL="",
+            )
+        output_tokens = summarize_web.count_tokens(result.json(ensure_ascii=False))
+        if self.chain is None:
+            await asyncio.sleep(self.base_latency + input_tokens / self.input_tps + output_tokens / self.output_tps)
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        return result
+
+    def cost(self) -> float:
+        return (self.input_tokens * PRICE[0] + self.output_tokens * PRICE[1]) / 1_000_000
+
+
+def run(content: str, chain: MeteredChain, chunk_size: int, stuff_tokens: int) -> float:
+    start = time.perf_counter()
+    summarize = summarize_web.asummarize(
+        content, chain, chunk_size=chunk_size, limit=asyncio.Semaphore(8), stuff_tokens=stuff_tokens
+    )
+    asyncio.run(summarize)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stuff vs map-reduce summarization on saved HTML")
+    parser.add_argument("--fixtures", type=Path, default=Path(__file__).with_name("fixtures"))
+    parser.add_argument("--max-stuff-tokens", type=int, default=32_000)
+    parser.add_argument("--max-chunk-tokens", type=int, default=32_000)
+    parser.add_argument("--live", action="store_true", help="Call the real model instead of the latency stub")
+    parser.add_argument("--base-latency", type=float, default=0.5, help="Stub latency per call (s)")
+    parser.add_argument("--input-tps", type=float, default=20_000, help="Stub prompt processing speed (tokens/s)")
+    parser.add_argument("--output-tps", type=float, default=150, help="Stub generation speed (tokens/s)")
+    args = parser.parse_args()
+
+    window = summarize_web.context_tokens_for()
+    chunk_size = summarize_web.chunk_size_for(max_chunk_tokens=args.max_chunk_tokens)
+    # stuff: コンテキストウィンドウに収まれば必ず1回で要約する
+    # default: summarize-web.py の既定 (--max-stuff-tokens を超えたら --max-chunk-tokens ごとに分割する)
+    modes = {"stuff": window, "default": summarize_web.stuff_tokens_for(max_stuff_tokens=args.max_stuff_tokens)}
+    print(f"{'fixture':<20}{'tokens':>8}{'mode':>12}{'calls':>7}{'seconds':>9}{'input':>9}{'output':>8}", end="")
+    print(f"{'cost($)':>10}")
+    for path in sorted(args.fixtures.glob("*.html")):
+        content = summarize_web.without_raw_text(summarize_web.extract_content(path.read_bytes()))
+        tokens = summarize_web.count_tokens(content)
+        for mode, stuff_tokens in modes.items():
+            if mode == "stuff" and tokens > window:
+                print(f"{path.stem:<20}{tokens:>8}{mode:>12}  exceeds the context window")
+                continue
+            chain = MeteredChain(
+                summarize_web.build_chain() if args.live else None, args.base_latency, args.input_tps, args.output_tps
+            )
+            seconds = run(content, chain, chunk_size, stuff_tokens)
+            print(
+                f"{path.stem:<20}{tokens:>8}{mode:>12}{chain.calls:>7}{seconds:>9.2f}{chain.input_tokens:>9}"
+                f"{chain.output_tokens:>8}{chain.cost():>10.5f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -14,17 +14,21 @@ prompt = ChatPromptTemplate.from_messages(
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_community.document_loaders import WebBaseLoader
 from langchain_community.embeddings.ollama import OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-docs = WebBaseLoader("https://docs.smith.langchain.com/user_guide").load()
+from index_store import IndexStore
 
 # ollama run gemma:2b
 embeddings = OllamaEmbeddings(model="gemma:2b")
-text_splitter = RecursiveCharacterTextSplitter()
-documents = text_splitter.split_documents(docs)
-vector = FAISS.from_documents(documents, embeddings)
+# インデックスは faiss-index/ に保存し、1日以上経っていたら取得し直して変わったページの分だけ埋め込み直す
+store = IndexStore("faiss-index/langsmith", embeddings, splitter=RecursiveCharacterTextSplitter())
+if store.exists() and not store.is_stale(max_age=24 * 60 * 60):
+    vector = store.load()
+else:
+    docs = WebBaseLoader("https://docs.smith.langchain.com/user_guide").load()
+    print(store.sync(docs))
+    vector = store.vectorstore
 
 prompt = ChatPromptTemplate.from_template(
     """Answer the following question based only on the provided context:
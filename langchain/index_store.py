@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Optional
+
+import faiss
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
+
+from ingest import embed_batches
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class IndexStore:
+    """FAISS のインデックスと docstore をディレクトリに保存し、変わったソースの文書だけを入れ替える
+
+    - index.faiss / index.pkl: FAISS.save_local と同じ形式 (読み込みは可能ならメモリマップ)
+    - manifest.json: ソース (metadata["source"]) ごとの文書のハッシュとチャンクの ID
+    - embeddings/: チャンクの内容のハッシュをキーにした埋め込みのキャッシュ (変わっていないチャンクは埋め込み直さない)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        embeddings: Embeddings,
+        splitter: Optional[TextSplitter] = None,
+        namespace: Optional[str] = None,
+        batch_size: int = 32,
+        workers: int = 4,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # モデルを変えたら別の埋め込みとして扱う
+        namespace = namespace if namespace is not None else str(getattr(embeddings, "model", ""))
+        self.embeddings = CacheBackedEmbeddings.from_bytes_store(
+            embeddings, LocalFileStore(str(self.directory / "embeddings")), namespace=namespace
+        )
+        self.splitter = splitter or RecursiveCharacterTextSplitter()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.vectorstore: Optional[FAISS] = None
+        self._read_only = False
+        manifest = self.directory / "manifest.json"
+        if manifest.exists() and self.exists():
+            self.manifest = json.loads(manifest.read_text())
+        else:
+            self.manifest = {"sources": {}, "updated_at": None}
+
+    def exists(self) -> bool:
+        return (self.directory / "index.faiss").exists() and (self.directory / "index.pkl").exists()
+
+    def is_stale(self, max_age: float) -> bool:
+        updated_at = self.manifest["updated_at"]
+        return updated_at is None or time.time() - updated_at > max_age
+
+    def load(self, mmap: bool = True) -> FAISS:
+        """保存したインデックスを読み込む。mmap のときはファイルをメモリマップし、読み込みだけで済ませる"""
+        path = str(self.directory / "index.faiss")
+        self._read_only = False
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                self._read_only = True
+            except RuntimeError:
+                # メモリマップに対応しない種類のインデックスは通常どおり読む
+                index = None
+        if index is None:
+            index = faiss.read_index(path)
+        # index.pkl は自分で保存したものだけを読む (FAISS.load_local の allow_dangerous_deserialization と同じ前提)
+        with open(self.directory / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        self.vectorstore = FAISS(self.embeddings, index, docstore, index_to_docstore_id)
+        return self.vectorstore
+
+    def sync(self, documents: Iterable[Document]) -> dict[str, int]:
+        """documents を保存済みのインデックスに反映する
+
+        ソースごとに文書のハッシュを比べ、変わったソースのチャンクだけを削除して追加し直す。
+        documents に含まれないソースは削除する。
+        """
+        groups: dict[str, list[Document]] = defaultdict(list)
+        for document in documents:
+            groups[str(document.metadata.get("source", ""))].append(document)
+
+        sources = self.manifest["sources"]
+        stats = {"sources_unchanged": 0, "sources_updated": 0, "sources_removed": 0}
+        deleted: list[str] = []
+        added: list[Document] = []
+        added_ids: list[str] = []
+        for source in list(sources):
+            if source not in groups:
+                deleted.extend(sources.pop(source)["ids"])
+                stats["sources_removed"] += 1
+        for source, docs in groups.items():
+            digest = _digest(*(json.dumps([d.page_content, d.metadata], sort_keys=True, default=str) for d in docs))
+            entry = sources.get(source)
+            if entry is not None and entry["hash"] == digest:
+                stats["sources_unchanged"] += 1
+                continue
+            if entry is not None:
+                deleted.extend(entry["ids"])
+            chunks = self.splitter.split_documents(docs)
+            ids = [_digest(source, str(i), chunk.page_content) for i, chunk in enumerate(chunks)]
+            sources[source] = {"hash": digest, "ids": ids}
+            added.extend(chunks)
+            added_ids.extend(ids)
+            stats["sources_updated"] += 1
+        stats["chunks_deleted"] = len(deleted)
+        stats["chunks_added"] = len(added)
+        if not deleted and not added and self.exists():
+            if self.vectorstore is None:
+                self.load()
+            self._save_manifest()
+            return stats
+
+        if self.vectorstore is None and self.exists():
+            self.load(mmap=False)
+        elif self._read_only:
+            # メモリマップしたインデックスは変更できないので読み直す
+            self.load(mmap=False)
+        if self.vectorstore is None and not added:
+            raise ValueError("No documents to index.")
+        if self.vectorstore is not None:
+            # 前回の保存がインデックスの後、マニフェストの前で止まった場合に備え、
+            # インデックスにある ID だけを消し、すでにある ID は追加しない (ID はチャンクの内容のハッシュ)
+            existing = set(self.vectorstore.index_to_docstore_id.values())
+            deleted = [id_ for id_ in deleted if id_ in existing]
+            if deleted:
+                self.vectorstore.delete(deleted)
+            existing.difference_update(deleted)
+            kept = [(chunk, id_) for chunk, id_ in zip(added, added_ids) if id_ not in existing]
+            added = [chunk for chunk, _ in kept]
+            added_ids = [id_ for _, id_ in kept]
+        self._add(added, added_ids)
+        self.save()
+        return stats
+
+    def _add(self, chunks: list[Document], ids: list[str]):
+        """チャンクをバッチに分けて並列に埋め込み、float32 の配列のままインデックスに追加する"""
+        ids_iter = iter(ids)
+        for batch, vectors in embed_batches(chunks, self.embeddings, self.batch_size, self.workers):
+            batch_ids = [next(ids_iter) for _ in batch]
+            text_embeddings = list(zip((chunk.page_content for chunk in batch), vectors))
+            metadatas = [chunk.metadata for chunk in batch]
+            if self.vectorstore is None:
+                self.vectorstore = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas, batch_ids)
+            else:
+                self.vectorstore.add_embeddings(text_embeddings, metadatas, batch_ids)
+
+    def save(self):
+        if self.vectorstore is None:
+            raise ValueError("Nothing to save.")
+        # 一時ディレクトリに書いてから入れ替え、書きかけのファイルを読まないようにする。マニフェストは最後に書く
+        tmp = self.directory / "index.tmp"
+        self.vectorstore.save_local(str(tmp))
+        for name in ("index.faiss", "index.pkl"):
+            os.replace(tmp / name, self.directory / name)
+        tmp.rmdir()
+        self._save_manifest()
+
+    def _save_manifest(self):
+        self.manifest["updated_at"] = time.time()
+        tmp = self.directory / "manifest.json.tmp"
+        tmp.write_text(json.dumps(self.manifest, ensure_ascii=False))
+        os.replace(tmp, self.directory / "manifest.json")
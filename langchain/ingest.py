@@ -0,0 +1,237 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
+
+
+def iter_chunks(documents: Iterable[Document], splitter: Optional[TextSplitter] = None) -> Iterator[Document]:
+    """文書を1つずつ分割してチャンクを返す (全文書を先に読み込まない)"""
+    splitter = splitter or RecursiveCharacterTextSplitter()
+    for document in documents:
+        yield from splitter.split_documents([document])
+
+
+def chunk_id(chunk: Document) -> str:
+    """チャンクの本文の 8 バイトのハッシュ (16 進)。重複の除去と、再開時に書き出し済みかの判定に使う"""
+    return hashlib.blake2b(chunk.page_content.encode(), digest_size=8).hexdigest()
+
+
+class BloomFilter:
+    """既出のキーの判定 (偽陽性はあるが偽陰性はない)。メモリは capacity と error_rate だけで決まり、件数では増えない"""
+
+    def __init__(self, capacity: int = 10_000_000, error_rate: float = 0.001):
+        bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = 1 << max(bits - 1, 1).bit_length()
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8)
+
+    def add(self, key: str) -> bool:
+        """key を追加し、初めて見たキーなら True を返す"""
+        # キーはハッシュの 16 進なので、そのまま2つのハッシュ値に分けてダブルハッシングする
+        value = int(key, 16)
+        h1, h2 = value & 0xFFFFFFFF, (value >> 32) | 1
+        new = False
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) & (self.size - 1)
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        return new
+
+
+def dedupe(
+    chunks: Iterable[Document], stats: Optional[dict] = None, seen: Optional[BloomFilter] = None
+) -> Iterator[Document]:
+    """本文が既出のチャンクを飛ばす。既出かどうかは大きさが固定の BloomFilter で判定する
+
+    偽陽性の分 (既定では 0.1%) だけ初出のチャンクも飛ばすので、飛ばした件数は stats["possible_duplicates"] に数える。
+    """
+    seen = seen if seen is not None else BloomFilter()
+    for chunk in chunks:
+        if not seen.add(chunk_id(chunk)):
+            if stats is not None:
+                stats["possible_duplicates"] = stats.get("possible_duplicates", 0) + 1
+            continue
+        yield chunk
+
+
+def embed_batches(
+    chunks: Iterable[Document],
+    embeddings: Embeddings,
+    batch_size: int = 32,
+    workers: int = 4,
+    max_pending: Optional[int] = None,
+) -> Iterator[tuple[list[Document], np.ndarray]]:
+    """チャンクを batch_size 件ずつ workers 並列で埋め込み、(チャンク, float32 の配列 (件数, 次元)) を入力の順に返す
+
+    処理中のバッチは max_pending (既定 workers * 2) 件までにし、それ以上は前のバッチが返されるまでチャンクを読まない。
+    """
+    max_pending = max_pending or workers * 2
+    iterator = iter(chunks)
+
+    def next_batch() -> list[Document]:
+        batch = []
+        for chunk in iterator:
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                break
+        return batch
+
+    def embed(batch: list[Document]) -> np.ndarray:
+        return np.asarray(embeddings.embed_documents([chunk.page_content for chunk in batch]), dtype=np.float32)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: deque[tuple[list[Document], Future]] = deque()
+        while True:
+            while len(pending) < max_pending and (batch := next_batch()):
+                pending.append((batch, executor.submit(embed, batch)))
+            if not pending:
+                return
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+
+class VectorWriter:
+    """埋め込みを directory に書き出す。ベクトルは float32 の連続した1つのファイル、チャンクは JSONL
+
+    vectors() はファイルをメモリマップした (件数, 次元) の配列を返すので、メモリに載らない件数でも扱える。
+    件数は書き込みのたびに数えるので、close() の前でもそれまでに書いた分を返す (meta.json の件数は close() で書く)。
+    既存の出力には追記する。途中で止まった場合は、ベクトルとチャンクの両方が揃っている件数まで切り詰めて続きから書く。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+        self.dim: Optional[int] = None
+        meta = self.directory / "meta.json"
+        if meta.exists():
+            self.dim = json.loads(meta.read_text())["dim"]
+        self._resume()
+        self._vectors = open(self.directory / "vectors.f32", "ab")
+        self._chunks = open(self.directory / "chunks.jsonl", "a", encoding="utf-8")
+
+    def _resume(self):
+        vectors_path = self.directory / "vectors.f32"
+        chunks_path = self.directory / "chunks.jsonl"
+        if self.dim is None:
+            # 次元がわからない (最初の書き込みの前に止まった) ときは最初から書く
+            for path in (vectors_path, chunks_path):
+                if path.exists():
+                    os.truncate(path, 0)
+            return
+        stored = os.path.getsize(vectors_path) // (self.dim * 4) if vectors_path.exists() else 0
+        offset = 0
+        if chunks_path.exists():
+            with open(chunks_path, "rb") as f:
+                for line in f:
+                    if self.count == stored or not line.endswith(b"\n"):
+                        break
+                    self.count += 1
+                    offset += len(line)
+            os.truncate(chunks_path, offset)
+        if vectors_path.exists():
+            os.truncate(vectors_path, self.count * self.dim * 4)
+
+    def write(self, chunks: list[Document], vectors: np.ndarray):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._write_meta()
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension changed from {self.dim} to {vectors.shape[1]}")
+        self._vectors.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        for chunk in chunks:
+            record = {"id": chunk_id(chunk), "text": chunk.page_content, "metadata": chunk.metadata}
+            self._chunks.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += len(chunks)
+
+    def written_ids(self) -> Iterator[str]:
+        """書き出し済みのチャンクの ID をファイルから順に読む (メモリには持たない)"""
+        self._chunks.flush()
+        with open(self.directory / "chunks.jsonl", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)["id"]
+
+    def _write_meta(self):
+        tmp = self.directory / "meta.json.tmp"
+        tmp.write_text(json.dumps({"count": self.count, "dim": self.dim}))
+        os.replace(tmp, self.directory / "meta.json")
+
+    def close(self):
+        self._vectors.close()
+        self._chunks.close()
+        self._write_meta()
+
+    def vectors(self) -> np.ndarray:
+        if not self._vectors.closed:
+            self._vectors.flush()
+        if not self.count:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        shape = (self.count, self.dim)
+        return np.memmap(self.directory / "vectors.f32", dtype=np.float32, mode="r", shape=shape)
+
+    def __enter__(self) -> "VectorWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def ingest(
+    documents: Iterable[Document],
+    embeddings: Embeddings,
+    writer: VectorWriter,
+    splitter: Optional[TextSplitter] = None,
+    batch_size: int = 32,
+    workers: int = 4,
+    max_pending: Optional[int] = None,
+    seen: Optional[BloomFilter] = None,
+) -> dict:
+    """文書を 分割 → 重複の除去 → 埋め込み の順に流し、writer に書き出す
+
+    writer に書き出し済みのチャンクは飛ばすので、途中で止まっても同じ文書を流し直せば続きから再開する。
+    同じ順に流し直したチャンクのうち、書き出し済みのものと順に一致したものは stats["resumed_chunks"] に、
+    それ以外で既出と判定したもの (Bloom filter の偽陽性を含む) は stats["possible_duplicates"] に数える。
+    """
+    stats = {"documents": 0, "chunks": 0, "possible_duplicates": 0, "resumed_chunks": 0, "batches": 0}
+    seen = seen if seen is not None else BloomFilter()
+    for key in writer.written_ids():
+        seen.add(key)
+    start = time.perf_counter()
+
+    def counted(documents: Iterable[Document]) -> Iterator[Document]:
+        for document in documents:
+            stats["documents"] += 1
+            yield document
+
+    def skip_written(chunks: Iterable[Document]) -> Iterator[Document]:
+        # 書き出し済みの ID をファイルから順に読み、前回と同じ順に流れてきたチャンクを飛ばす
+        written = itertools.islice(writer.written_ids(), writer.count)
+        expected = next(written, None)
+        for chunk in chunks:
+            if expected is not None and chunk_id(chunk) == expected:
+                stats["resumed_chunks"] += 1
+                expected = next(written, None)
+                continue
+            yield chunk
+
+    chunks = dedupe(skip_written(iter_chunks(counted(documents), splitter)), stats, seen)
+    for batch, vectors in embed_batches(chunks, embeddings, batch_size, workers, max_pending):
+        writer.write(batch, vectors)
+        stats["chunks"] += len(batch)
+        stats["batches"] += 1
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    stats["chunks_per_second"] = round(stats["chunks"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+    return stats
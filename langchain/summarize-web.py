@@ -1,17 +1,41 @@
 import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
 import warnings
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import AbstractAsyncContextManager, asynccontextmanager, nullcontext
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, Optional, TextIO
+from urllib.parse import urlsplit
 
+import httpx
+import tiktoken
 import trafilatura
-from langchain.cache import SQLiteCache
 from langchain_anthropic import ChatAnthropic
-from langchain_core.globals import set_llm_cache
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.runnables import Runnable
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from web_cache import WebCache, content_hash, html_hash
 
-def fetch_content(url: str) -> str:
-    downloaded = trafilatura.fetch_url(url)
-    content = trafilatura.extract(downloaded, include_links=True, output_format="json")
+MODEL_NAME = "claude-3-haiku-20240307"
+TASK = "contentを日本語で整理しなさい。"
+REDUCE_TASK = "contentは同じWebページを分割してそれぞれ整理した結果です。1つに統合し、日本語で整理しなさい。"
+# モデルが一度に受け取れるトークン数
+CONTEXT_WINDOWS = {"claude-3-haiku-20240307": 200_000}
+# プロンプトの定型部分と出力のために空けておくトークン数
+RESERVED_TOKENS = 8_000
+USER_AGENT = "Mozilla/5.0 (compatible; summarize-web)"
+
+
+def extract_content(html: Optional[str | bytes]) -> str:
+    content = trafilatura.extract(html, include_links=True, output_format="json")
     if content is None:
         raise ValueError("Failed to extract content from the URL.")
     return content
@@ -27,8 +51,8 @@ class SummarizeOutput(BaseModel):
     URL: str = Field(description="url")
 
 
-def summarize(content: str) -> SummarizeOutput:
-    llm = ChatAnthropic(model_name="claude-3-haiku-20240307", temperature=0)
+def build_chain() -> Runnable:
+    llm = ChatAnthropic(model_name=MODEL_NAME, temperature=0)
     structured_llm = llm.with_structured_output(SummarizeOutput)
     prompt = PromptTemplate(
         template="""
@@ -39,23 +63,440 @@ def summarize(content: str) -> SummarizeOutput:
         """,
         input_variables=[],
     )
-    chain = prompt | structured_llm
-    result = chain.invoke({"task": "contentを日本語で整理しなさい。", "content": content})
+    return prompt | structured_llm
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    # Claude のトークナイザは公開されていないので、近い cl100k_base で数える
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text, disallowed_special=()))
+
+
+def context_tokens_for(model: str = MODEL_NAME) -> int:
+    """1回の呼び出しに渡せる本文のトークン数 (コンテキストウィンドウから定型部分と出力の分を引いたもの)"""
+    return max(1_000, CONTEXT_WINDOWS.get(model, 8_000) - RESERVED_TOKENS)
+
+
+def chunk_size_for(model: str = MODEL_NAME, max_chunk_tokens: int = 32_000) -> int:
+    """分割するときの1つの部分のトークン数
+
+    コンテキストウィンドウに収まる範囲で、max_chunk_tokens までにする
+    (長すぎるプロンプトは遅く、途中の情報を落としやすい)。
+    """
+    return min(context_tokens_for(model), max(1_000, max_chunk_tokens))
+
+
+def stuff_tokens_for(model: str = MODEL_NAME, max_stuff_tokens: int = 32_000) -> int:
+    """分割せずに1回で要約する本文のトークン数の上限
+
+    コンテキストウィンドウに収まっても、長いプロンプトは遅く料金も高いので、max_stuff_tokens を超えたら分割する。
+    """
+    return min(context_tokens_for(model), max(1_000, max_stuff_tokens))
+
+
+def without_raw_text(content: str) -> str:
+    """trafilatura の JSON から raw_text を除く (text とほぼ同じ内容なので、両方を渡すと入力が倍になる)"""
+    try:
+        fields = json.loads(content)
+    except json.JSONDecodeError:
+        return content
+    if not isinstance(fields, dict) or "raw_text" not in fields or not fields.get("text"):
+        return content
+    del fields["raw_text"]
+    return json.dumps(fields, ensure_ascii=False)
+
+
+def split_content(content: str, chunk_size: int, overlap: int = 200) -> list[str]:
+    """本文 (trafilatura の JSON) を chunk_size トークン以下に分割する。収まるならそのまま1つで返す
+
+    分割した各部分には、タイトルなどのメタデータと何番目の部分かを付ける。前後の部分とは overlap トークン重ねる。
+    """
+    if count_tokens(content) <= chunk_size:
+        return [content]
+    try:
+        fields = json.loads(content)
+    except json.JSONDecodeError:
+        fields = {"text": content}
+    if not isinstance(fields, dict):
+        fields = {"text": content}
+    # フォーラムのスレッドなどはコメントも本文として扱う
+    body = "\n\n".join(part for part in (fields.get("text"), fields.get("comments")) if part)
+    metadata = {key: value for key, value in fields.items() if key not in ("text", "comments", "raw_text")}
+    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base",
+        chunk_size=max(chunk_size - count_tokens(json.dumps(metadata, ensure_ascii=False)) - 50, 100),
+        chunk_overlap=overlap,
+        separators=["\n\n", "\n", "。", "、", " ", ""],
+    )
+    chunks = splitter.split_text(body)
+    return [
+        json.dumps({**metadata, "part": f"{i}/{len(chunks)}", "text": chunk}, ensure_ascii=False)
+        for i, chunk in enumerate(chunks, start=1)
+    ]
+
+
+def summarize(content: str, chain: Optional[Runnable] = None, chunk_size: Optional[int] = None) -> SummarizeOutput:
+    return asyncio.run(asummarize(content, chain or build_chain(), chunk_size=chunk_size))
+
+
+async def asummarize(
+    content: str,
+    chain: Runnable,
+    chunk_size: Optional[int] = None,
+    limit: Optional[AbstractAsyncContextManager] = None,
+    stuff_tokens: Optional[int] = None,
+) -> SummarizeOutput:
+    """本文を要約する。長い本文は分割して並列に要約し (map)、その結果を統合する (reduce)
+
+    stuff_tokens (既定は stuff_tokens_for()) に収まる本文は分割せずに1回で要約する。
+    limit (asyncio.Semaphore など) を渡すと、LLM の呼び出しごとにそれで同時実行数を制限する。
+    """
+    content = without_raw_text(content)
+    stuff_tokens = stuff_tokens or stuff_tokens_for()
+    if count_tokens(content) <= stuff_tokens:
+        return await _invoke(chain, TASK, content, limit)
+    chunk_size = min(chunk_size or chunk_size_for(), stuff_tokens)
+    chunks = split_content(content, chunk_size)
+    if len(chunks) == 1:
+        return await _invoke(chain, TASK, content, limit)
+    partials = await asyncio.gather(*(_invoke(chain, TASK, chunk, limit) for chunk in chunks))
+    return await _reduce(chain, list(partials), chunk_size, limit)
+
+
+async def _reduce(
+    chain: Runnable,
+    partials: list[SummarizeOutput],
+    chunk_size: int,
+    limit: Optional[AbstractAsyncContextManager],
+) -> SummarizeOutput:
+    # 部分ごとの結果が1回に収まらなければ、収まる単位でまとめてから統合する
+    groups: list[list[str]] = [[]]
+    tokens = 0
+    for partial in partials:
+        text = partial.json(ensure_ascii=False)
+        size = count_tokens(text)
+        if groups[-1] and tokens + size > chunk_size:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(text)
+        tokens += size
+    if len(groups) == len(partials):
+        # 1件ずつしかまとめられないときは、それ以上小さくならないので一度に統合する
+        groups = [[text for group in groups for text in group]]
+    reduced = await asyncio.gather(
+        *(_invoke(chain, REDUCE_TASK, "[" + ",\n".join(group) + "]", limit) for group in groups)
+    )
+    if len(reduced) == 1:
+        return reduced[0]
+    return await _reduce(chain, list(reduced), chunk_size, limit)
+
+
+async def _invoke(
+    chain: Runnable, task: str, content: str, limit: Optional[AbstractAsyncContextManager]
+) -> SummarizeOutput:
+    async with limit or nullcontext():
+        result = await chain.ainvoke({"task": task, "content": content})
     if not isinstance(result, SummarizeOutput):
         raise ValueError("The output is not a valid SummarizeOutput object.")
     return result
 
 
-warnings.filterwarnings("ignore")
-set_llm_cache(SQLiteCache())
+def summary_version() -> str:
+    """要約のキャッシュのキーに含めるバージョン (出力の形式・タスク・モデルが変わったら変わる)"""
+    payload = json.dumps(
+        [SummarizeOutput.schema(), TASK, REDUCE_TASK, MODEL_NAME], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class BatchError(Exception):
+    """バッチ処理で1つのURLが失敗した理由 (kind ごとに集計する)"""
+
+    def __init__(self, kind: str, message: str = ""):
+        super().__init__(message)
+        self.kind = kind
+
+
+class HostLimiter:
+    """同じホストへの同時接続数と、リクエストの間隔を制限する"""
+
+    def __init__(self, per_host: int = 2, interval: float = 1.0):
+        self.per_host = per_host
+        self.interval = interval
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._next_start: dict[str, float] = {}
+
+    @asynccontextmanager
+    async def limit(self, host: str) -> AsyncIterator[None]:
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.per_host))
+        async with semaphore:
+            now = asyncio.get_running_loop().time()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+def read_urls(source: TextIO) -> Iterator[str]:
+    for line in source:
+        url = line.strip()
+        if url and not url.startswith("#"):
+            yield url
+
+
+class BatchSummarizer:
+    """URLを並列に取得・抽出・要約し、終わったものから SummarizeOutput を JSONL で書き出す
+
+    取得は非同期の HTTP 接続プール、抽出 (trafilatura は CPU を使う) はプロセスプール、要約は1つの chain で行う。
+    cache を渡すと、変わっていないページは条件付き GET と本文のハッシュで解決し、抽出と LLM の呼び出しを省く。
+    """
+
+    def __init__(
+        self,
+        chain: Runnable,
+        executor: Optional[Executor],
+        output: TextIO,
+        concurrency: int = 32,
+        llm_concurrency: int = 8,
+        per_host: int = 2,
+        host_interval: float = 1.0,
+        timeout: float = 20.0,
+        cache: Optional[WebCache] = None,
+        chunk_size: Optional[int] = None,
+        stuff_tokens: Optional[int] = None,
+    ):
+        self.chain = chain
+        self.executor = executor
+        self.output = output
+        self.concurrency = concurrency
+        self.llm_concurrency = llm_concurrency
+        self.hosts = HostLimiter(per_host, host_interval)
+        self.timeout = timeout
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.stuff_tokens = stuff_tokens
+        self.succeeded = 0
+        self.failures: Counter[str] = Counter()
+        self._llm = asyncio.Semaphore(llm_concurrency)
+
+    async def run(self, urls: Iterator[str]) -> dict:
+        start = time.perf_counter()
+        # URLの読み込みは処理に合わせて進め、一度に全件をメモリに載せない
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=self.concurrency * 2)
+        async with self._client() as client:
+            workers = [asyncio.create_task(self._worker(client, queue)) for _ in range(self.concurrency)]
+            # 標準入力などの読み込みはブロックするので、イベントループを止めないよう別スレッドで読む
+            while (url := await asyncio.to_thread(next, urls, None)) is not None:
+                await queue.put(url)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        return self.stats(time.perf_counter() - start)
+
+    async def summarize_url(self, url: str) -> SummarizeOutput:
+        async with self._client() as client:
+            return await self.process(client, url)
+
+    def _client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        return httpx.AsyncClient(
+            limits=limits, timeout=self.timeout, follow_redirects=True, headers={"User-Agent": USER_AGENT}
+        )
+
+    async def _worker(self, client: httpx.AsyncClient, queue: "asyncio.Queue[Optional[str]]"):
+        while (url := await queue.get()) is not None:
+            try:
+                summary = await self.process(client, url)
+            except BatchError as e:
+                self.failures[e.kind] += 1
+                print(f"FAILED {url}: {e.kind} {e}".rstrip(), file=sys.stderr)
+                continue
+            except Exception as e:
+                # 想定外の例外でもワーカーを止めない (止まるとキューが詰まり、URLの読み込みが進まなくなる)
+                self.failures["unexpected_error"] += 1
+                print(f"FAILED {url}: unexpected_error {e!r}", file=sys.stderr)
+                continue
+            self.succeeded += 1
+            self.output.write(summary.json(ensure_ascii=False) + "\n")
+            self.output.flush()
+
+    async def process(self, client: httpx.AsyncClient, url: str) -> SummarizeOutput:
+        content = await self.fetch_content(client, url)
+        key = content_hash(content)
+        cached = self.cache.get_summary(key) if self.cache is not None else None
+        if cached is not None:
+            summary = SummarizeOutput.parse_raw(cached)
+        else:
+            try:
+                summary = await asummarize(
+                    content, self.chain, chunk_size=self.chunk_size, limit=self._llm, stuff_tokens=self.stuff_tokens
+                )
+            except Exception as e:
+                raise BatchError("summarize_error", repr(e)) from e
+            if self.cache is not None:
+                self.cache.put_summary(key, summary.json(ensure_ascii=False))
+        # 入力と突き合わせられるよう、URL は要約対象のものにする
+        return summary.copy(update={"URL": url})
+
+    async def fetch_content(self, client: httpx.AsyncClient, url: str) -> str:
+        headers = self.cache.conditional_headers(url) if self.cache is not None else {}
+        response = await self.fetch(client, url, headers)
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            content = self.cache.not_modified_content(url) if self.cache is not None else None
+            if content is not None:
+                return content
+            # 本文がキャッシュから消えていたら取得し直す
+            response = await self.fetch(client, url)
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                raise BatchError("fetch_error", "304 without a conditional request")
+        # 文字コードの判定は trafilatura に任せる
+        html = response.content
+        page_hash = html_hash(html)
+        content = self.cache.get_content(page_hash) if self.cache is not None else None
+        if content is None:
+            try:
+                content = await asyncio.get_running_loop().run_in_executor(self.executor, extract_content, html)
+            except ValueError as e:
+                raise BatchError("extract_empty", str(e)) from e
+            except Exception as e:
+                raise BatchError("extract_error", repr(e)) from e
+            if self.cache is not None:
+                self.cache.put_content(page_hash, content)
+        if self.cache is not None:
+            self.cache.put_fetch(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), page_hash)
+        return content
+
+    async def fetch(self, client: httpx.AsyncClient, url: str, headers: Optional[dict] = None) -> httpx.Response:
+        try:
+            host = urlsplit(url).hostname
+        except ValueError:
+            host = None
+        if host is None:
+            raise BatchError("invalid_url")
+        try:
+            async with self.hosts.limit(host):
+                response = await client.get(url, headers=headers)
+            if response.status_code != httpx.codes.NOT_MODIFIED:
+                response.raise_for_status()
+        except httpx.TimeoutException as e:
+            raise BatchError("fetch_timeout", repr(e)) from e
+        except httpx.HTTPStatusError as e:
+            raise BatchError(f"http_{e.response.status_code}") from e
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise BatchError("fetch_error", repr(e)) from e
+        return response
+
+    def stats(self, seconds: float) -> dict:
+        total = self.succeeded + sum(self.failures.values())
+        return {
+            "urls": total,
+            "succeeded": self.succeeded,
+            "failed": total - self.succeeded,
+            "failures": dict(self.failures.most_common()),
+            "seconds": round(seconds, 2),
+            "urls_per_minute": round(total / seconds * 60, 1) if seconds else 0.0,
+            **({"cache": self.cache.stats()} if self.cache is not None else {}),
+        }
+
+
+def make_cache(args: argparse.Namespace) -> Optional[WebCache]:
+    if args.no_cache:
+        return None
+    return WebCache(
+        args.cache,
+        schema_version=summary_version(),
+        max_fetches=args.cache_size,
+        max_contents=args.cache_size,
+        max_summaries=args.cache_size,
+    )
+
+
+def run_batch(args: argparse.Namespace, cache: Optional[WebCache]) -> dict:
+    source = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8")
+    output = sys.stdout if args.output is None else open(args.output, "a", encoding="utf-8")
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            summarizer = BatchSummarizer(
+                build_chain(),
+                executor,
+                output,
+                concurrency=args.concurrency,
+                llm_concurrency=args.llm_concurrency,
+                per_host=args.per_host,
+                host_interval=args.host_interval,
+                timeout=args.timeout,
+                cache=cache,
+                chunk_size=chunk_size_for(max_chunk_tokens=args.max_chunk_tokens),
+                stuff_tokens=stuff_tokens_for(max_stuff_tokens=args.max_stuff_tokens),
+            )
+            return asyncio.run(summarizer.run(read_urls(source)))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def main():
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Webページを要約します")
+    parser.add_argument("url", type=str, help="要約するWebページのURL", nargs="?")
+    parser.add_argument("--batch", type=str, help="URLを1行ずつ書いたファイル (- で標準入力) をまとめて要約する")
+    parser.add_argument("--output", type=str, help="バッチの結果 (JSONL) の追記先 (省略すると標準出力)")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に処理するURLの数")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="同時に実行する LLM の呼び出しの数")
+    parser.add_argument("--per-host", type=int, default=2, help="同じホストへの同時接続数")
+    parser.add_argument("--host-interval", type=float, default=1.0, help="同じホストへのリクエストの間隔 (秒)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="本文抽出のプロセス数")
+    parser.add_argument("--timeout", type=float, default=20.0, help="1回の取得のタイムアウト (秒)")
+    parser.add_argument(
+        "--max-stuff-tokens",
+        type=int,
+        default=32_000,
+        help="分割せずに1回で要約するページのトークン数の上限 (コンテキストウィンドウまで)",
+    )
+    parser.add_argument(
+        "--max-chunk-tokens", type=int, default=32_000, help="長いページを分割するときの1つのトークン数"
+    )
+    parser.add_argument("--cache", type=str, default=".web_cache.sqlite3", help="取得・本文・要約のキャッシュ")
+    parser.add_argument("--cache-size", type=int, default=100_000, help="キャッシュの段ごとの上限の件数")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュを使わない")
+    arg = parser.parse_args()
+    if arg.batch is None and arg.url is None:
+        parser.print_help()
+        exit(0)
+
+    cache = make_cache(arg)
+    try:
+        if arg.batch is not None:
+            stats = run_batch(arg, cache)
+            print(json.dumps(stats, ensure_ascii=False), file=sys.stderr)
+            return
+        summarizer = BatchSummarizer(
+            build_chain(),
+            None,
+            sys.stdout,
+            concurrency=1,
+            timeout=arg.timeout,
+            cache=cache,
+            chunk_size=chunk_size_for(max_chunk_tokens=arg.max_chunk_tokens),
+            stuff_tokens=stuff_tokens_for(max_stuff_tokens=arg.max_stuff_tokens),
+        )
+        try:
+            summary = asyncio.run(summarizer.summarize_url(arg.url))
+        except BatchError as e:
+            raise SystemExit(f"Failed to summarize {arg.url}: {e.kind} {e}".rstrip()) from e
+        print(summary.json(indent=4, ensure_ascii=False))
+    finally:
+        if cache is not None:
+            cache.close()
 
-parser = argparse.ArgumentParser(description="Webページを要約します")
-parser.add_argument("url", type=str, help="要約するWebページのURL", nargs="?")
-arg = parser.parse_args()
-if arg.url is None:
-    parser.print_help()
-    exit(0)
 
-content = fetch_content(arg.url)
-summary = summarize(content)
-print(summary.json(indent=4, ensure_ascii=False))
+if __name__ == "__main__":
+    main()
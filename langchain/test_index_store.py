@@ -0,0 +1,86 @@
+import pytest
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from index_store import IndexStore
+
+
+def make_store(directory, embeddings) -> IndexStore:
+    splitter = RecursiveCharacterTextSplitter(chunk_size=30, chunk_overlap=0)
+    return IndexStore(str(directory), embeddings, splitter=splitter, batch_size=2, workers=2)
+
+
+def page(source: str, text: str) -> Document:
+    return Document(page_content=text, metadata={"source": source})
+
+
+def indexed_sources(store: IndexStore) -> list[str]:
+    docstore = store.vectorstore.docstore
+    return sorted(docstore.search(id_).metadata["source"] for id_ in store.vectorstore.index_to_docstore_id.values())
+
+
+A = page("a", "りんごは赤い果物です。\n\n甘くて、そのまま食べたりジャムにしたりします。")
+B = page("b", "みかんは冬の果物です。")
+B2 = page("b", "みかんは冬においしい果物です。")
+C = page("c", "ぶどうは房になる果物です。")
+
+
+def test_sync_adds_updates_and_removes_sources(tmp_path, embeddings):
+    store = make_store(tmp_path, embeddings)
+    stats = store.sync([A, B])
+    assert stats["sources_updated"] == 2
+    assert stats["chunks_added"] == 3
+    assert indexed_sources(store) == ["a", "a", "b"]
+
+    # 変わったソース (b) と新しいソース (c) だけを埋め込み、なくなったソース (a) は消す
+    embedded = embeddings.embedded
+    stats = make_store(tmp_path, embeddings).sync([B2, C])
+    assert stats == {
+        "sources_unchanged": 0,
+        "sources_updated": 2,
+        "sources_removed": 1,
+        "chunks_deleted": 3,
+        "chunks_added": 2,
+    }
+    assert embeddings.embedded == embedded + 2
+
+    store = make_store(tmp_path, embeddings)
+    store.load()
+    assert indexed_sources(store) == ["b", "c"]
+    assert store.vectorstore.similarity_search_with_score(B2.page_content, k=1)[0][0].page_content == B2.page_content
+
+
+def test_sync_without_changes_only_touches_manifest(tmp_path, embeddings):
+    make_store(tmp_path, embeddings).sync([A, B])
+    embedded = embeddings.embedded
+    store = make_store(tmp_path, embeddings)
+    stats = store.sync([A, B])
+    assert stats["sources_unchanged"] == 2
+    assert stats["chunks_added"] == stats["chunks_deleted"] == 0
+    assert embeddings.embedded == embedded
+    assert not store.is_stale(max_age=60)
+
+
+def test_sync_recovers_from_crash_between_index_and_manifest(tmp_path, embeddings, monkeypatch):
+    make_store(tmp_path, embeddings).sync([A, B])
+
+    # インデックスを書いた後、マニフェストを書く前に落ちる
+    def crash(self):
+        raise RuntimeError("crash")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(IndexStore, "_save_manifest", crash)
+        with pytest.raises(RuntimeError):
+            make_store(tmp_path, embeddings).sync([B2, C])
+
+    # 古いマニフェストのまま同じ文書を反映し直しても、チャンクが重複したり消し損ねたりしない
+    store = make_store(tmp_path, embeddings)
+    store.sync([B2, C])
+    assert indexed_sources(store) == ["b", "c"]
+    ids = list(store.vectorstore.index_to_docstore_id.values())
+    assert len(ids) == len(set(ids)) == store.vectorstore.index.ntotal
+
+
+def test_sync_requires_documents_for_new_index(tmp_path, embeddings):
+    with pytest.raises(ValueError):
+        make_store(tmp_path, embeddings).sync([])
@@ -0,0 +1,101 @@
+import json
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ingest import BloomFilter, VectorWriter, chunk_id, ingest
+
+
+def documents(n: int) -> list[Document]:
+    return [Document(page_content=f"文書 {i} の本文です。", metadata={"source": str(i)}) for i in range(n)]
+
+
+def splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=0)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    seen = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [chunk_id(Document(page_content=str(i))) for i in range(1000)]
+    new = [seen.add(key) for key in keys]
+    assert all(not seen.add(key) for key in keys)
+    # 上限の件数までなら、偽陽性 (初出なのに既出と判定) は error_rate 程度に収まる
+    assert new.count(False) <= 1000 * 0.01 * 3
+    assert len(seen.bits) == seen.size // 8
+
+
+def test_ingest_writes_vectors_and_chunks(tmp_path, embeddings):
+    docs = documents(10)
+    with VectorWriter(str(tmp_path)) as writer:
+        stats = ingest(docs + docs[:3], embeddings, writer, splitter(), batch_size=4, workers=2)
+    assert stats["documents"] == 13
+    assert stats["chunks"] == 10
+    assert stats["possible_duplicates"] == 3
+    assert stats["batches"] == 3
+
+    with VectorWriter(str(tmp_path)) as reader:
+        vectors = reader.vectors()
+    assert vectors.shape == (10, embeddings.dim)
+    assert np.allclose(vectors[0], embeddings.embed_query(docs[0].page_content))
+    with open(tmp_path / "chunks.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["text"] for line in f] == [doc.page_content for doc in docs]
+
+
+def test_resume_truncates_to_complete_records(tmp_path, embeddings):
+    docs = documents(10)
+    writer = VectorWriter(str(tmp_path))
+    ingest(docs[:6], embeddings, writer, splitter(), batch_size=2, workers=1)
+    writer.close()
+    # 書き込みの途中で止まった状態: ベクトルは 5 件と少し、チャンクは 6 件と書きかけの1行
+    os.truncate(tmp_path / "vectors.f32", 5 * embeddings.dim * 4 + 3)
+    with open(tmp_path / "chunks.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"id": "0')
+
+    writer = VectorWriter(str(tmp_path))
+    assert writer.count == 5
+    assert os.path.getsize(tmp_path / "vectors.f32") == 5 * embeddings.dim * 4
+    assert len(list(writer.written_ids())) == 5
+
+    # 同じ文書を流し直すと、書き出し済みの 5 件を飛ばして続きから書く
+    embedded = embeddings.embedded
+    stats = ingest(docs, embeddings, writer, splitter(), batch_size=2, workers=1)
+    writer.close()
+    assert stats["resumed_chunks"] == 5
+    assert stats["possible_duplicates"] == 0
+    assert stats["chunks"] == 5
+    assert embeddings.embedded == embedded + 5
+    with VectorWriter(str(tmp_path)) as reader:
+        assert reader.vectors().shape == (10, embeddings.dim)
+        assert list(reader.written_ids()) == [chunk_id(doc) for doc in docs]
+
+
+def test_resumed_chunks_are_counted_apart_from_duplicates(tmp_path, embeddings):
+    docs = documents(4)
+    with VectorWriter(str(tmp_path)) as writer:
+        ingest(docs[:2], embeddings, writer, splitter())
+    with VectorWriter(str(tmp_path)) as writer:
+        stats = ingest(docs + docs[:1], embeddings, writer, splitter())
+    assert stats["resumed_chunks"] == 2
+    assert stats["possible_duplicates"] == 1
+    assert stats["chunks"] == 2
+
+
+def test_vectors_reflect_writes_before_close(tmp_path, embeddings):
+    writer = VectorWriter(str(tmp_path))
+    ingest(documents(3), embeddings, writer, splitter())
+    assert writer.vectors().shape == (3, embeddings.dim)
+    ingest(documents(5), embeddings, writer, splitter())
+    assert writer.vectors().shape == (5, embeddings.dim)
+    writer.close()
+
+
+def test_resume_before_first_write_starts_over(tmp_path):
+    (tmp_path / "vectors.f32").write_bytes(b"\0" * 10)
+    (tmp_path / "chunks.jsonl").write_text('{"id": "0')
+    writer = VectorWriter(str(tmp_path))
+    assert writer.count == 0
+    assert os.path.getsize(tmp_path / "vectors.f32") == 0
+    writer.close()
+    assert writer.vectors().shape == (0, 0)
@@ -0,0 +1,107 @@
+import asyncio
+import importlib.util
+import io
+import itertools
+from pathlib import Path
+
+import httpx
+import pytest
+
+from web_cache import WebCache, html_hash
+
+_spec = importlib.util.spec_from_file_location("summarize_web", Path(__file__).with_name("summarize-web.py"))
+summarize_web = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(summarize_web)
+
+URL = "https://example.com/page"
+HTML = "<html><body><p>本文</p></body></html>".encode()
+
+
+@pytest.fixture
+def extracted(monkeypatch) -> list[bytes]:
+    """trafilatura の代わりに HTML をそのまま本文として返し、抽出した HTML を記録する"""
+    calls: list[bytes] = []
+
+    def extract(html: bytes) -> str:
+        calls.append(html)
+        return html.decode()
+
+    monkeypatch.setattr(summarize_web, "extract_content", extract)
+    return calls
+
+
+def serve(requests: list[httpx.Request], etag: str = '"v1"') -> httpx.MockTransport:
+    """ETag が一致する条件付き GET には 304 を返すサーバ"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, content=HTML, headers={"ETag": etag})
+
+    return httpx.MockTransport(handler)
+
+
+def fetch_content(cache: WebCache, transport: httpx.MockTransport) -> str:
+    summarizer = summarize_web.BatchSummarizer(None, None, io.StringIO(), host_interval=0, cache=cache)
+
+    async def main() -> str:
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await summarizer.fetch_content(client, URL)
+
+    return asyncio.run(main())
+
+
+def test_not_modified_page_is_read_from_cache(tmp_path, extracted):
+    cache = WebCache(str(tmp_path / "cache.sqlite3"))
+    requests: list[httpx.Request] = []
+    assert fetch_content(cache, serve(requests)) == HTML.decode()
+    assert fetch_content(cache, serve(requests)) == HTML.decode()
+
+    assert [request.headers.get("If-None-Match") for request in requests] == [None, '"v1"']
+    assert len(extracted) == 1
+    assert cache.stats()["not_modified"] == 1
+    cache.close()
+
+
+def test_not_modified_page_missing_from_cache_is_fetched_again(tmp_path, extracted):
+    cache = WebCache(str(tmp_path / "cache.sqlite3"))
+    # 取得の記録だけが残り、本文はキャッシュから消えている
+    cache.put_fetch(URL, '"v1"', None, html_hash(HTML))
+    requests: list[httpx.Request] = []
+    assert fetch_content(cache, serve(requests)) == HTML.decode()
+
+    # 304 が返ったら、条件を付けずに取得し直して抽出する
+    assert [request.headers.get("If-None-Match") for request in requests] == ['"v1"', None]
+    assert extracted == [HTML]
+    assert cache.get_content(html_hash(HTML)) == HTML.decode()
+    cache.close()
+
+
+def test_host_limiter_spaces_requests_per_host():
+    limiter = summarize_web.HostLimiter(per_host=2, interval=0.05)
+    started: list[tuple[str, float]] = []
+    active = {"example.com": 0}
+    max_active = {"example.com": 0}
+
+    async def request(host: str):
+        async with limiter.limit(host):
+            started.append((host, asyncio.get_running_loop().time()))
+            if host in active:
+                active[host] += 1
+                max_active[host] = max(max_active[host], active[host])
+                await asyncio.sleep(0.2)
+                active[host] -= 1
+
+    async def main():
+        await asyncio.gather(*(request("example.com") for _ in range(3)), request("example.org"))
+
+    asyncio.run(main())
+    times = [at for host, at in started if host == "example.com"]
+    assert len(times) == 3
+    # 同じホストへのリクエストは interval ずつ空け、同時には per_host 件まで
+    assert all(later - earlier >= 0.04 for earlier, later in itertools.pairwise(times))
+    assert times[2] - times[0] >= 0.2 - 0.01
+    assert max_active["example.com"] == 2
+    # 別のホストは待たされない
+    assert next(at for host, at in started if host == "example.org") - times[0] < 0.04
@@ -0,0 +1,100 @@
+import itertools
+import sqlite3
+
+import pytest
+
+import web_cache
+from web_cache import WebCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.time() を呼ぶたびに1秒進める (使われた時刻の順序を決まったものにする)"""
+    ticks = itertools.count(1_000_000)
+    monkeypatch.setattr(web_cache.time, "time", lambda: float(next(ticks)))
+
+
+def test_eviction_removes_least_recently_used(tmp_path, clock):
+    cache = WebCache(str(tmp_path / "cache.sqlite3"), max_summaries=10)
+    for i in range(10):
+        cache.put_summary(f"k{i}", f"v{i}")
+    # k0 を使うと、次に消えるのは k1 から
+    assert cache.get_summary("k0") == "v0"
+    cache.put_summary("k10", "v10")
+
+    stats = cache.stats()["summaries"]
+    # 上限を超えたら1割多めに消して 9 件にする
+    assert stats["entries"] == 9
+    assert stats["evictions"] == 2
+    assert cache.get_summary("k0") == "v0"
+    assert cache.get_summary("k1") is None
+    assert cache.get_summary("k2") is None
+    assert cache.get_summary("k3") == "v3"
+    cache.close()
+
+
+def test_counts_are_kept_incrementally(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = WebCache(path)
+    cache.put_content("a", "1")
+    cache.put_content("a", "2")
+    cache.put_content("b", "3")
+    cache.put_fetch("https://example.com/", '"v1"', None, "a")
+    cache.put_fetch("https://example.com/", '"v2"', None, "b")
+    assert cache.stats()["contents"]["entries"] == 2
+    assert cache.stats()["fetches"]["entries"] == 1
+    assert cache.get_content("a") == "2"
+    assert cache.get_fetch("https://example.com/").etag == '"v2"'
+    cache.close()
+
+    # 開き直したときは数え直す
+    reopened = WebCache(path)
+    assert reopened.stats()["contents"]["entries"] == 2
+    assert reopened.stats()["fetches"]["entries"] == 1
+    reopened.close()
+
+
+def test_touches_and_commits_are_batched(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = WebCache(path, commit_every=1000, commit_interval=3600)
+    cache.put_summary("k", "v")
+    cache.flush()
+    reader = sqlite3.connect(path)
+    (accessed_at,) = reader.execute("SELECT accessed_at FROM summaries").fetchone()
+
+    cache.get_summary("k")
+    cache.put_summary("other", "v")
+    # まとめている間は、ほかの接続からは前の状態が見える
+    assert reader.execute("SELECT accessed_at FROM summaries WHERE key LIKE '%:k'").fetchone() == (accessed_at,)
+    assert reader.execute("SELECT COUNT(*) FROM summaries").fetchone() == (1,)
+
+    cache.close()
+    assert reader.execute("SELECT accessed_at FROM summaries WHERE key LIKE '%:k'").fetchone()[0] > accessed_at
+    assert reader.execute("SELECT COUNT(*) FROM summaries").fetchone() == (2,)
+    reader.close()
+
+
+def test_conditional_headers(tmp_path):
+    cache = WebCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.conditional_headers("https://example.com/") == {}
+    cache.put_fetch("https://example.com/", '"v1"', "Wed, 01 May 2024 00:00:00 GMT", "hash")
+    assert cache.conditional_headers("https://example.com/") == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Wed, 01 May 2024 00:00:00 GMT",
+    }
+    # 本文が消えていれば、304 が返っても本文は得られない
+    assert cache.not_modified_content("https://example.com/") is None
+    cache.put_content("hash", "本文")
+    assert cache.not_modified_content("https://example.com/") == "本文"
+    assert cache.stats()["not_modified"] == 1
+    cache.close()
+
+
+def test_summaries_are_keyed_by_schema_version(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    with_v1 = WebCache(path, schema_version="v1")
+    with_v1.put_summary("k", "old")
+    with_v1.close()
+    with_v2 = WebCache(path, schema_version="v2")
+    assert with_v2.get_summary("k") is None
+    with_v2.close()
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import NamedTuple, Optional
+
+# trafilatura の JSON のうち、本文が同じでも変わりうる項目 (要約のキーには含めない)
+VOLATILE_FIELDS = ("id", "fingerprint", "filedate")
+
+
+def html_hash(body: bytes) -> str:
+    """空白の違いを無視した、取得したページのハッシュ"""
+    return hashlib.sha256(re.sub(rb"\s+", b" ", body).strip()).hexdigest()
+
+
+def content_hash(content: str) -> str:
+    """抽出した本文 (trafilatura の JSON) のハッシュ。キーの順序・空白・変わりうる項目を無視する"""
+    try:
+        fields = json.loads(content)
+    except json.JSONDecodeError:
+        fields = None
+    if isinstance(fields, dict):
+        for field in VOLATILE_FIELDS:
+            fields.pop(field, None)
+        normalized = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    else:
+        normalized = content
+    return hashlib.sha256(re.sub(r"\s+", " ", normalized).strip().encode()).hexdigest()
+
+
+class FetchEntry(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    html_hash: str
+
+
+class WebCache:
+    """Webページの要約の3段のキャッシュ (SQLite)
+
+    - fetches: URL ごとの ETag / Last-Modified と、ページのハッシュ (条件付き GET に使う)
+    - contents: ページのハッシュから抽出した本文 (trafilatura を呼ばずに済ませる)
+    - summaries: 本文のハッシュとスキーマのバージョンから要約 (LLM を呼ばずに済ませる)
+
+    それぞれ上限の件数を超えたら、最後に使われた時刻が古いものから消す。
+    イベントループの上から呼ばれるので、件数は数え直さずに増減で持ち、使われた時刻の更新とコミットは
+    commit_every 件または commit_interval 秒ごとにまとめて行う (異常終了するとその間の更新は失われる)。
+    """
+
+    TABLES = ("fetches", "contents", "summaries")
+
+    def __init__(
+        self,
+        path: str = ".web_cache.sqlite3",
+        schema_version: str = "",
+        max_fetches: Optional[int] = 100_000,
+        max_contents: Optional[int] = 20_000,
+        max_summaries: Optional[int] = 100_000,
+        commit_every: int = 100,
+        commit_interval: float = 1.0,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.schema_version = schema_version
+        self.max_entries = {"fetches": max_fetches, "contents": max_contents, "summaries": max_summaries}
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fetches (
+                key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, value TEXT NOT NULL, accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS contents (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fetches_accessed_at ON fetches (accessed_at);
+            CREATE INDEX IF NOT EXISTS contents_accessed_at ON contents (accessed_at);
+            CREATE INDEX IF NOT EXISTS summaries_accessed_at ON summaries (accessed_at);
+            """
+        )
+        self._counts = {
+            table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in self.TABLES
+        }
+        self._stats = {table: {"hits": 0, "misses": 0, "evictions": 0} for table in self.TABLES}
+        self.not_modified = 0
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # まだ書き込んでいない、使われた時刻の更新 (テーブルごとに キー → 時刻)
+        self._touches: dict[str, dict[str, float]] = {table: {} for table in self.TABLES}
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def conditional_headers(self, url: str) -> dict[str, str]:
+        entry = self.get_fetch(url, count=False)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def get_fetch(self, url: str, count: bool = True) -> Optional[FetchEntry]:
+        row = self._conn.execute("SELECT etag, last_modified, value FROM fetches WHERE key = ?", (url,)).fetchone()
+        if count:
+            self._count("fetches", row is not None)
+        if row is None:
+            return None
+        self._touch("fetches", url)
+        return FetchEntry(*row)
+
+    def put_fetch(self, url: str, etag: Optional[str], last_modified: Optional[str], page_hash: str):
+        row = (url, etag, last_modified, page_hash, time.time())
+        inserted = self._conn.execute(
+            "INSERT OR IGNORE INTO fetches (key, etag, last_modified, value, accessed_at) VALUES (?, ?, ?, ?, ?)", row
+        ).rowcount
+        if not inserted:
+            self._conn.execute(
+                "UPDATE fetches SET etag = ?, last_modified = ?, value = ?, accessed_at = ? WHERE key = ?",
+                row[1:] + row[:1],
+            )
+        self._added("fetches", inserted)
+
+    def not_modified_content(self, url: str) -> Optional[str]:
+        """304 Not Modified が返った URL の本文 (キャッシュから消えていれば None)"""
+        entry = self.get_fetch(url)
+        if entry is None:
+            return None
+        content = self.get_content(entry.html_hash)
+        if content is not None:
+            self.not_modified += 1
+        return content
+
+    def get_content(self, page_hash: str) -> Optional[str]:
+        return self._get("contents", page_hash)
+
+    def put_content(self, page_hash: str, content: str):
+        self._put("contents", page_hash, content)
+
+    def get_summary(self, content_key: str) -> Optional[str]:
+        return self._get("summaries", self._summary_key(content_key))
+
+    def put_summary(self, content_key: str, summary: str):
+        self._put("summaries", self._summary_key(content_key), summary)
+
+    def stats(self) -> dict:
+        stats: dict = {table: {"entries": self._counts[table], **self._stats[table]} for table in self.TABLES}
+        stats["not_modified"] = self.not_modified
+        return stats
+
+    def flush(self):
+        """まとめていた更新を書き込んでコミットする"""
+        for table, touches in self._touches.items():
+            if touches:
+                self._conn.executemany(
+                    f"UPDATE {table} SET accessed_at = ? WHERE key = ?", [(at, key) for key, at in touches.items()]
+                )
+                touches.clear()
+        self._conn.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def _summary_key(self, content_key: str) -> str:
+        # 出力の形式やプロンプトを変えたら、古い要約は使わない
+        return f"{self.schema_version}:{content_key}"
+
+    def _get(self, table: str, key: str) -> Optional[str]:
+        row = self._conn.execute(f"SELECT value FROM {table} WHERE key = ?", (key,)).fetchone()
+        self._count(table, row is not None)
+        if row is None:
+            return None
+        self._touch(table, key)
+        return row[0]
+
+    def _put(self, table: str, key: str, value: str):
+        now = time.time()
+        inserted = self._conn.execute(
+            f"INSERT OR IGNORE INTO {table} (key, value, accessed_at) VALUES (?, ?, ?)", (key, value, now)
+        ).rowcount
+        if not inserted:
+            self._conn.execute(f"UPDATE {table} SET value = ?, accessed_at = ? WHERE key = ?", (value, now, key))
+        self._added(table, inserted)
+
+    def _count(self, table: str, hit: bool):
+        self._stats[table]["hits" if hit else "misses"] += 1
+
+    def _touch(self, table: str, key: str):
+        self._touches[table][key] = time.time()
+        self._changed()
+
+    def _added(self, table: str, inserted: int):
+        self._counts[table] += inserted
+        max_entries = self.max_entries[table]
+        if max_entries is not None and self._counts[table] > max_entries:
+            # 古い順に消すので、まとめていた時刻の更新を先に書き込む
+            self.flush()
+            # 上限を超えたら1割多めに消し、削除の頻度を下げる
+            excess = self._counts[table] - int(max_entries * 0.9)
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE key IN (SELECT key FROM {table} ORDER BY accessed_at ASC LIMIT ?)",
+                (excess,),
+            )
+            self._counts[table] -= excess
+            self._stats[table]["evictions"] += excess
+        self._changed()
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.flush()
@@ -1,10 +1,11 @@
 import argparse
 import asyncio
 import base64
-import io
 import os
 import platform
 import re
+import time
+import weakref
 from getpass import getpass
 from typing import List, Optional, TypedDict
 
@@ -19,11 +20,15 @@ from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.runnables import chain as chain_decorator
 from langchain_openai import ChatOpenAI
 from langgraph.graph import END, StateGraph
-from PIL import Image
 from playwright.async_api import Page, async_playwright
 from playwright_stealth import stealth_async
 
+from image_pipeline import ImageOptions, encode_screenshot
 from path import Path
+from profiler import RunProfiler, current_profiler, profiled
+from screenshot_store import ScreenshotStore
+from settle import SettleOptions, settle, track_network
+from trace_writer import TraceWriter, new_run_dir
 
 
 def _getpass(env_var: str):
@@ -53,6 +58,8 @@ nest_asyncio.apply()
 class BBox(TypedDict):
     x: float
     y: float
+    width: float
+    height: float
     text: str
     type: str
     ariaLabel: str
@@ -67,7 +74,12 @@ class AgentState(TypedDict):
     page: Page  # The Playwright web page lets us interact with the web environment
     input: str  # User request
     img: str  # b64 encoded screenshot
+    img_mime: str  # MIME type of img
+    img_bytes: int  # Size of the encoded screenshot sent to the LLM
+    img_transform: dict  # image = (page - offset) * scale
+    screenshot: bytes  # The labeled screenshot as taken (PNG), before encoding for the LLM
     bboxes: List[BBox]  # The bounding boxes from the browser annotation function
+    mark_timing: dict  # Time spent (ms) in each phase of markPage()
     prediction: Prediction  # The Agent's output
     # A system message (or messages) containing the intermediate steps
     scratchpad: List[BaseMessage]
@@ -76,6 +88,10 @@ class AgentState(TypedDict):
 
 # 2. Tools:
 
+# 各操作の後にページが落ち着くまで待つ。Wait はより長く、静かな時間も長めに取る
+settle_options = SettleOptions(timeout=10.0, quiet=0.5)
+wait_settle_options = SettleOptions(timeout=15.0, quiet=1.5)
+
 
 async def click(state: AgentState):
     # - Click [Numerical_Label]
@@ -92,8 +108,9 @@ async def click(state: AgentState):
         return f"Error: no bbox for : {bbox_id}"
     x, y = bbox["x"], bbox["y"]
     await page.mouse.click(x, y)
+    settled = await settle(page, settle_options)
 
-    return f"Clicked {bbox_id}"
+    return f"Clicked {bbox_id} ({settled})"
 
 
 async def type_text(state: AgentState):
@@ -113,7 +130,8 @@ async def type_text(state: AgentState):
     await page.keyboard.press("Backspace")
     await page.keyboard.type(text_content)
     await page.keyboard.press("Enter")
-    return f"Typed {text_content} and submitted"
+    settled = await settle(page, settle_options)
+    return f"Typed {text_content} and submitted ({settled})"
 
 
 async def scroll(state: AgentState):
@@ -139,25 +157,28 @@ async def scroll(state: AgentState):
         await page.mouse.move(x, y)
         await page.mouse.wheel(0, scroll_direction)
 
-    return f"Scrolled {direction} in {'window' if target.upper() == 'WINDOW' else 'element'}"
+    settled = await settle(page, settle_options)
+    return f"Scrolled {direction} in {'window' if target.upper() == 'WINDOW' else 'element'} ({settled})"
 
 
 async def wait(state: AgentState):
-    sleep_time = 5
-    await asyncio.sleep(sleep_time)
-    return f"Waited for {sleep_time}s."
+    # 固定時間眠る代わりに、読み込み・通信・DOMの変化が落ち着くまで待つ
+    settled = await settle(state["page"], wait_settle_options)
+    return f"Waited until the {settled}."
 
 
 async def go_back(state: AgentState):
     page = state["page"]
     await page.go_back()
-    return f"Navigated back a page to {page.url}."
+    settled = await settle(page, settle_options)
+    return f"Navigated back a page to {page.url} ({settled})."
 
 
 async def to_google(state: AgentState):
     page = state["page"]
     await page.goto("https://www.google.com/")
-    return "Navigated to google.com."
+    settled = await settle(page, settle_options)
+    return f"Navigated to google.com ({settled})."
 
 
 # 3. Agent:
@@ -170,23 +191,72 @@ async def to_google(state: AgentState):
 with open("mark_page.js") as f:
     mark_page_script = f.read()
 
+# markPage() のオプション。intersectionObserver を True にすると表示領域外の候補を先に除外する
+mark_page_options = {"intersectionObserver": False}
+
+# LLMに渡すスクリーンショットの形式・品質・縮小・切り抜き
+image_options = ImageOptions()
+
+
+# ページごとの登録済みフラグと、直前の注釈結果 (指紋, 結果)
+_registered_pages: "weakref.WeakSet[Page]" = weakref.WeakSet()
+_last_marks: "weakref.WeakKeyDictionary[Page, tuple[dict, dict]]" = weakref.WeakKeyDictionary()
+
+
+async def register_mark_page(page: Page):
+    """mark_page.js をページに一度だけ登録する。以降の遷移先では初期化スクリプトとして自動で読み込まれる"""
+    if page in _registered_pages:
+        return
+    await page.add_init_script(mark_page_script)
+    track_network(page)
+    # 読み込み済みの文書には初期化スクリプトが走らないので、ここで一度だけ注入する
+    await page.evaluate(mark_page_script)
+    _registered_pages.add(page)
+
+
+async def page_fingerprint(page: Page) -> Optional[dict]:
+    try:
+        return await page.evaluate("window.markPageFingerprint ? window.markPageFingerprint() : null")
+    except Exception:
+        # 遷移中などで評価できない場合は変化ありとして扱う
+        return None
+
 
 @chain_decorator
 async def mark_page(page: Page):
-    await page.evaluate(mark_page_script)
-    bboxes = []
+    await register_mark_page(page)
+    fingerprint = await page_fingerprint(page)
+    if fingerprint is None:
+        # 初期化スクリプトが効いていない文書 (about:blank など) には直接注入する
+        await page.evaluate(mark_page_script)
+        fingerprint = await page_fingerprint(page)
+    elif page in _last_marks and _last_marks[page][0] == fingerprint:
+        # 失敗したClickやWaitの後などページが変わっていなければ、前回の注釈とスクリーンショットを使い回す
+        return _last_marks[page][1]
+
+    result = {"bboxes": [], "timing": {}}
     for _ in range(10):
         try:
-            bboxes = await page.evaluate("markPage()")
+            result = await page.evaluate("(options) => markPage(options)", mark_page_options)
             break
         except Exception:
             await asyncio.sleep(3)
-    screenshot = await page.screenshot()
+    # markPage() の座標と揃えるため、デバイスピクセルではなくCSSピクセルで撮る
+    screenshot = await page.screenshot(scale="css")
     await page.evaluate("unmarkPage()")
-    return {
-        "img": base64.b64encode(screenshot).decode(),
-        "bboxes": bboxes,
+    encoded = await asyncio.to_thread(encode_screenshot, screenshot, result["bboxes"], image_options)
+    marked = {
+        "img": base64.b64encode(encoded.data).decode(),
+        "img_mime": encoded.mime,
+        "img_bytes": len(encoded.data),
+        "img_transform": {"scale": encoded.scale, "offset": encoded.offset},
+        "screenshot": screenshot,
+        "bboxes": result["bboxes"],
+        "mark_timing": result["timing"],
     }
+    if fingerprint is not None:
+        _last_marks[page] = (fingerprint, marked)
+    return marked
 
 
 # Agent prompt
@@ -229,7 +299,7 @@ def parse(text: str) -> dict:
 
 # prompt = hub.pull("wfh/web-voyager")
 prompt = prompts.ChatPromptTemplate(
-    input_variables=["bbox_descriptions", "img", "input"],
+    input_variables=["bbox_descriptions", "img", "img_mime", "input"],
     input_types={
         "scratchpad": list[
             ai.AIMessage
@@ -294,7 +364,9 @@ Observation: {{A labeled screenshot Given by User}}
         prompts.MessagesPlaceholder(variable_name="scratchpad", optional=True),
         prompts.HumanMessagePromptTemplate(
             prompt=[
-                ImagePromptTemplate(input_variables=["img"], template={"url": "data:image/png;base64,{img}"}),
+                ImagePromptTemplate(
+                    input_variables=["img", "img_mime"], template={"url": "data:{img_mime};base64,{img}"}
+                ),
                 prompts.PromptTemplate(input_variables=["bbox_descriptions"], template="{bbox_descriptions}"),
                 prompts.PromptTemplate(input_variables=["input"], template="{input}"),
             ]
@@ -303,8 +375,16 @@ Observation: {{A labeled screenshot Given by User}}
 )
 
 llm = ChatOpenAI(model="gpt-4-turbo", max_tokens=4096)
-agent = annotate | RunnablePassthrough.assign(
-    prediction=format_descriptions | prompt | llm | StrOutputParser() | parse
+# 各段階を profiled() で包み、実行ごとの所要時間とトークン数を計測できるようにする
+agent = profiled(
+    "agent",
+    profiled("annotate", annotate)
+    | RunnablePassthrough.assign(
+        prediction=profiled("format_prompt", format_descriptions | prompt)
+        | profiled("llm", llm, measure_io=True)
+        | profiled("parse", StrOutputParser() | parse)
+    ),
+    new_step=True,
 )
 
 # 4. Graph:
@@ -349,7 +429,7 @@ graph_builder.add_node("agent", agent)
 graph_builder.set_entry_point("agent")
 
 # Edges (data flow)
-graph_builder.add_node("update_scratchpad", update_scratchpad)
+graph_builder.add_node("update_scratchpad", profiled("update_scratchpad", update_scratchpad))
 graph_builder.add_edge("update_scratchpad", "agent")
 
 tools = {
@@ -365,7 +445,7 @@ tools = {
 for node_name in tools:
     graph_builder.add_node(
         node_name,
-        RunnableLambda(tools[node_name]) | (lambda observation: {"observation": observation}),
+        profiled(node_name, RunnableLambda(tools[node_name]) | (lambda observation: {"observation": observation})),
     )
     graph_builder.add_edge(node_name, "update_scratchpad")
 
@@ -389,10 +469,25 @@ graph.get_graph().print_ascii()
 # 5. Run agent
 
 
-async def call_agent(question: str, page, max_steps: int = 150):
-    path = Path()
+async def call_agent(
+    question: str,
+    page,
+    max_steps: int = 150,
+    path_output: str = "grid",
+    output_dir: Optional[str] = None,
+    store: Optional[ScreenshotStore] = None,
+    full_size_path: bool = False,
+):
+    # 実行ごとに出力先を分けるので、並列に実行しても互いのファイルを上書きしない
+    run_dir = output_dir or new_run_dir()
+    os.makedirs(run_dir, exist_ok=True)
+    # 画面遷移図のグリッドは既定で縮小版から作り、ステップ数が増えてもメモリを一定に保つ
+    path = Path(path_history_dir=run_dir, output=path_output, store=store, use_thumbnails=not full_size_path)
+    trace = TraceWriter(run_dir, path)
+    profiler = RunProfiler()
+    current_profiler.set(profiler)
     objective_image = path.create_text_image("Objective: " + question, width=800, height=100, font_size=100)
-    path.update_agent_path_image(objective_image, is_initial=True)
+    trace.add_image(objective_image, is_initial=True)
 
     event_stream = graph.astream(
         {
@@ -406,35 +501,65 @@ async def call_agent(question: str, page, max_steps: int = 150):
     )
 
     final_answer = None
-    steps = []
+    # ツールのノードはエージェントのイベントの後に同じステップ番号で実行されるので、
+    # ステップの記録は次のステップ (または実行の終わり) まで待ち、その操作の所要時間も含める
+    pending_step = None
+
+    def flush_step():
+        nonlocal pending_step
+        if pending_step is not None:
+            *record, step = pending_step
+            trace.record_step(*record, profiler.step_timings(step))
+            pending_step = None
+
     step_counter = 0
-    async for event in event_stream:
-        if "agent" not in event:
-            continue
-        pred = event["agent"].get("prediction") or {}
-        action = pred.get("action")
-        action_input = pred.get("args")
-
-        step_counter += 1
-        steps.append(f"{step_counter}. {action}: {action_input}")
-        print(f"{step_counter}. {action}: {action_input}")
-
-        with open("agent_steps.txt", "w") as file:
-            file.write("\n".join(steps))
-
-        screenshot_data = base64.b64decode(event["agent"]["img"])
-        img = Image.open(io.BytesIO(screenshot_data))
-        path.update_agent_path_image(img)
-
-        if action and "ANSWER" in action:
-            if action_input is None:
-                raise ValueError("No answer provided.")
-            final_answer = action_input[0]
-            # Create and add the final response image
-            final_response_image = path.create_text_image(
-                "Final Response: " + final_answer, width=800, height=100, font_size=20
+    img_bytes_total = 0
+    start = time.perf_counter()
+    try:
+        async for event in event_stream:
+            if "agent" not in event:
+                continue
+            pred = event["agent"].get("prediction") or {}
+            action = pred.get("action")
+            action_input = pred.get("args")
+
+            step_counter += 1
+            print(f"{step_counter}. {action}: {action_input}")
+            img_bytes_total += event["agent"].get("img_bytes", 0)
+            mark_timing = event["agent"].get("mark_timing") or {}
+            if mark_timing:
+                print(
+                    f"   markPage: {mark_timing['total']:.0f} ms "
+                    f"({mark_timing['candidates']} candidates, {mark_timing['items']} items)"
+                )
+
+            # 画像のデコードやファイルへの書き込みはバックグラウンドで行う
+            flush_step()
+            pending_step = (step_counter, action, action_input, event["agent"], profiler.step)
+
+            if action and "ANSWER" in action:
+                if action_input is None:
+                    raise ValueError("No answer provided.")
+                final_answer = action_input[0]
+                # Create and add the final response image
+                final_response_image = path.create_text_image(
+                    "Final Response: " + final_answer, width=800, height=100, font_size=20
+                )
+                trace.add_image(final_response_image, is_final=True)
+    finally:
+        flush_step()
+        await trace.aclose()
+        if step_counter:
+            print(
+                f"{step_counter} steps in {time.perf_counter() - start:.1f}s, "
+                f"{img_bytes_total / step_counter / 1024:.1f} KiB image per step"
             )
-            path.update_agent_path_image(final_response_image, is_final=True)
+        print(f"Trace written to {trace.trace_filename}")
+        if profiler.spans:
+            profile_filename = os.path.join(run_dir, "profile.json")
+            profiler.write_chrome_trace(profile_filename)
+            print(profiler.format_summary())
+            print(f"Profile written to {profile_filename} (open in chrome://tracing or ui.perfetto.dev)")
 
     return final_answer
 
@@ -445,13 +570,46 @@ async def call_agent(question: str, page, max_steps: int = 150):
 @dataclass
 class Args:
     objective: str
+    path_output: str
+    image_format: str
+    image_quality: int
+    image_max_dimension: int
+    grayscale: bool
+    crop: bool
+    full_size_path: bool
 
 
 async def main():
     parser = argparse.ArgumentParser(description="Run the agent on a given objective")
     parser.add_argument("--objective", type=str, help="The question to run the agent on")
+    parser.add_argument(
+        "--path-output",
+        type=str,
+        default="grid",
+        choices=["grid", "html", "webp", "gif"],
+        help="Output format of the agent path history",
+    )
+    parser.add_argument("--image-format", type=str, default="webp", choices=["png", "jpeg", "webp"])
+    parser.add_argument("--image-quality", type=int, default=75, help="JPEG/WebP quality of the screenshot")
+    parser.add_argument(
+        "--image-max-dimension", type=int, default=1280, help="Downscale screenshots to this size (0 to disable)"
+    )
+    parser.add_argument("--grayscale", action="store_true", help="Send grayscale screenshots")
+    parser.add_argument("--crop", action="store_true", help="Crop screenshots to the labeled elements")
+    parser.add_argument(
+        "--full-size-path", action="store_true", help="Build the agent path grid from full-size screenshots"
+    )
     args = Args(**vars(parser.parse_args()))
 
+    global image_options
+    image_options = ImageOptions(
+        format=args.image_format,
+        quality=args.image_quality,
+        max_dimension=args.image_max_dimension or None,
+        grayscale=args.grayscale,
+        crop_to_bboxes=args.crop,
+    )
+
     objective = args.objective or input("objective: ")
     if objective == "":
         print("Defaulting to 'What is the capital of France?'")
@@ -464,7 +622,9 @@ async def main():
         await page.goto("https://www.google.com")
 
         try:
-            res = await call_agent(objective, page)
+            res = await call_agent(
+                objective, page, path_output=args.path_output, full_size_path=args.full_size_path
+            )
             print(f"Final response: {res}")
         finally:
             await browser.close()
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable
+
+from playwright.async_api import Browser, BrowserContext, async_playwright
+from playwright_stealth import stealth_async
+
+from agent_voyage import call_agent
+from screenshot_store import ScreenshotStore
+
+# 複数の目的 (objective) を並列に実行する
+#
+# 起動したブラウザを使い回し、タスクごとに新しいコンテキストを作って終わったら閉じる
+# (Cookie・localStorage・IndexedDB・Service Worker・キャッシュ・権限を次のタスクに持ち越さない)。
+# ブラウザはNタスクごとに起動し直してメモリの増加を抑える。
+#
+# python batch.py objectives.jsonl --concurrency 4 --browsers 2
+#
+# objectives.jsonl の各行: {"id": "q1", "objective": "...", "start_url": "https://www.google.com"}
+
+
+@dataclass
+class Task:
+    id: str
+    objective: str
+    start_url: str
+
+
+class _PooledBrowser:
+    def __init__(self, browser: Browser):
+        self.browser = browser
+        self.active = 0
+        self.uses = 0
+        self.retired = False
+
+
+class BrowserPool:
+    def __init__(self, launch: Callable[[], Awaitable[Browser]], size: int, recycle_after: int):
+        self.launch = launch
+        self.size = size
+        self.recycle_after = recycle_after
+        self._browsers: list[_PooledBrowser] = []
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        for _ in range(self.size):
+            self._browsers.append(_PooledBrowser(await self.launch()))
+
+    async def _acquire(self) -> _PooledBrowser:
+        async with self._lock:
+            # 落ちたブラウザは起動し直す
+            for i, pooled in enumerate(self._browsers):
+                if not pooled.browser.is_connected():
+                    pooled.retired = True
+                    self._browsers[i] = _PooledBrowser(await self.launch())
+            pooled = min(self._browsers, key=lambda pooled: pooled.active)
+            pooled.active += 1
+            pooled.uses += 1
+            if pooled.uses >= self.recycle_after:
+                # このタスクが終わったら閉じ、以降のタスクには新しいブラウザを使う
+                pooled.retired = True
+                self._browsers[self._browsers.index(pooled)] = _PooledBrowser(await self.launch())
+            return pooled
+
+    async def _release(self, pooled: _PooledBrowser):
+        pooled.active -= 1
+        if pooled.retired and pooled.active == 0:
+            await _close_quietly(pooled.browser)
+
+    @asynccontextmanager
+    async def context(self) -> AsyncIterator[BrowserContext]:
+        """タスク専用の新しいコンテキスト。抜けるときに閉じる"""
+        pooled = await self._acquire()
+        try:
+            context = await pooled.browser.new_context()
+            try:
+                yield context
+            finally:
+                await _close_quietly(context)
+        finally:
+            await self._release(pooled)
+
+    async def close(self):
+        for pooled in self._browsers:
+            await _close_quietly(pooled.browser)
+        self._browsers.clear()
+
+
+async def _close_quietly(target: Browser | BrowserContext):
+    # ブラウザが落ちた後の close の失敗でタスクの結果を上書きしない
+    try:
+        await target.close()
+    except Exception as e:
+        print(f"Failed to close {type(target).__name__}: {e}")
+
+
+def load_tasks(filename: str, default_start_url: str) -> list[Task]:
+    tasks = []
+    seen = set()
+    with open(filename) as f:
+        for i, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            task_id = str(record.get("id", i))
+            # id は出力のディレクトリ名になるので、重複すると結果を上書きしてしまう
+            if task_id in seen:
+                raise ValueError(f"{filename}:{i}: duplicate objective id {task_id!r}")
+            seen.add(task_id)
+            tasks.append(
+                Task(
+                    id=task_id,
+                    objective=record["objective"],
+                    start_url=record.get("start_url", default_start_url),
+                )
+            )
+    return tasks
+
+
+async def run_task(
+    task: Task, pool: BrowserPool, limit: asyncio.Semaphore, store: ScreenshotStore, output_dir: str, max_steps: int
+) -> dict:
+    task_dir = os.path.join(output_dir, task.id)
+    result = {"id": task.id, "objective": task.objective, "answer": None, "error": None}
+    async with limit:
+        start = time.perf_counter()
+        # コンテキストの作成・破棄を含め、例外はこのタスクの失敗として記録する (バッチ全体は止めない)
+        try:
+            async with pool.context() as context:
+                page = await context.new_page()
+                await stealth_async(page)
+                await page.goto(task.start_url)
+                result["answer"] = await call_agent(
+                    task.objective, page, max_steps=max_steps, output_dir=task_dir, store=store
+                )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+    result["latency"] = time.perf_counter() - start
+    result["output_dir"] = task_dir
+    return result
+
+
+def percentile(values: list[float], p: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+async def run_batch(
+    tasks: list[Task],
+    output_dir: str,
+    concurrency: int = 4,
+    browsers: int = 1,
+    headless: bool = True,
+    recycle_after: int = 20,
+    max_steps: int = 150,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    # スクリーンショットは全タスクで共有し、メモリに載せる縮小版の総量を抑える
+    store = ScreenshotStore(cache_dir=os.path.join(output_dir, "screenshots"))
+    results_filename = os.path.join(output_dir, "results.jsonl")
+
+    async with async_playwright() as p:
+        pool = BrowserPool(lambda: p.chromium.launch(headless=headless), browsers, recycle_after)
+        await pool.start()
+        limit = asyncio.Semaphore(concurrency)
+        start = time.perf_counter()
+        latencies = []
+        failures = 0
+        try:
+            pending = [
+                asyncio.create_task(run_task(task, pool, limit, store, output_dir, max_steps)) for task in tasks
+            ]
+            with open(results_filename, "a") as results_file:
+                # 完了した順に書き出す
+                for done in asyncio.as_completed(pending):
+                    result = await done
+                    latencies.append(result["latency"])
+                    failures += result["error"] is not None
+                    results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    results_file.flush()
+                    print(f"[{len(latencies)}/{len(tasks)}] {result['id']}: {result['answer'] or result['error']}")
+        finally:
+            await pool.close()
+
+    elapsed = time.perf_counter() - start
+    if latencies:
+        print(
+            f"\n{len(latencies)} objectives ({failures} failed) in {elapsed:.1f}s: "
+            f"{len(latencies) / elapsed * 60:.1f} objectives/minute"
+        )
+        print(
+            "latency p50 {:.1f}s / p90 {:.1f}s / p99 {:.1f}s".format(
+                percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99)
+            )
+        )
+    print(f"results: {results_filename}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the agent on objectives from a JSONL file")
+    parser.add_argument("objectives", type=str, help="JSONL file with one objective per line")
+    parser.add_argument("--output-dir", type=str, default="batch-runs", help="Directory for results and step logs")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of objectives run in parallel")
+    parser.add_argument("--browsers", type=int, default=1, help="Number of browser processes shared by the objectives")
+    parser.add_argument("--recycle-after", type=int, default=20, help="Relaunch a browser after this many objectives")
+    parser.add_argument("--max-steps", type=int, default=150)
+    parser.add_argument("--start-url", type=str, default="https://www.google.com")
+    parser.add_argument("--headed", action="store_true", help="Show the browser windows")
+    args = parser.parse_args()
+
+    tasks = load_tasks(args.objectives, args.start_url)
+    asyncio.run(
+        run_batch(
+            tasks,
+            args.output_dir,
+            concurrency=args.concurrency,
+            browsers=args.browsers,
+            headless=not args.headed,
+            recycle_after=args.recycle_after,
+            max_steps=args.max_steps,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
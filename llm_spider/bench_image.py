@@ -0,0 +1,149 @@
+import argparse
+import base64
+import glob
+import json
+import math
+import os
+import statistics
+import time
+
+from image_pipeline import ImageOptions, encode_screenshot
+
+# 1ステップの スクリーンショット → エンコード → プロンプトの組み立て → LLM の応答 までのレイテンシを設定ごとに比較する
+#
+# 過去の実行で保存されたスクリーンショット (path-history/screenshots) を入力に使う:
+# python bench_image.py "path-history/screenshots/*/*.png"
+# --url を渡すと、保存したファイルの代わりに Playwright でそのページのスクリーンショットを毎回撮る:
+# python bench_image.py --url https://www.google.com --limit 10
+#
+# LLM は呼ばずに、送信するリクエストの大きさと画像のトークン数から応答までの時間を見積もるスタブで待つ
+
+SETTINGS = {
+    "png (before)": ImageOptions(format="png", max_dimension=None),
+    "jpeg q75 1280": ImageOptions(format="jpeg", quality=75, max_dimension=1280),
+    "jpeg q60 1024": ImageOptions(format="jpeg", quality=60, max_dimension=1024),
+    "webp q75 1280": ImageOptions(format="webp", quality=75, max_dimension=1280),
+    "webp q60 gray": ImageOptions(format="webp", quality=60, max_dimension=1280, grayscale=True),
+}
+
+
+def image_tokens(size: tuple[int, int]) -> int:
+    """OpenAI の画像入力 (detail=high) のトークン数: 2048px 四方に収め、短辺を 768px にして 512px のタイルで数える"""
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def build_request(encoded_data: bytes, mime: str, text: str) -> bytes:
+    """agent_voyage.py のプロンプトと同じ形 (data URL の画像 + テキスト) の Chat Completions のリクエスト本文"""
+    img = base64.b64encode(encoded_data).decode()
+    content = [
+        {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{img}"}},
+        {"type": "text", "text": text},
+    ]
+    body = {"model": "gpt-4-turbo", "max_tokens": 4096, "messages": [{"role": "user", "content": content}]}
+    return json.dumps(body).encode()
+
+
+class StubLLM:
+    """リクエストの送信 (uplink_mbps) と、画像のトークンの処理 (input_tps) にかかる時間だけ待つ"""
+
+    def __init__(self, base_latency: float, input_tps: float, uplink_mbps: float):
+        self.base_latency = base_latency
+        self.input_tps = input_tps
+        self.uplink_bytes_per_second = uplink_mbps * 1_000_000 / 8
+
+    def call(self, request: bytes, tokens: int):
+        time.sleep(self.base_latency + len(request) / self.uplink_bytes_per_second + tokens / self.input_tps)
+
+
+def saved_screenshots(pattern: str, limit: int):
+    files = sorted(glob.glob(pattern))[:limit]
+    if not files:
+        raise SystemExit(f"no files match {pattern}")
+    print(f"{len(files)} screenshots from {os.path.dirname(files[0])}")
+
+    def capture(i: int) -> bytes:
+        with open(files[i], "rb") as f:
+            return f.read()
+
+    return len(files), capture, lambda: None
+
+
+def live_screenshots(url: str, limit: int):
+    from playwright.sync_api import sync_playwright
+
+    playwright = sync_playwright().start()
+    browser = playwright.chromium.launch()
+    page = browser.new_page(viewport={"width": 1280, "height": 1080})
+    page.goto(url)
+    print(f"{limit} screenshots of {url}")
+
+    def close():
+        browser.close()
+        playwright.stop()
+
+    # agent_voyage.py と同じく CSS ピクセルで撮る
+    return limit, lambda i: page.screenshot(scale="css"), close
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-step latency of the screenshot to LLM round trip")
+    parser.add_argument("pattern", type=str, nargs="?", help="Glob of PNG screenshots")
+    parser.add_argument("--url", type=str, help="Capture screenshots of this page with Playwright instead")
+    parser.add_argument("--limit", type=int, default=20, help="Screenshots per setting")
+    parser.add_argument("--base-latency", type=float, default=0.5, help="Stub latency per call (s)")
+    parser.add_argument("--input-tps", type=float, default=5_000, help="Stub prompt processing speed (tokens/s)")
+    parser.add_argument("--uplink-mbps", type=float, default=20.0, help="Stub upload bandwidth (Mbit/s)")
+    args = parser.parse_args()
+    if (args.pattern is None) == (args.url is None):
+        parser.error("pass either a glob of screenshots or --url")
+
+    if args.url:
+        count, capture, close = live_screenshots(args.url, args.limit)
+    else:
+        count, capture, close = saved_screenshots(args.pattern, args.limit)
+    llm = StubLLM(args.base_latency, args.input_tps, args.uplink_mbps)
+
+    print(
+        f"{'setting':<16}{'KiB/step':>10}{'tokens':>8}{'capture ms':>12}{'encode ms':>11}{'prompt ms':>11}"
+        f"{'llm ms':>9}{'step ms':>9}"
+    )
+    try:
+        for name, options in SETTINGS.items():
+            sizes, tokens, stages = [], [], {"capture": [], "encode": [], "prompt": [], "llm": [], "step": []}
+            for i in range(count):
+                start = time.perf_counter()
+                png = capture(i)
+                captured = time.perf_counter()
+                encoded = encode_screenshot(png, [], options)
+                encoded_at = time.perf_counter()
+                request = build_request(encoded.data, encoded.mime, "Valid Bounding Boxes:\n")
+                built = time.perf_counter()
+                llm.call(request, image_tokens(encoded.size))
+                end = time.perf_counter()
+                sizes.append(len(encoded.data))
+                tokens.append(image_tokens(encoded.size))
+                for stage, seconds in (
+                    ("capture", captured - start),
+                    ("encode", encoded_at - captured),
+                    ("prompt", built - encoded_at),
+                    ("llm", end - built),
+                    ("step", end - start),
+                ):
+                    stages[stage].append(seconds * 1000)
+            mean = {stage: statistics.mean(values) for stage, values in stages.items()}
+            print(
+                f"{name:<16}{statistics.mean(sizes) / 1024:>10.1f}{statistics.mean(tokens):>8.0f}"
+                f"{mean['capture']:>12.1f}{mean['encode']:>11.1f}{mean['prompt']:>11.1f}{mean['llm']:>9.0f}"
+                f"{mean['step']:>9.0f}"
+            )
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    main()
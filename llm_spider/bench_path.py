@@ -0,0 +1,90 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from path import Path
+
+# 画面遷移図の1ステップあたりのレイテンシを、従来の全体再描画と比較する
+#
+# python bench_path.py --steps 10 50 150
+
+
+class LegacyPath:
+    """従来の実装: 毎ステップ全スクリーンショットからグリッドを作り直してPNGを保存する"""
+
+    def __init__(self, path_history_dir: str):
+        self.screenshots = []
+        self.path_history_dir = path_history_dir
+
+    def update_agent_path_image(self, img, is_initial=False, is_final=False):
+        if is_initial or is_final:
+            self.screenshots.insert(0 if is_initial else len(self.screenshots), img)
+        else:
+            self.screenshots.append(img)
+        cols = 3
+        rows = (len(self.screenshots) + cols - 1) // cols
+        max_width = max(img.width for img in self.screenshots)
+        max_height = max(img.height for img in self.screenshots)
+        grid_image = Image.new("RGB", (cols * max_width, rows * max_height), color=(255, 255, 255))
+        for i, img in enumerate(self.screenshots):
+            grid_image.paste(img, ((i % cols) * max_width, (i // cols) * max_height))
+        grid_image.save(os.path.join(self.path_history_dir, "agent_path.png"))
+
+    def close(self):
+        pass
+
+
+def make_screenshot(step: int, width: int, height: int) -> Image.Image:
+    image = Image.new("RGB", (width, height), color=(240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, height, 24):
+        draw.rectangle((20, i + 4, 20 + (step * 37 + i * 13) % (width - 40), i + 18), fill=(40, 90, 160))
+    draw.text((10, 10), f"step {step}", fill="black")
+    return image
+
+
+def run(factory, steps: int, width: int, height: int) -> list[float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = factory(tmp)
+        latencies = []
+        for step in range(steps):
+            img = make_screenshot(step, width, height)
+            start = time.perf_counter()
+            path.update_agent_path_image(img)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        path.close()
+        latencies[-1] += time.perf_counter() - start
+        return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark agent path rendering")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 50, 150])
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    args = parser.parse_args()
+
+    implementations = {
+        "legacy": lambda tmp: LegacyPath(tmp),
+        "grid": lambda tmp: Path(path_history_dir=tmp, use_thumbnails=False),
+        "thumbs": lambda tmp: Path(path_history_dir=tmp),
+        "html": lambda tmp: Path(path_history_dir=tmp, output="html"),
+        "webp": lambda tmp: Path(path_history_dir=tmp, output="webp"),
+    }
+    print(f"{'impl':<8}{'steps':>6}{'mean ms':>10}{'last10 ms':>11}{'total s':>9}")
+    for steps in args.steps:
+        for name, factory in implementations.items():
+            latencies = run(factory, steps, args.width, args.height)
+            print(
+                f"{name:<8}{steps:>6}{statistics.mean(latencies) * 1000:>10.1f}"
+                f"{statistics.mean(latencies[-10:]) * 1000:>11.1f}{sum(latencies):>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import io
+from dataclasses import dataclass
+from typing import NamedTuple, Sequence
+
+from PIL import Image
+
+# LLMに渡すスクリーンショットの変換
+#
+# markPage() の座標はCSSピクセルなので、スクリーンショットも scale="css" で撮る前提。
+# 縮小・切り抜きをしても bboxes (クリック先) はページ座標のまま変えず、
+# 画像座標との対応は transform (scale, offset) で表す。
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# ラベルは要素の左上から上に 19px はみ出して描かれる
+LABEL_HEIGHT = 19
+
+
+@dataclass
+class ImageOptions:
+    format: str = "webp"
+    quality: int = 75
+    max_dimension: int | None = 1280
+    grayscale: bool = False
+    crop_to_bboxes: bool = False
+    crop_padding: int = 16
+
+    def __post_init__(self):
+        if self.format not in MIME_TYPES:
+            raise ValueError(f"format must be one of {tuple(MIME_TYPES)}, got {self.format!r}")
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    mime: str
+    size: tuple[int, int]
+    # 画像座標 = (ページ座標 - offset) * scale
+    scale: float
+    offset: tuple[int, int]
+
+
+def bboxes_region(bboxes: Sequence[dict], size: tuple[int, int], padding: int) -> tuple[int, int, int, int] | None:
+    """ラベルを含めてすべての bbox を囲む領域 (left, top, right, bottom) を返す"""
+    if not bboxes:
+        return None
+    width, height = size
+    left = min(b["x"] - b.get("width", 0) / 2 for b in bboxes) - padding
+    top = min(b["y"] - b.get("height", 0) / 2 for b in bboxes) - LABEL_HEIGHT - padding
+    right = max(b["x"] + b.get("width", 0) / 2 for b in bboxes) + padding
+    bottom = max(b["y"] + b.get("height", 0) / 2 for b in bboxes) + padding
+    return (max(0, int(left)), max(0, int(top)), min(width, int(right) + 1), min(height, int(bottom) + 1))
+
+
+def encode_screenshot(png: bytes, bboxes: Sequence[dict], options: ImageOptions) -> EncodedImage:
+    image = Image.open(io.BytesIO(png))
+    passthrough = (
+        options.format == "png"
+        and not options.grayscale
+        and not options.crop_to_bboxes
+        and (options.max_dimension is None or max(image.size) <= options.max_dimension)
+    )
+    if passthrough:
+        # 何も変換しない場合は再エンコードしない
+        return EncodedImage(png, MIME_TYPES["png"], image.size, 1.0, (0, 0))
+
+    offset = (0, 0)
+    if options.crop_to_bboxes:
+        region = bboxes_region(bboxes, image.size, options.crop_padding)
+        if region is not None:
+            image = image.crop(region)
+            offset = region[:2]
+
+    scale = 1.0
+    if options.max_dimension is not None and max(image.size) > options.max_dimension:
+        scale = options.max_dimension / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    image = image.convert("L" if options.grayscale else "RGB")
+    buffer = io.BytesIO()
+    if options.format == "png":
+        image.save(buffer, format="PNG", optimize=True)
+    elif options.format == "jpeg":
+        image.save(buffer, format="JPEG", quality=options.quality)
+    else:
+        image.save(buffer, format="WEBP", quality=options.quality, method=4)
+    return EncodedImage(buffer.getvalue(), MIME_TYPES[options.format], image.size, scale, offset)
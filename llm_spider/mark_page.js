@@ -1,102 +1,194 @@
-const customCSS = `
-    ::-webkit-scrollbar {
-        width: 10px;
+// page.add_init_script でページごとに一度だけ登録する。
+// 同じ文書に何度注入されても状態を二重に作らないようにガードする。
+(function () {
+    if (window.__markPageInstalled) {
+        return;
     }
-    ::-webkit-scrollbar-track {
-        background: #27272a;
+    window.__markPageInstalled = true;
+
+    const customCSS = `
+        ::-webkit-scrollbar {
+            width: 10px;
+        }
+        ::-webkit-scrollbar-track {
+            background: #27272a;
+        }
+        ::-webkit-scrollbar-thumb {
+            background: #888;
+            border-radius: 0.375rem;
+        }
+        ::-webkit-scrollbar-thumb:hover {
+            background: #555;
+        }
+    `;
+
+    // 自前のラベルやスタイルの追加・削除はページの変化として数えない
+    const OWN_NODE = "__markPageOwn";
+
+    function isOwnRecord(record) {
+        const nodes = [...record.addedNodes, ...record.removedNodes];
+        if (record.type === "childList" && nodes.length > 0) {
+            return nodes.every((node) => node[OWN_NODE]);
+        }
+        let target = record.target;
+        while (target) {
+            if (target[OWN_NODE]) {
+                return true;
+            }
+            target = target.parentNode;
+        }
+        return false;
     }
-    ::-webkit-scrollbar-thumb {
-        background: #888;
-        border-radius: 0.375rem;
+
+    // DOMの変更回数。URL・スクロール位置と合わせてページの指紋にする
+    window.__markPageMutations = 0;
+    new MutationObserver((records) => {
+        for (const record of records) {
+            if (!isOwnRecord(record)) {
+                window.__markPageMutations++;
+            }
+        }
+    }).observe(document, {
+        subtree: true,
+        childList: true,
+        attributes: true,
+        characterData: true,
+    });
+
+    // 要素内スクロールや入力欄の値の変化はDOMの変更として観測されないので、イベントで数える
+    window.__markPageEvents = 0;
+    for (const type of ["scroll", "input", "change"]) {
+        window.addEventListener(type, () => window.__markPageEvents++, { capture: true, passive: true });
     }
-    ::-webkit-scrollbar-thumb:hover {
-        background: #555;
+
+    window.markPageFingerprint = function () {
+        return {
+            mutations: window.__markPageMutations,
+            events: window.__markPageEvents,
+            url: location.href,
+            scrollX: window.scrollX,
+            scrollY: window.scrollY,
+            width: window.innerWidth,
+            height: window.innerHeight,
+        };
+    };
+
+    // DOMの変更が quietMs の間止まるまで待つ。待った時間 (ms) を返す
+    window.waitForDomQuiet = function (quietMs, timeoutMs) {
+        return new Promise((resolve) => {
+            const start = performance.now();
+            let last = window.__markPageMutations;
+            let lastChange = start;
+            function tick() {
+                const now = performance.now();
+                if (window.__markPageMutations !== last) {
+                    last = window.__markPageMutations;
+                    lastChange = now;
+                }
+                if (now - lastChange >= quietMs || now - start >= timeoutMs) {
+                    resolve(now - start);
+                } else {
+                    setTimeout(tick, 50);
+                }
+            }
+            tick();
+        });
+    };
+
+    // 初期化スクリプトの時点では <head> がまだ無いので、最初の markPage で追加する
+    function ensureStyle() {
+        if (document.getElementById("__mark-page-style")) {
+            return;
+        }
+        const styleTag = document.createElement("style");
+        styleTag.id = "__mark-page-style";
+        styleTag[OWN_NODE] = true;
+        styleTag.textContent = customCSS;
+        (document.head || document.documentElement).append(styleTag);
     }
-`;
 
-const styleTag = document.createElement("style");
-styleTag.textContent = customCSS;
-document.head.append(styleTag);
+    let labels = [];
+
+    window.unmarkPage = function () {
+        // Unmark page logic
+        for (const label of labels) {
+            label.remove();
+        }
+        labels = [];
+    };
+
+    // 操作可能な要素の候補。cursor: pointer は最後に getComputedStyle で確認する
+    const CANDIDATE_TAGS = new Set(["INPUT", "TEXTAREA", "SELECT", "BUTTON", "A", "IFRAME", "VIDEO"]);
+    const CANDIDATE_ROLES = new Set([
+        "button",
+        "link",
+        "checkbox",
+        "radio",
+        "tab",
+        "menuitem",
+        "option",
+        "switch",
+        "textbox",
+        "combobox",
+        "searchbox",
+    ]);
+
+    function isCandidate(element) {
+        if (CANDIDATE_TAGS.has(element.tagName) || element.onclick != null) {
+            return true;
+        }
+        const role = element.getAttribute("role");
+        if (role && CANDIDATE_ROLES.has(role)) {
+            return true;
+        }
+        const tabindex = element.getAttribute("tabindex");
+        if (tabindex !== null && Number(tabindex) >= 0) {
+            return true;
+        }
+        return window.getComputedStyle(element).cursor == "pointer";
+    }
 
-let labels = [];
+    // 要素を文書順に走査し、候補だけを集める。自前のラベルの部分木は丸ごと飛ばす
+    function collectCandidates(root) {
+        const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT, {
+            acceptNode(node) {
+                if (node[OWN_NODE]) {
+                    return NodeFilter.FILTER_REJECT;
+                }
+                return isCandidate(node) ? NodeFilter.FILTER_ACCEPT : NodeFilter.FILTER_SKIP;
+            },
+        });
+        const candidates = [];
+        let node;
+        while ((node = walker.nextNode())) {
+            candidates.push(node);
+        }
+        return candidates;
+    }
 
-function unmarkPage() {
-    // Unmark page logic
-    for (const label of labels) {
-        document.body.removeChild(label);
+    // IntersectionObserver で表示領域に掛かっている要素だけに絞る (同期的なレイアウト計算を避ける)
+    function filterIntersecting(elements) {
+        if (elements.length === 0 || typeof IntersectionObserver === "undefined") {
+            return Promise.resolve(elements);
+        }
+        return new Promise((resolve) => {
+            const visible = new Set();
+            let pending = elements.length;
+            const observer = new IntersectionObserver((entries) => {
+                for (const entry of entries) {
+                    if (entry.isIntersecting) {
+                        visible.add(entry.target);
+                    }
+                }
+                pending -= entries.length;
+                if (pending <= 0) {
+                    observer.disconnect();
+                    resolve(elements.filter((element) => visible.has(element)));
+                }
+            });
+            elements.forEach((element) => observer.observe(element));
+        });
     }
-    labels = [];
-}
-
-function markPage() {
-    unmarkPage();
-
-    var bodyRect = document.body.getBoundingClientRect();
-
-    var items = Array.prototype.slice
-        .call(document.querySelectorAll("*"))
-        .map(function (element) {
-            var vw = Math.max(
-                document.documentElement.clientWidth || 0,
-                window.innerWidth || 0
-            );
-            var vh = Math.max(
-                document.documentElement.clientHeight || 0,
-                window.innerHeight || 0
-            );
-            var textualContent = element.textContent.trim().replace(/\s{2,}/g, " ");
-            var elementType = element.tagName.toLowerCase();
-            var ariaLabel = element.getAttribute("aria-label") || "";
-
-            var rects = [...element.getClientRects()]
-                .filter((bb) => {
-                    var center_x = bb.left + bb.width / 2;
-                    var center_y = bb.top + bb.height / 2;
-                    var elAtCenter = document.elementFromPoint(center_x, center_y);
-
-                    return elAtCenter === element || element.contains(elAtCenter);
-                })
-                .map((bb) => {
-                    const rect = {
-                        left: Math.max(0, bb.left),
-                        top: Math.max(0, bb.top),
-                        right: Math.min(vw, bb.right),
-                        bottom: Math.min(vh, bb.bottom),
-                    };
-                    return {
-                        ...rect,
-                        width: rect.right - rect.left,
-                        height: rect.bottom - rect.top,
-                    };
-                });
-
-            var area = rects.reduce((acc, rect) => acc + rect.width * rect.height, 0);
-
-            return {
-                element: element,
-                include:
-                    element.tagName === "INPUT" ||
-                    element.tagName === "TEXTAREA" ||
-                    element.tagName === "SELECT" ||
-                    element.tagName === "BUTTON" ||
-                    element.tagName === "A" ||
-                    element.onclick != null ||
-                    window.getComputedStyle(element).cursor == "pointer" ||
-                    element.tagName === "IFRAME" ||
-                    element.tagName === "VIDEO",
-                area,
-                rects,
-                text: textualContent,
-                type: elementType,
-                ariaLabel: ariaLabel,
-            };
-        })
-        .filter((item) => item.include && item.area >= 20);
-
-    // Only keep inner clickable items
-    items = items.filter(
-        (x) => !items.some((y) => x.element.contains(y.element) && !(x == y))
-    );
 
     // Function to generate random colors
     function getRandomColor() {
@@ -108,50 +200,131 @@ function markPage() {
         return color;
     }
 
-    // Lets create a floating border on top of these elements that will always be visible
-    items.forEach(function (item, index) {
-        item.rects.forEach((bbox) => {
-            newElement = document.createElement("div");
-            var borderColor = getRandomColor();
-            newElement.style.outline = `2px dashed ${borderColor}`;
-            newElement.style.position = "fixed";
-            newElement.style.left = bbox.left + "px";
-            newElement.style.top = bbox.top + "px";
-            newElement.style.width = bbox.width + "px";
-            newElement.style.height = bbox.height + "px";
-            newElement.style.pointerEvents = "none";
-            newElement.style.boxSizing = "border-box";
-            newElement.style.zIndex = 2147483647;
-            // newElement.style.background = `${borderColor}80`;
-
-            // Add floating label at the corner
-            var label = document.createElement("span");
-            label.textContent = index;
-            label.style.position = "absolute";
-            // These we can tweak if we want
-            label.style.top = "-19px";
-            label.style.left = "0px";
-            label.style.background = borderColor;
-            // label.style.background = "black";
-            label.style.color = "white";
-            label.style.padding = "2px 4px";
-            label.style.fontSize = "12px";
-            label.style.borderRadius = "2px";
-            newElement.appendChild(label);
-
-            document.body.appendChild(newElement);
-            labels.push(newElement);
-            // item.element.setAttribute("-ai-label", label.textContent);
+    // options.intersectionObserver が true のときは Promise を返す
+    window.markPage = function (options = {}) {
+        unmarkPage();
+        ensureStyle();
+
+        const timing = {};
+        let last = performance.now();
+        const start = last;
+        function lap(name) {
+            const now = performance.now();
+            timing[name] = now - last;
+            last = now;
+        }
+
+        const candidates = collectCandidates(document.body);
+        lap("collect");
+        if (options.intersectionObserver) {
+            return filterIntersecting(candidates).then((visible) => {
+                lap("intersect");
+                return annotate(visible, candidates.length, timing, lap, start);
+            });
+        }
+        return annotate(candidates, candidates.length, timing, lap, start);
+    };
+
+    function annotate(candidates, candidateCount, timing, lap, start) {
+        // 表示領域は要素ごとではなく一度だけ求める
+        const vw = Math.max(document.documentElement.clientWidth || 0, window.innerWidth || 0);
+        const vh = Math.max(document.documentElement.clientHeight || 0, window.innerHeight || 0);
+
+        // 読み取りだけをまとめて行い、書き込みは最後に行う (レイアウトの再計算を一度で済ませる)
+        let items = [];
+        for (const element of candidates) {
+            const rects = [];
+            let area = 0;
+            for (const bb of element.getClientRects()) {
+                const center_x = bb.left + bb.width / 2;
+                const center_y = bb.top + bb.height / 2;
+                if (center_x < 0 || center_y < 0 || center_x > vw || center_y > vh) {
+                    // 表示領域外の点に elementFromPoint は null を返すので呼ぶ必要がない
+                    continue;
+                }
+                const elAtCenter = document.elementFromPoint(center_x, center_y);
+                if (!(elAtCenter === element || element.contains(elAtCenter))) {
+                    continue;
+                }
+                const rect = {
+                    left: Math.max(0, bb.left),
+                    top: Math.max(0, bb.top),
+                    right: Math.min(vw, bb.right),
+                    bottom: Math.min(vh, bb.bottom),
+                };
+                rect.width = rect.right - rect.left;
+                rect.height = rect.bottom - rect.top;
+                area += rect.width * rect.height;
+                rects.push(rect);
+            }
+            if (area >= 20) {
+                items.push({ element, rects });
+            }
+        }
+        lap("measure");
+
+        // Only keep inner clickable items
+        // 候補は文書順に並んでいるので、子孫を持つ要素の直後の候補は必ずその子孫になる
+        items = items.filter((x, i) => !(i + 1 < items.length && x.element.contains(items[i + 1].element)));
+        for (const item of items) {
+            item.text = item.element.textContent.trim().replace(/\s{2,}/g, " ");
+            item.type = item.element.tagName.toLowerCase();
+            item.ariaLabel = item.element.getAttribute("aria-label") || "";
+        }
+        lap("filter");
+
+        // Lets create a floating border on top of these elements that will always be visible
+        const fragment = document.createDocumentFragment();
+        items.forEach(function (item, index) {
+            item.rects.forEach((bbox) => {
+                var newElement = document.createElement("div");
+                newElement[OWN_NODE] = true;
+                var borderColor = getRandomColor();
+                newElement.style.outline = `2px dashed ${borderColor}`;
+                newElement.style.position = "fixed";
+                newElement.style.left = bbox.left + "px";
+                newElement.style.top = bbox.top + "px";
+                newElement.style.width = bbox.width + "px";
+                newElement.style.height = bbox.height + "px";
+                newElement.style.pointerEvents = "none";
+                newElement.style.boxSizing = "border-box";
+                newElement.style.zIndex = 2147483647;
+
+                // Add floating label at the corner
+                var label = document.createElement("span");
+                label.textContent = index;
+                label.style.position = "absolute";
+                // These we can tweak if we want
+                label.style.top = "-19px";
+                label.style.left = "0px";
+                label.style.background = borderColor;
+                label.style.color = "white";
+                label.style.padding = "2px 4px";
+                label.style.fontSize = "12px";
+                label.style.borderRadius = "2px";
+                newElement.appendChild(label);
+
+                fragment.appendChild(newElement);
+                labels.push(newElement);
+            });
         });
-    });
-    const coordinates = items.flatMap((item) =>
-        item.rects.map(({ left, top, width, height }) => ({
-            x: (left + left + width) / 2,
-            y: (top + top + height) / 2,
-            type: item.type,
-            text: item.text,
-            ariaLabel: item.ariaLabel,
-        }))
-    );
-    return coordinates;
-}
+        document.body.appendChild(fragment);
+        lap("draw");
+
+        const bboxes = items.flatMap((item) =>
+            item.rects.map(({ left, top, width, height }) => ({
+                x: (left + left + width) / 2,
+                y: (top + top + height) / 2,
+                width: width,
+                height: height,
+                type: item.type,
+                text: item.text,
+                ariaLabel: item.ariaLabel,
+            }))
+        );
+        timing.total = performance.now() - start;
+        timing.candidates = candidateCount;
+        timing.items = items.length;
+        return { bboxes, timing };
+    }
+})();
@@ -2,15 +2,93 @@ import os
 import textwrap
 from PIL import Image, ImageDraw, ImageFont
 
+from screenshot_store import ScreenshotRef, ScreenshotStore
+
 # 画面遷移図を作成する
+#
+# スクリーンショットは到着した時点でタイルとしてディスクに書き出し、
+# グリッドは行単位で伸びるキャンバスに新しいタイルだけを貼り付ける。
+# これにより1ステップあたりのコストは全体のステップ数に依存しない。
+# タイルの実体は ScreenshotStore が持ち、Path はキーとサイズのみを保持する。
+
+OUTPUT_FORMATS = ("grid", "html", "webp", "gif")
+
+
+class _LazyFrames(Image.Image):
+    """seek(i) のたびに render(i) でフレームを作る複数フレームの画像
+
+    Pillow の複数フレームの保存処理は n_frames と seek() でフレームを読むので、全フレームを先に作らずに済む。
+    フレームはすべて同じ大きさ・モードにする。
+    """
+
+    def __init__(self, render, n_frames: int):
+        super().__init__()
+        self._render = render
+        self.n_frames = n_frames
+        self.is_animated = n_frames > 1
+        first = render(0)
+        self._mode = first.mode
+        self._size = first.size
+        self.im = first.im
+        self._frame = 0
+
+    def seek(self, frame: int):
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("no more frames")
+        if frame != self._frame:
+            self.im = self._render(frame).im
+            self._frame = frame
+
+    def tell(self) -> int:
+        return self._frame
 
 
 class Path:
-    def __init__(self):
-        self.screenshots = []
-        self.base_filename = "agent_path"
-        self.path_history_dir = "path-history"
+    def __init__(
+        self,
+        path_history_dir: str = "path-history",
+        base_filename: str = "agent_path",
+        output: str = "grid",
+        cols: int = 3,
+        grid_every: int = 10,
+        animation_max_size: int = 640,
+        animation_frame_ms: int = 1000,
+        store: ScreenshotStore | None = None,
+        use_thumbnails: bool = True,
+    ):
+        if output not in OUTPUT_FORMATS:
+            raise ValueError(f"output must be one of {OUTPUT_FORMATS}, got {output!r}")
+        self.base_filename = base_filename
+        self.path_history_dir = path_history_dir
+        self.output = output
+        self.cols = cols
+        # グリッドPNGの再エンコードはキャンバス全体に比例するので、Nステップごとと close() 時のみ行う
+        self.grid_every = grid_every
+        self.animation_max_size = animation_max_size
+        self.animation_frame_ms = animation_frame_ms
+
+        self.store = store or ScreenshotStore(cache_dir=os.path.join(self.path_history_dir, "screenshots"))
+        # True (既定) のときグリッドを縮小版で組み立て、キャンバスのメモリも上限付きにする
+        # False ではフル解像度で組み立てるので、キャンバスはステップ数に比例して大きくなる
+        self.use_thumbnails = use_thumbnails
+
+        # タイルのキーとサイズだけを保持し、PIL画像は保持しない
+        self.tiles: list[ScreenshotRef] = []
+        self.cell_size = self.store.thumbnail_size if use_thumbnails else (0, 0)
+        self.canvas: Image.Image | None = None
+        self._dirty = False
+
         os.makedirs(self.path_history_dir, exist_ok=True)
+        if self.output == "html":
+            self._rewrite_html()
+
+    @property
+    def grid_filename(self) -> str:
+        return os.path.join(self.path_history_dir, f"{self.base_filename}.png")
+
+    @property
+    def html_filename(self) -> str:
+        return os.path.join(self.path_history_dir, f"{self.base_filename}.html")
 
     def create_text_image(self, text, width=800, height=100, font_size=100):
         font = ImageFont.load_default()
@@ -24,10 +102,6 @@ class Path:
         return image
 
     def add_screenshot(self, image, is_initial=False, is_final=False):
-        if is_initial or is_final:
-            self.screenshots.append(image)
-        else:
-            self.screenshots.append(Image.open(image))
         self.update_agent_path_image(image, is_initial, is_final)
 
     def update_agent_path_image(self, new_image, is_initial=False, is_final=False):
@@ -38,25 +112,131 @@ class Path:
         else:
             raise ValueError("The new_image parameter must be a file path or a PIL Image object.")
 
-        if is_initial or is_final:
-            self.screenshots.insert(0 if is_initial else len(self.screenshots), img)
+        # 縮小版はグリッドを縮小版で組み立てるときだけ作る
+        tile = self.store.add(img, thumbnail=self.output == "grid" and self.use_thumbnails)
+        # 先頭への挿入は既存タイルの位置をすべてずらすので、まとめて描き直す
+        relayout = is_initial and len(self.tiles) > 0
+        if relayout:
+            self.tiles.insert(0, tile)
         else:
-            self.screenshots.append(img)
-        filename = os.path.join(self.path_history_dir, f"{self.base_filename}.png")
+            self.tiles.append(tile)
 
-        cols = 3
-        rows = (len(self.screenshots) + cols - 1) // cols
-        max_width, max_height = self.get_max_dimensions(self.screenshots)
+        if self.output == "html":
+            if relayout:
+                self._rewrite_html()
+            else:
+                self._append_html(tile, len(self.tiles))
+        elif self.output == "grid":
+            if relayout:
+                self._relayout()
+            else:
+                self._paste_tile(len(self.tiles) - 1, self._tile_image(tile) if self.use_thumbnails else img)
+            self._dirty = True
+            if is_final or (self.grid_every and len(self.tiles) % self.grid_every == 0):
+                self.save_grid()
+        return tile
 
-        grid_image = Image.new("RGB", (cols * max_width, rows * max_height), color=(255, 255, 255))
-        for i, img in enumerate(self.screenshots):
-            x = (i % cols) * max_width
-            y = (i // cols) * max_height
-            grid_image.paste(img, (x, y))
-        grid_image.save(filename)
+    def close(self):
+        """残っている出力を書き出す。実行の最後に一度呼ぶ"""
+        if self.output == "grid":
+            if self._dirty:
+                self.save_grid()
+        elif self.output == "html":
+            with open(self.html_filename, "a") as f:
+                f.write("</body></html>\n")
+        else:
+            self.save_animation()
 
-    def get_max_dimensions(self, screenshots):
-        widths, heights = zip(
-            *[(img.width, img.height) if isinstance(img, Image.Image) else Image.open(img).size for img in screenshots]
+    def save_grid(self):
+        if self.canvas is None:
+            return
+        rows = (len(self.tiles) + self.cols - 1) // self.cols
+        grid = self.canvas.crop((0, 0, self.canvas.width, rows * self.cell_size[1]))
+        grid.save(self.grid_filename, compress_level=1)
+        self._dirty = False
+
+    def save_animation(self):
+        if not self.tiles:
+            return
+        filename = os.path.join(self.path_history_dir, f"{self.base_filename}.{self.output}")
+        size = (self.animation_max_size, self.animation_max_size)
+
+        def render(index: int) -> Image.Image:
+            frame = self.store.open(self.tiles[index].key).convert("RGB")
+            frame.thumbnail(size)
+            canvas = Image.new("RGB", size, color=(255, 255, 255))
+            canvas.paste(frame, (0, 0))
+            return canvas
+
+        # フレームは保存処理が読むときに1枚ずつ作るので、WebP ではメモリはステップ数によらない。
+        # GIF は Pillow が差分を取ったパレット画像を全フレーム分保持してから書き出す (RGBの約1/3)
+        _LazyFrames(render, len(self.tiles)).save(
+            filename, save_all=True, duration=self.animation_frame_ms, loop=0
         )
+
+    def get_max_dimensions(self, screenshots):
+        widths, heights = zip(*[self._dimensions(img) for img in screenshots])
         return max(widths), max(heights)
+
+    def _dimensions(self, img) -> tuple[int, int]:
+        if isinstance(img, ScreenshotRef):
+            return img.size
+        if isinstance(img, Image.Image):
+            return img.width, img.height
+        with Image.open(img) as opened:
+            return opened.size
+
+    def _tile_image(self, tile: ScreenshotRef) -> Image.Image:
+        if self.use_thumbnails:
+            return self.store.thumbnail(tile.key)
+        return self.store.open(tile.key)
+
+    def _paste_tile(self, index: int, img: Image.Image):
+        width, height = img.size
+        if width > self.cell_size[0] or height > self.cell_size[1]:
+            # セルより大きいタイルが来たときだけ全体を描き直す (通常は最初のスクリーンショットのみ)
+            self.cell_size = (max(width, self.cell_size[0]), max(height, self.cell_size[1]))
+            self._relayout()
+            return
+        self._ensure_rows(index // self.cols + 1)
+        cell_w, cell_h = self.cell_size
+        self.canvas.paste(img, ((index % self.cols) * cell_w, (index // self.cols) * cell_h))
+
+    def _ensure_rows(self, rows: int):
+        cell_w, cell_h = self.cell_size
+        capacity = 0 if self.canvas is None else self.canvas.height // cell_h
+        if rows <= capacity:
+            return
+        # 行数を1.5倍ずつ確保して再確保の回数を O(log n) に抑える
+        new_capacity = max(rows, capacity + capacity // 2)
+        canvas = Image.new("RGB", (self.cols * cell_w, new_capacity * cell_h), color=(255, 255, 255))
+        if self.canvas is not None:
+            canvas.paste(self.canvas, (0, 0))
+        self.canvas = canvas
+
+    def _relayout(self):
+        if not self.use_thumbnails:
+            self.cell_size = (
+                max([self.cell_size[0]] + [tile.size[0] for tile in self.tiles]),
+                max([self.cell_size[1]] + [tile.size[1] for tile in self.tiles]),
+            )
+        self.canvas = None
+        self._ensure_rows((len(self.tiles) + self.cols - 1) // self.cols)
+        cell_w, cell_h = self.cell_size
+        for i, tile in enumerate(self.tiles):
+            self.canvas.paste(self._tile_image(tile), ((i % self.cols) * cell_w, (i // self.cols) * cell_h))
+
+    def _rewrite_html(self):
+        with open(self.html_filename, "w") as f:
+            f.write(
+                "<!DOCTYPE html><html><head><meta charset='utf-8'><title>agent path</title>"
+                "<style>body{display:flex;flex-wrap:wrap;gap:8px}figure{margin:0}"
+                "img{max-width:480px;border:1px solid #ccc}</style></head><body>\n"
+            )
+        for i, tile in enumerate(self.tiles, start=1):
+            self._append_html(tile, i)
+
+    def _append_html(self, tile: ScreenshotRef, step: int):
+        src = os.path.relpath(self.store.path(tile.key), self.path_history_dir)
+        with open(self.html_filename, "a") as f:
+            f.write(f"<figure><img src='{src}' loading='lazy'><figcaption>{step}</figcaption></figure>\n")
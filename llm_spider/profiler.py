@@ -0,0 +1,167 @@
+import contextvars
+import json
+import statistics
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+# グラフの各ノードの所要時間・送受信バイト数・トークン数を記録する
+#
+# profiled() で包んだ Runnable は、現在の実行に RunProfiler が設定されていれば計測される。
+# 結果は要約表と、chrome://tracing や Perfetto で開ける Chrome trace 形式のJSONで出力する。
+
+current_profiler: contextvars.ContextVar["RunProfiler | None"] = contextvars.ContextVar(
+    "current_profiler", default=None
+)
+
+
+@dataclass
+class Span:
+    name: str
+    step: int
+    start: float
+    duration: float
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    extra: dict = field(default_factory=dict)
+
+
+class RunProfiler:
+    def __init__(self):
+        self.spans: list[Span] = []
+        # ステップごとの索引 (ステップの記録のたびに全体を走査しない)
+        self.step_spans: dict[int, list[Span]] = defaultdict(list)
+        self.step = 0
+        self._origin = time.perf_counter()
+
+    def add(self, span: Span):
+        self.spans.append(span)
+        self.step_spans[span.step].append(span)
+
+    def step_timings(self, step: int) -> dict[str, float]:
+        """ステップ内の各ノードの所要時間 (秒)。同じノードが複数回呼ばれたら合計する"""
+        timings: dict[str, float] = defaultdict(float)
+        for span in self.step_spans.get(step, ()):
+            timings[span.name] += span.duration
+        return dict(timings)
+
+    def summary(self) -> list[dict]:
+        by_name: dict[str, list[Span]] = defaultdict(list)
+        for span in self.spans:
+            by_name[span.name].append(span)
+        # ステップ全体 (agent) は内訳と二重に数えないよう、割合の分母から除く
+        total = sum(span.duration for span in self.spans if span.name != "agent") or 1.0
+        rows = []
+        for name, spans in by_name.items():
+            durations = [span.duration for span in spans]
+            rows.append(
+                {
+                    "name": name,
+                    "count": len(spans),
+                    "total_s": sum(durations),
+                    "mean_ms": statistics.mean(durations) * 1000,
+                    "max_ms": max(durations) * 1000,
+                    "share": 0.0 if name == "agent" else sum(durations) / total,
+                    "bytes_sent": sum(span.bytes_sent for span in spans),
+                    "bytes_received": sum(span.bytes_received for span in spans),
+                    "prompt_tokens": sum(span.prompt_tokens for span in spans),
+                    "completion_tokens": sum(span.completion_tokens for span in spans),
+                }
+            )
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+    def format_summary(self) -> str:
+        lines = [
+            f"{'node':<18}{'count':>6}{'total s':>9}{'mean ms':>9}{'max ms':>9}{'share':>7}"
+            f"{'sent KiB':>10}{'recv KiB':>10}{'tokens in':>10}{'out':>7}"
+        ]
+        for row in self.summary():
+            lines.append(
+                f"{row['name']:<18}{row['count']:>6}{row['total_s']:>9.2f}{row['mean_ms']:>9.0f}"
+                f"{row['max_ms']:>9.0f}{row['share']:>7.0%}{row['bytes_sent'] / 1024:>10.1f}"
+                f"{row['bytes_received'] / 1024:>10.1f}{row['prompt_tokens']:>10}{row['completion_tokens']:>7}"
+            )
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        events = []
+        for span in self.spans:
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": "agent",
+                    "ph": "X",
+                    "ts": (span.start - self._origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": 1,
+                    "tid": 1,
+                    "args": {
+                        "step": span.step,
+                        "bytes_sent": span.bytes_sent,
+                        "bytes_received": span.bytes_received,
+                        "prompt_tokens": span.prompt_tokens,
+                        "completion_tokens": span.completion_tokens,
+                        **span.extra,
+                    },
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def _payload_bytes(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, BaseMessage):
+        return _payload_bytes(value.content)
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_payload_bytes(item) for item in value.values())
+    if hasattr(value, "to_messages"):
+        return _payload_bytes(value.to_messages())
+    return 0
+
+
+def _token_usage(value) -> tuple[int, int]:
+    if not isinstance(value, BaseMessage):
+        return 0, 0
+    usage = getattr(value, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (getattr(value, "response_metadata", None) or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+
+def profiled(name: str, runnable, new_step: bool = False, measure_io: bool = False) -> RunnableLambda:
+    """Runnable を計測付きで包む。new_step=True のノードが呼ばれるたびにステップ番号を進める"""
+    inner = runnable if hasattr(runnable, "ainvoke") else RunnableLambda(runnable)
+
+    async def _run(input, config: RunnableConfig):
+        profiler = current_profiler.get()
+        if profiler is None:
+            return await inner.ainvoke(input, config)
+        if new_step:
+            profiler.step += 1
+        step = profiler.step
+        start = time.perf_counter()
+        output = await inner.ainvoke(input, config)
+        span = Span(name, step, start, time.perf_counter() - start)
+        if measure_io:
+            span.bytes_sent = _payload_bytes(input)
+            span.bytes_received = _payload_bytes(output)
+            span.prompt_tokens, span.completion_tokens = _token_usage(output)
+        if isinstance(output, dict) and "img_bytes" in output:
+            span.extra["img_bytes"] = output["img_bytes"]
+        profiler.add(span)
+        return output
+
+    return RunnableLambda(_run, name=name)
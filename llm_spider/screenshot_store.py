@@ -0,0 +1,120 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from PIL import Image
+
+# スクリーンショットの保存先
+#
+# 元画像は内容のハッシュをキーにしてディスクへ書き出し、メモリには縮小版のみを置く (縮小版は使うときだけ作る)。
+# 縮小版はメモリ上限を超えると古いものから捨て、必要になればディスクから作り直す。
+# 複数のブラウザ・エージェントから同じインスタンスを共有できる。
+
+
+class ScreenshotRef(NamedTuple):
+    key: str
+    size: tuple[int, int]
+
+
+class ScreenshotStore:
+    def __init__(
+        self,
+        cache_dir: str = os.path.join("path-history", "screenshots"),
+        thumbnail_size: tuple[int, int] = (320, 320),
+        max_memory_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.cache_dir = cache_dir
+        self.thumbnail_size = thumbnail_size
+        self.max_memory_bytes = max_memory_bytes
+        self._thumbnails: OrderedDict[str, Image.Image] = OrderedDict()
+        self._sizes: dict[str, tuple[int, int]] = {}
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def add(self, image: Image.Image | str, thumbnail: bool = False) -> ScreenshotRef:
+        """image をディスクに書き出す。thumbnail のときは縮小版もメモリに置く (後の thumbnail() で読み直さない)"""
+        if isinstance(image, str):
+            with Image.open(image) as opened:
+                return self.add(opened.copy(), thumbnail)
+        digest = hashlib.sha256(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+        key = digest.hexdigest()
+        filename = self.path(key)
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # 同じ内容を並行して書いても壊れないよう、一時ファイルから置き換える
+            tmp = f"{filename}.{threading.get_ident()}.tmp"
+            image.save(tmp, format="PNG", compress_level=1)
+            os.replace(tmp, filename)
+        with self._lock:
+            self._sizes[key] = image.size
+        if thumbnail:
+            self._put_thumbnail(key, image)
+        return ScreenshotRef(key, image.size)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def size(self, key: str) -> tuple[int, int]:
+        with self._lock:
+            size = self._sizes.get(key)
+        if size is None:
+            # 別プロセスが書いたキャッシュの場合のみヘッダを読む (画素はデコードしない)
+            with Image.open(self.path(key)) as image:
+                size = image.size
+            with self._lock:
+                self._sizes[key] = size
+        return size
+
+    def open(self, key: str) -> Image.Image:
+        with Image.open(self.path(key)) as image:
+            image.load()
+            return image
+
+    def thumbnail(self, key: str) -> Image.Image:
+        with self._lock:
+            thumbnail = self._thumbnails.get(key)
+            if thumbnail is not None:
+                self._thumbnails.move_to_end(key)
+                self.hits += 1
+                return thumbnail
+            self.misses += 1
+        image = self.open(key)
+        return self._put_thumbnail(key, image)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._sizes),
+                "thumbnails": len(self._thumbnails),
+                "memory_bytes": self._memory_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _put_thumbnail(self, key: str, image: Image.Image) -> Image.Image:
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail(self.thumbnail_size)
+        nbytes = thumbnail.width * thumbnail.height * len(thumbnail.getbands())
+        with self._lock:
+            previous = self._thumbnails.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous.width * previous.height * len(previous.getbands())
+            self._thumbnails[key] = thumbnail
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_memory_bytes and len(self._thumbnails) > 1:
+                _, evicted = self._thumbnails.popitem(last=False)
+                self._memory_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+                self.evictions += 1
+        return thumbnail
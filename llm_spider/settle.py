@@ -0,0 +1,108 @@
+import asyncio
+import time
+import weakref
+from dataclasses import dataclass
+
+from playwright.async_api import Error, Page, Request
+
+# 操作の後、ページが落ち着くまで待つ
+#
+# 固定時間のスリープの代わりに、(1) 読み込み状態を待ち、続けて (2) 通信が一定時間途切れることと
+# (3) DOMの変更が一定時間止まること、を同時に待つ (静かな時間は両方とも操作の時点から数えるので、
+# 待ち時間は quiet の2倍ではなく、遅い方の1回分で済む)。全体は timeout で打ち切る。
+# (3) は mark_page.js の waitForDomQuiet() を使う。
+
+
+@dataclass
+class SettleOptions:
+    timeout: float = 10.0  # 秒
+    quiet: float = 0.5  # 通信とDOMの変化が止まっているとみなす時間 (秒)
+    max_inflight: int = 2  # これ以下の通信中リクエストは無視する (ロングポーリングや計測ビーコン対策)
+
+
+@dataclass
+class SettleResult:
+    elapsed: float
+    timed_out: bool
+
+    def __str__(self) -> str:
+        suffix = " (timed out)" if self.timed_out else ""
+        return f"page settled in {self.elapsed:.1f}s{suffix}"
+
+
+class NetworkTracker:
+    def __init__(self, page: Page):
+        self.inflight: set[Request] = set()
+        self.last_activity = time.monotonic()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_done)
+        page.on("requestfailed", self._on_done)
+
+    def _on_request(self, request: Request):
+        self.inflight.add(request)
+        self.last_activity = time.monotonic()
+
+    def _on_done(self, request: Request):
+        self.inflight.discard(request)
+        self.last_activity = time.monotonic()
+
+
+_trackers: "weakref.WeakKeyDictionary[Page, NetworkTracker]" = weakref.WeakKeyDictionary()
+
+
+def track_network(page: Page) -> NetworkTracker:
+    """ページの通信の監視を始める。操作より前に呼んでおく"""
+    if page not in _trackers:
+        _trackers[page] = NetworkTracker(page)
+    return _trackers[page]
+
+
+async def settle(page: Page, options: SettleOptions | None = None) -> SettleResult:
+    options = options or SettleOptions()
+    tracker = track_network(page)
+    start = time.monotonic()
+    deadline = start + options.timeout
+
+    def remaining() -> float:
+        return max(0.0, deadline - time.monotonic())
+
+    def remaining_ms() -> float:
+        # Playwright は timeout=0 を「無制限」と解釈するので、最小でも1msにする
+        return max(1.0, remaining() * 1000)
+
+    try:
+        await page.wait_for_load_state("domcontentloaded", timeout=remaining_ms())
+    except Error:
+        return SettleResult(time.monotonic() - start, True)
+
+    async def network_quiet():
+        while remaining() > 0:
+            now = time.monotonic()
+            # 操作直後はまだリクエストが出ていないこともあるので、静かな時間は操作の時点から数える
+            quiet_since = max(tracker.last_activity, start)
+            if len(tracker.inflight) <= options.max_inflight and now - quiet_since >= options.quiet:
+                return
+            await asyncio.sleep(0.05)
+
+    async def dom_quiet():
+        backoff = 0.05
+        while remaining() > 0:
+            try:
+                await page.evaluate(
+                    "([quiet, timeout]) => window.waitForDomQuiet ? window.waitForDomQuiet(quiet, timeout) : 0",
+                    [options.quiet * 1000, remaining_ms()],
+                )
+                return
+            except Error:
+                # 待っている間に遷移した場合は新しい文書で待ち直す
+                try:
+                    await page.wait_for_load_state("domcontentloaded", timeout=remaining_ms())
+                except Error:
+                    return
+                # 遷移以外のエラーで evaluate がすぐに失敗し続けるときに、空回りしないよう間隔を空ける
+                await asyncio.sleep(min(backoff, remaining()))
+                backoff = min(backoff * 2, 1.0)
+
+    await asyncio.gather(network_quiet(), dom_quiet())
+
+    return SettleResult(time.monotonic() - start, remaining() <= 0)
@@ -0,0 +1,89 @@
+import asyncio
+import io
+import json
+import os
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from path import Path
+
+# エージェントの実行記録
+#
+# 画像のデコード、画面遷移図の更新、ファイルへの追記はすべて専用のスレッド1本で順番に行い、
+# イベントループ (ブラウザとLLMのI/O) を止めない。
+# 記録は追記のみの JSONL (trace.jsonl) と、人が読むための agent_steps.txt に書く。
+
+
+def new_run_dir(base_dir: str = "path-history") -> str:
+    """実行ごとの出力先。並列に実行しても互いのファイルを上書きしない"""
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    run_dir = os.path.join(base_dir, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+
+class TraceWriter:
+    def __init__(self, run_dir: str, path: Path):
+        self.run_dir = run_dir
+        self.path = path
+        self.trace_filename = os.path.join(run_dir, "trace.jsonl")
+        self.steps_filename = os.path.join(run_dir, "agent_steps.txt")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-writer")
+        self._last: Future | None = None
+        self._start = time.perf_counter()
+        self._trace_file = None
+        self._steps_file = None
+
+    def add_image(self, image: Image.Image, is_initial: bool = False, is_final: bool = False):
+        self._submit(self.path.update_agent_path_image, image, is_initial, is_final)
+
+    def record_step(self, step: int, action, args, state: dict, timings: dict | None = None):
+        """エージェントの1ステップを記録する。呼び出し側ではブロックしない"""
+        record = {
+            "step": step,
+            "action": action,
+            "args": args,
+            "elapsed": time.perf_counter() - self._start,
+            "timings": {"mark_page": state.get("mark_timing") or {}, **(timings or {})},
+            "img_bytes": state.get("img_bytes"),
+        }
+        # 画面遷移図と保存するタイルには、LLM向けに縮小・圧縮した画像ではなく撮影したままの画像を使う
+        self._submit(self._write_step, record, state.get("screenshot"))
+
+    async def aclose(self):
+        """未処理の記録をすべて書き出してから閉じる"""
+        await asyncio.wrap_future(self._submit(self._close))
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, fn, *args) -> Future:
+        self._last = self._executor.submit(self._guard, fn, *args)
+        return self._last
+
+    def _guard(self, fn, *args):
+        # 記録の失敗でエージェントの実行を止めない
+        try:
+            fn(*args)
+        except Exception:
+            print(f"Trace writer error:\n{traceback.format_exc()}")
+
+    def _write_step(self, record: dict, screenshot: bytes | None):
+        if screenshot:
+            tile = self.path.update_agent_path_image(Image.open(io.BytesIO(screenshot)))
+            record["screenshot"] = os.path.relpath(self.path.store.path(tile.key), self.run_dir)
+        if self._trace_file is None:
+            self._trace_file = open(self.trace_filename, "a")
+            self._steps_file = open(self.steps_filename, "a")
+        self._trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._trace_file.flush()
+        self._steps_file.write(f"{record['step']}. {record['action']}: {record['args']}\n")
+        self._steps_file.flush()
+
+    def _close(self):
+        self.path.close()
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._steps_file.close()